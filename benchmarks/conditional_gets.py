@@ -0,0 +1,68 @@
+"""
+Time spent serving the pages and fragments a returning user navigates through: rendered
+in full, served from the server's cache of rendered fragments to a browser that doesn't
+have them, and answered with a 304 because the browser sent the ETag of its copy.
+
+    python benchmarks/conditional_gets.py [storage] [requests per page]
+"""
+import os
+import sys
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+
+import httpx
+
+from storage_backends import populate
+
+#: Pages of the navigation between the home and a deck
+PAGES = [
+    "/home",
+    "/htmx/components/decks",
+    "/decks/0/cards",
+    "/htmx/components/decks/0/cards",
+    "/htmx/components/schemas",
+]
+
+
+async def timed(client, url, requests, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    start = default_timer()
+    for _ in range(requests):
+        response = await client.get(url, headers=headers)
+        assert response.status_code == (304 if etag else 200)
+    return (default_timer() - start) / requests * 1000, response
+
+
+async def main(storage, requests):
+    with TemporaryDirectory() as folder:
+        # Read when the app is imported
+        os.environ["FLASHCARDS_STORAGE"] = storage
+        os.environ["FLASHCARDS_DATABASE"] = str(Path(folder) / "flashcards")
+        os.environ["FLASHCARDS_LEGACY_DATABASE"] = str(Path(folder) / "flashcards.db")
+        from flashcards_htmx.app import app, rendered_fragments
+
+        async with app.router.lifespan_context(app):
+            populate(app.state.storage, 50, 50)
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                print(f"{storage} storage, {requests} requests per page\n")
+                print(f"{'page':<34}  {'rendered':>9}  {'shared':>9}  {'304':>9}  {'bytes':>7}")
+                max_bytes = rendered_fragments.max_bytes
+                for url in PAGES:
+                    rendered_fragments.max_bytes = 0
+                    full, response = await timed(client, url, requests)
+                    rendered_fragments.max_bytes = max_bytes
+                    shared, _ = await timed(client, url, requests)
+                    cached, _ = await timed(client, url, requests, response.headers["ETag"])
+                    print(
+                        f"{url:<34}  {full:>6.2f} ms  {shared:>6.2f} ms  {cached:>6.2f} ms  "
+                        f"{len(response.content):>7}"
+                    )
+
+
+if __name__ == "__main__":
+    storage = sys.argv[1] if len(sys.argv) > 1 else "sqlite"
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    asyncio.run(main(storage, requests))
@@ -0,0 +1,122 @@
+"""
+Stress test of the SQLite storage shared by several processes, like the workers of
+`uvicorn --workers N`: each process posts reviews through the app, all on the same few
+cards, and then checks that no review was lost and that its review index isn't stale.
+
+    python benchmarks/multiprocess_reviews.py [processes] [reviews per process] [cards]
+"""
+import os
+import sys
+import asyncio
+import multiprocessing
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+
+import httpx
+
+from storage_backends import populate
+
+#: Card types of the cards created by `populate`
+CARD_TYPES = ["direct", "reverse"]
+
+
+def open_app(folder):
+    # Read when the app is imported
+    os.environ["FLASHCARDS_STORAGE"] = "sqlite"
+    os.environ["FLASHCARDS_DATABASE"] = str(Path(folder) / "flashcards.sqlite3")
+    os.environ["FLASHCARDS_LEGACY_DATABASE"] = str(Path(folder) / "flashcards.db")
+    from flashcards_htmx.app import app
+
+    return app
+
+
+async def review(app, worker, reviews, cards, barrier):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        for number in range(reviews):
+            card_id, card_type = reviewed(worker + number, cards)
+            response = await client.post(
+                f"/htmx/components/decks/0/study/{card_id}/{card_type}/correct"
+            )
+            response.raise_for_status()
+    barrier.wait()
+    # Every other process is done writing: the index must reflect all their reviews
+    storage = app.state.storage
+    scores = {
+        (card_id, card_type): score or 0
+        for card_id, card_type, score in storage.list_reviews("0")
+    }
+    minimum = min(scores.values())
+    lowest = {key for key, score in scores.items() if score == minimum}
+    picked = {storage.review_index.pick("0", minimum) for _ in range(100 * len(lowest))}
+    return storage.review_index.minimum("0") == minimum and picked == lowest
+
+
+def reviewed(number, cards):
+    """The card type reviewed by the given review: they're all reviewed in turn"""
+    card_id, card_type = divmod(number % (cards * len(CARD_TYPES)), len(CARD_TYPES))
+    return str(card_id), CARD_TYPES[card_type]
+
+
+def worker(folder, number, reviews, cards, barrier, results):
+    app = open_app(folder)
+
+    async def run():
+        async with app.router.lifespan_context(app):
+            return await review(app, number, reviews, cards, barrier)
+
+    results.put((number, asyncio.run(run())))
+
+
+def main(processes, reviews, cards):
+    from flashcards_htmx.storage import SQLiteStorage
+
+    with TemporaryDirectory() as folder:
+        storage = SQLiteStorage(str(Path(folder) / "flashcards.sqlite3"))
+        storage.open()
+        populate(storage, cards, 1)
+        storage.close()
+
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(processes)
+        results = context.Queue()
+        workers = [
+            context.Process(
+                target=worker, args=(folder, number, reviews, cards, barrier, results)
+            )
+            for number in range(processes)
+        ]
+        start = default_timer()
+        for process in workers:
+            process.start()
+        fresh = dict(results.get() for _ in workers)
+        for process in workers:
+            process.join()
+        elapsed = default_timer() - start
+
+        storage.open()
+        scores = {(card_id, card_type): score or 0
+                  for card_id, card_type, score in storage.list_reviews("0")}
+        storage.close()
+
+    expected = {key: 0 for key in scores}
+    for number in range(processes):
+        for review_number in range(reviews):
+            expected[reviewed(number + review_number, cards)] += 1
+    lost = sum(expected[key] - scores[key] for key in expected)
+    stale = [number for number, ok in fresh.items() if not ok]
+
+    print(f"{processes} processes, {reviews} reviews each on {cards} cards: {elapsed:.1f} s")
+    saved = sum(scores.values())
+    print(f"reviews saved: {saved} of {sum(expected.values())}")
+    print(f"reviews lost: {lost}")
+    print(f"processes with a stale review index: {len(stale)}")
+    return lost == 0 and not stale
+
+
+if __name__ == "__main__":
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    reviews = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    cards = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    sys.exit(0 if main(processes, reviews, cards) else 1)
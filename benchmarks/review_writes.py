@@ -0,0 +1,65 @@
+"""
+Throughput of concurrent reviews saved to the SQLite storage, each in its own transaction
+and with group commit (see `flashcards_htmx.api.reviews`).
+
+    python benchmarks/review_writes.py [threads] [reviews per thread]
+"""
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from timeit import default_timer
+
+from flashcards_htmx.api import reviews
+from flashcards_htmx.api.algorithms import ALGORITHMS
+from flashcards_htmx.storage import SQLiteStorage
+
+from storage_backends import populate
+
+
+def review(storage, group_commit, thread, count):
+    algorithm = ALGORITHMS["HardestFirst"]
+    for number in range(count):
+        card_id = str((thread + number) % 100)
+
+        def save():
+            now = time.time()
+            algorithm.process_result(storage, "0", card_id, "direct", "correct", now=now)
+            storage.log_review("0", card_id, "direct", "correct", now)
+
+        group_commit.save(storage, save)
+
+
+def benchmark(batch_size, threads, count):
+    reviews.REVIEW_BATCH_SIZE = batch_size
+    with TemporaryDirectory() as folder:
+        storage = SQLiteStorage(str(Path(folder) / "flashcards.sqlite3"))
+        storage.open()
+        populate(storage, 100, 1)
+        group_commit = reviews.GroupCommit()
+        workers = [
+            Thread(target=review, args=(storage, group_commit, thread, count))
+            for thread in range(threads)
+        ]
+        start = default_timer()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = default_timer() - start
+        logged = len(storage.list_review_log("0"))
+        storage.close()
+    print(
+        f"{batch_size:>10}  {logged / elapsed:>10.0f}/s  "
+        f"{group_commit.transactions:>12}  {logged:>8}"
+    )
+
+
+if __name__ == "__main__":
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    print(f"{threads} threads, {count} reviews each\n")
+    print(f"{'batch size':>10}  {'reviews':>12}  {'transactions':>12}  {'logged':>8}")
+    for batch_size in (1, reviews.REVIEW_BATCH_SIZE):
+        benchmark(batch_size, threads, count)
@@ -0,0 +1,92 @@
+"""
+Times the storage operations used by the routers against every storage backend.
+
+    python benchmarks/storage_backends.py [cards per deck] [decks]
+"""
+import sys
+import random
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+
+from flashcards_htmx.storage import STORAGE_BACKENDS, DEFAULT_SCHEMAS
+
+
+def timed(function, repeat=100):
+    start = default_timer()
+    for _ in range(repeat):
+        function()
+    return (default_timer() - start) / repeat * 1000
+
+
+def populate(storage, cards, decks):
+    schema_id = list(DEFAULT_SCHEMAS)[1]
+    with storage.transaction():
+        for deck in range(decks):
+            storage.import_deck(str(deck), {
+                "name": f"Deck {deck}",
+                "description": "",
+                "tags": [],
+                "algorithm": "HardestFirst",
+                "cards": {
+                    str(card): {
+                        "schema": schema_id,
+                        "tags": [f"tag{card % 10}", f"group{card % 3}"],
+                        "question": f"Question {card}",
+                        "answer": f"Answer {card}",
+                        "reviews": {"direct": None, "reverse": None},
+                    }
+                    for card in range(cards)
+                }
+            })
+    return schema_id
+
+
+def benchmark(name, backend, cards, decks):
+    with TemporaryDirectory() as folder:
+        storage = backend(str(Path(folder) / "flashcards.db"))
+        storage.open()
+        start = default_timer()
+        schema_id = populate(storage, cards, decks)
+        populate_time = (default_timer() - start) * 1000
+
+        def card_id():
+            return str(random.randrange(cards))
+
+        results = {
+            "populate": populate_time,
+            "list_decks": timed(storage.list_decks),
+            "get_deck": timed(lambda: storage.get_deck("0")),
+            "get_card": timed(lambda: storage.get_card("0", card_id())),
+            "list_cards": timed(lambda: storage.list_cards("0"), repeat=10),
+            "page_cards": timed(lambda: storage.page_cards("0", str(cards // 2), 50)),
+            "list_reviews": timed(lambda: storage.list_reviews("0"), repeat=10),
+            "upsert_card": timed(lambda: storage.upsert_card("0", card_id(), {
+                "schema": schema_id,
+                "tags": [],
+                "question": "Question",
+                "answer": "Answer",
+                "reviews": {"direct": 1, "reverse": None},
+            })),
+            "record_review": timed(
+                lambda: storage.record_review("0", card_id(), "direct", random.randrange(5))
+            ),
+            "usage_by_schema": timed(storage.usage_by_schema, repeat=10),
+            "search": timed(lambda: storage.search(f"question {card_id()}"), repeat=10),
+            "filter_cards": timed(
+                lambda: storage.filter_cards("0", ["tag1", "group2"], schema_id, 50), repeat=10
+            ),
+        }
+        storage.close()
+
+    print(f"\n{name}")
+    for operation, milliseconds in results.items():
+        print(f"  {operation:<16} {milliseconds:>10.3f} ms")
+
+
+if __name__ == "__main__":
+    cards = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    decks = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"{decks} decks with {cards} cards each")
+    for name, backend in STORAGE_BACKENDS.items():
+        benchmark(name, backend, cards, decks)
@@ -0,0 +1,87 @@
+"""
+Latency of concurrent study requests while reviews are being saved, with the storage's
+writes slowed down artificially: since the storage is accessed in the threadpool, the
+study requests' p99 shouldn't grow with the time each write takes.
+
+    python benchmarks/study_load.py [concurrent readers] [requests per reader]
+"""
+import os
+import sys
+import time
+import asyncio
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+
+import httpx
+
+from storage_backends import populate
+
+#: Simulated duration of each write, in milliseconds
+WRITE_DELAYS = [0, 20, 100]
+
+
+def slowed_down(storage, delay):
+    record_review = type(storage).record_review
+
+    def slow_record_review(*args, **kwargs):
+        with storage.transaction():
+            # Blocking, like a slow fsync: it would stall everything if run on the event loop
+            time.sleep(delay / 1000)
+            record_review(storage, *args, **kwargs)
+
+    storage.record_review = slow_record_review
+
+
+async def reader(client, requests, latencies):
+    for _ in range(requests):
+        start = default_timer()
+        response = await client.get("/htmx/components/decks/0/study")
+        response.raise_for_status()
+        latencies.append((default_timer() - start) * 1000)
+
+
+async def writer(client, stop):
+    reviews = 0
+    while not stop.is_set():
+        response = await client.post("/htmx/components/decks/0/study/1/direct/Correct")
+        response.raise_for_status()
+        reviews += 1
+    return reviews
+
+
+async def run(app, delay, readers, requests):
+    slowed_down(app.state.storage, delay)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        stop = asyncio.Event()
+        writing = asyncio.create_task(writer(client, stop))
+        latencies = []
+        await asyncio.gather(*(reader(client, requests, latencies) for _ in range(readers)))
+        stop.set()
+        reviews = await writing
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{delay:>14} ms  {p50:>8.1f} ms  {p99:>8.1f} ms  {reviews:>8}")
+
+
+async def main(readers, requests):
+    with TemporaryDirectory() as folder:
+        # Read when the app is imported
+        os.environ["FLASHCARDS_DATABASE"] = str(Path(folder) / "flashcards.sqlite3")
+        os.environ["FLASHCARDS_LEGACY_DATABASE"] = str(Path(folder) / "flashcards.db")
+        from flashcards_htmx.app import app
+
+        async with app.router.lifespan_context(app):
+            populate(app.state.storage, 1000, 1)
+            print(f"{readers} readers, {requests} study requests each\n")
+            print(f"{'write delay':>17}  {'p50':>11}  {'p99':>11}  {'reviews':>8}")
+            for delay in WRITE_DELAYS:
+                await run(app, delay, readers, requests)
+
+
+if __name__ == "__main__":
+    readers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(main(readers, requests))
@@ -1,10 +1,15 @@
-from typing import Dict
+from typing import Any, Dict
 from abc import ABC, abstractmethod
+import math
+import time
 import random
 
-from jinja2 import Template
+import numpy as np
+from fastapi import HTTPException
 
-from flashcards_htmx.api.utils import get_question_answer_from_schema
+from flashcards_htmx.ebisu import update_recall, weakest
+from flashcards_htmx.api.utils import card_question_answer
+from flashcards_htmx.storage import MemoryStorage
 
 
 class Algorithm(ABC):
@@ -15,13 +20,24 @@ class Algorithm(ABC):
             "wrong": "var(--danger)",
         }
 
+    def settings(self, form) -> Dict[str, Any]:
+        """Deck settings specific to this algorithm, read from the deck's form"""
+        return {}
+
     @abstractmethod
-    def next_card(self, deck, schemas):
-        ...
+    def next_card(self, storage, deck_id, deck, card_ids=None):
+        """
+        Picks the next card type to review, among the cards in `card_ids` if given
+        (for example the ones with some tags), otherwise among the whole deck.
+        Returns None if there's no card type to pick.
+        """
 
     @abstractmethod
-    def process_result(self, deck, card_id, card_type, result):
-        ...
+    def process_result(self, storage, deck_id, card_id, card_type, result, now=None):
+        """
+        Updates the card type's score or model with the review's result. `now` is the
+        review's timestamp, when it's replayed from the review log.
+        """
 
 
 class Random(Algorithm):
@@ -30,15 +46,17 @@ class Random(Algorithm):
     No review data is kept.
     """
     
-    def next_card(self, deck, schemas):
-        card_id, card_data = random.choice(list(deck["cards"].items()))
-        card_schema = schemas[card_data["schema"]]
-        card_type, card = random.choice(list(card_schema["cards"].items()))
-        question = Template(card["question"]).render(**card_data)
-        answer = Template(card["answer"]).render(**card_data)
+    def next_card(self, storage, deck_id, deck, card_ids=None):
+        if card_ids is not None:
+            card_id = random.choice(list(card_ids))
+            card_data = storage.get_card(deck_id, card_id)
+        else:
+            card_id, card_data = random.choice(list(storage.list_cards(deck_id).items()))
+        card_type = random.choice(list(card_data["reviews"]))
+        question, answer = card_question_answer(storage, card_type, card_data)
         return card_id, card_type, question, answer
 
-    def process_result(self, deck, card_id, card_type, result):
+    def process_result(self, storage, deck_id, card_id, card_type, result, now=None):
         pass
 
 
@@ -47,6 +65,9 @@ class HardestFirst(Algorithm):
     For each successful reviews adds 1 to the score.
     For each failed review, sets the score to the minimum of all scores minus 1.
     The algorithm picks a random card with a score below [minimum + 3].
+
+    Scores are looked up in the storage's review index, so picking a card
+    doesn't depend on the size of the deck.
     """
 
     def buttons(self):
@@ -55,58 +76,154 @@ class HardestFirst(Algorithm):
             "wrong": "var(--danger)",
         }
     
-    def next_card(self, deck, schemas, from_minimum=3):
+    def next_card(self, storage, deck_id, deck, card_ids=None, from_minimum=3):
         """
         from_minimum: how many values above the minimum are still considered
             when selecting the cards to pick from.
             Default: 3
         """
-        reviewable_cards = [
-            (card_id, card_type, review_data or 0) 
-            for card_id, card_data in deck["cards"].items()
-            for card_type, review_data in card_data["reviews"].items()
-        ]
-        reviewable_cards.sort(key=lambda x: x[2])
-
-        for c in reviewable_cards:
-            print(c)
-
-        threshold = reviewable_cards[0][2] + from_minimum
-        print(threshold)
-        
-        cards_to_pick_from = [
-            reviewable_card 
-            for reviewable_card in reviewable_cards
-            if reviewable_card[2] <= threshold
-        ]
-        print(cards_to_pick_from)
-
-        card_id, card_type, _ = random.choice(cards_to_pick_from)
-        card_schema = schemas[deck["cards"][card_id]["schema"]]["cards"][card_type]
-
-        question_template, answer_template = get_question_answer_from_schema(card_schema, deck["cards"][card_id])
-
-        question = Template(question_template).render(**deck["cards"][card_id])
-        answer = Template(answer_template).render(**deck["cards"][card_id])
+        if card_ids is not None:
+            picked = storage.review_index.pick_among(deck_id, card_ids, from_minimum)
+        else:
+            # No minimum when the deck has no card type
+            threshold = (storage.review_index.minimum(deck_id) or 0) + from_minimum
+            picked = storage.review_index.pick(deck_id, threshold)
+        if picked is None:
+            return None
+        card_id, card_type = picked
+        card_data = storage.get_card(deck_id, card_id)
+        question, answer = card_question_answer(storage, card_type, card_data)
         return card_id, card_type, question, answer
     
-    def process_result(self, deck, card_id, card_type, result):
-        card_data = deck["cards"][card_id]
+    def process_result(self, storage, deck_id, card_id, card_type, result, now=None):
         if result == "correct":
-            card_data["reviews"][card_type] = (card_data["reviews"].get(card_type, 0) or 0) + 1
+            card_data = storage.get_card(deck_id, card_id)
+            score = (card_data["reviews"].get(card_type, 0) or 0) + 1
         else:
-            reviews = []
-            for card_data in deck["cards"].values():
-                reviews += card_data.get("reviews", {}).values()
-            card_data["reviews"][card_type] = max(min(reviews or []) - 1, 0)
+            # Not the review index: it doesn't see the reviews saved earlier in the same batch
+            score = max((storage.lowest_score(deck_id) or 0) - 1, 0)
+        storage.record_review(deck_id, card_id, card_type, score)
+
+
+class Ebisu(Algorithm):
+    """
+    Models the recall probability of each card type with Ebisu
+    (https://fasiha.github.io/ebisu/) and picks the card type most likely
+    to be forgotten. New card types are introduced once all the reviewed ones
+    are recalled with a probability above `recall_threshold`.
 
-        reviews = []
-        for card_data in deck["cards"].values():
-            reviews += card_data.get("reviews", {}).values()
+    The models of the whole deck are kept in the storage's model index as NumPy
+    arrays, so the recall of every card type is predicted in a single pass.
+    """
+
+    #: Settings of the deck, with their default
+    DEFAULTS = {
+        "initial_alpha": 3.0,
+        "initial_beta": 3.0,
+        "initial_t": 3.0,
+        "half_life_unit": 30.0,
+    }
+
+    def settings(self, form):
+        settings = {}
+        for name, default in self.DEFAULTS.items():
+            try:
+                settings[name] = float(form.get(name) or default)
+            except (TypeError, ValueError):
+                settings[name] = math.nan
+            if not 0 < settings[name] < math.inf:
+                raise HTTPException(
+                    status_code=400, detail=f"{name} must be a positive number"
+                )
+        return settings
+
+    def _unit(self, deck):
+        """Length of the deck's half life unit, in seconds"""
+        return 60 * float(deck.get("half_life_unit") or 30)
+
+    def _elapsed(self, deck, now, last_review):
+        """Time since the last review, in half life units"""
+        return (now - last_review) / self._unit(deck)
+
+    def next_card(self, storage, deck_id, deck, card_ids=None, recall_threshold=0.5):
+        """
+        recall_threshold: below this recall probability, reviewed cards are
+            picked before the new ones.
+            Default: 0.5
+        """
+        with storage.model_index.deck(deck_id) as arrays:
+            models, estimates, keys = arrays.models, arrays.estimates, arrays.keys
+            if card_ids is not None:
+                columns = arrays.positions(card_ids)
+                models, estimates = models[:, columns], estimates[:, columns]
+                keys = [keys[column] for column in columns]
+            if not keys:
+                return None
+            # New card types have NaN models and so NaN recall: no need to filter them out
+            new = np.flatnonzero(np.isnan(estimates[0]))
+            key = None
+            if len(new) < len(keys):
+                position, log_recall = weakest(
+                    models, estimates, time.time(), arrays.epoch, self._unit(deck)
+                )
+                if not len(new) or log_recall < np.log(recall_threshold):
+                    key = keys[position]
+            if key is None:
+                key = keys[random.choice(new)]
+        card_id, card_type = key
+
+        card_data = storage.get_card(deck_id, card_id)
+        question, answer = card_question_answer(storage, card_type, card_data)
+        return card_id, card_type, question, answer
 
+    def process_result(self, storage, deck_id, card_id, card_type, result, now=None):
+        now = time.time() if now is None else now
+        deck = storage.get_deck(deck_id)
+        model = storage.get_model(deck_id, card_id, card_type)
+        if model is None:
+            # First review: the card type starts from the deck's initial model
+            settings = self.settings(deck)
+            model = (settings["initial_alpha"], settings["initial_beta"], settings["initial_t"])
+        else:
+            alpha, beta, t, last_review = model
+            model = update_recall(
+                (alpha, beta, t), result == "correct", self._elapsed(deck, now, last_review)
+            )
+        storage.save_model(deck_id, card_id, card_type, (*model, now))
 
 
 ALGORITHMS: Dict[str, Algorithm] = {
     "Random": Random(),
     "HardestFirst": HardestFirst(),
-}
\ No newline at end of file
+    "Ebisu": Ebisu(),
+}
+
+
+def replay_reviews(storage, deck_id):
+    """
+    Rebuilds the scores and recall models of the deck's card types by replaying its review
+    log with the deck's algorithm, for example after the algorithm changed.
+
+    The reviews are replayed on a copy of the deck in memory, where each one sees the
+    previous ones right away, and the results are saved in a single transaction.
+    """
+    deck = storage.get_deck(deck_id)
+    algorithm = ALGORITHMS[deck["algorithm"]]
+    cards = {
+        card_id: {**card, "reviews": dict.fromkeys(card["reviews"])}
+        for card_id, card in storage.list_cards(deck_id).items()
+    }
+    replay = MemoryStorage()
+    replay.open()
+    replay.import_deck(deck_id, {**deck, "cards": cards})
+    for card_id, card_type, result, timestamp, _ in storage.list_review_log(deck_id):
+        # The card's schema may have changed since
+        if card_type in cards.get(card_id, {}).get("reviews", {}):
+            algorithm.process_result(replay, deck_id, card_id, card_type, result, now=timestamp)
+
+    with storage.transaction():
+        storage.clear_reviews(deck_id)
+        for card_id, card_type, score in replay.list_reviews(deck_id):
+            storage.record_review(deck_id, card_id, card_type, score)
+        for (card_id, card_type), model in replay.list_models(deck_id).items():
+            storage.save_model(deck_id, card_id, card_type, model)
@@ -0,0 +1,179 @@
+"""
+Bulk card endpoints, to create, edit, delete and retag many cards of a deck at once.
+Each request is applied in a single storage transaction, in the threadpool: the body is
+read beforehand by the `_rows()` and `_json_body()` dependencies, on the event loop.
+Rows that can't be applied are skipped and reported, with their position in the request,
+in the response's `errors`.
+"""
+from typing import Any, Container, Dict, Iterator, List, Tuple
+import csv
+import io
+
+import starlette.status as status
+from fastapi import APIRouter, Request, Depends, HTTPException
+
+from flashcards_htmx.app import get_storage
+from flashcards_htmx.api.imports import prepare_card
+from flashcards_htmx.api.utils import split_tags
+from flashcards_htmx.storage.indexes import tags_of
+
+
+router = APIRouter()
+
+
+async def _json_body(request: Request) -> Any:
+    try:
+        return await request.json()
+    except ValueError as error:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid JSON: {error}"
+        )
+
+
+async def _rows(request: Request) -> List[Any]:
+    """The cards sent as a JSON list of objects, or as CSV with a header row"""
+    if request.headers.get("content-type", "").startswith("text/csv"):
+        text = (await request.body()).decode("utf-8-sig")
+        rows = []
+        for row in csv.DictReader(io.StringIO(text)):
+            # Empty cells are missing fields, so that edits keep the current value
+            row = {key: value for key, value in row.items() if key and value not in (None, "")}
+            if "tags" in row:
+                row["tags"] = split_tags(row["tags"])
+            rows.append(row)
+        return rows
+    rows = await _json_body(request)
+    if not isinstance(rows, list):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a list of cards"
+        )
+    return rows
+
+
+def _new_card_ids(storage, deck_id: str, taken: Container[str]) -> Iterator[str]:
+    """
+    IDs for new cards, numbered after the deck's cards like the card creation page does,
+    skipping the ones in `taken` and the existing ones.
+    """
+    number = storage.count_cards(deck_id)
+    while True:
+        number += 1
+        card_id = str(number)
+        if card_id not in taken and not storage.get_card(deck_id, card_id):
+            yield card_id
+
+
+def _selected_card_ids(storage, deck_id: str, selection: Any) -> List[str]:
+    """The IDs listed in `selection["ids"]`, or the cards matching its `tags` and `schema_id`"""
+    if not isinstance(selection, dict):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected an object")
+    if "ids" in selection:
+        if not isinstance(selection["ids"], list):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Expected a list of IDs"
+            )
+        return [str(card_id) for card_id in selection["ids"]]
+    tags = tags_of(selection)
+    schema_id = selection.get("schema_id")
+    if not tags and not schema_id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Select the cards with 'ids', or filter them with 'tags' and 'schema_id'",
+        )
+    return [card_id for _, card_id in storage.filter_cards(deck_id, tags, schema_id)]
+
+
+def _existing(storage, deck_id: str, card_ids: List[str]) -> Tuple[Dict[str, Any], List[Dict]]:
+    """The cards that exist among the given ones, and an error for each of the others"""
+    found = {}
+    errors = []
+    for row_number, card_id in enumerate(card_ids):
+        card = storage.get_card(deck_id, card_id)
+        if card is None:
+            errors.append({"row": row_number, "id": card_id, "error": "card not found"})
+        else:
+            found[card_id] = card
+    return found, errors
+
+
+def _check_deck(storage, deck_id: str):
+    if not storage.get_deck(deck_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Deck not found")
+
+
+@router.post("/decks/{deck_id}/bulk/cards")
+def bulk_save_cards_endpoint(deck_id: str, rows=Depends(_rows), storage=Depends(get_storage)):
+    """
+    Creates the cards without an `id`, and the ones whose `id` doesn't exist yet, and edits
+    the others: their fields are updated with the given ones. The `schema` can be given by ID
+    or by name.
+    """
+    _check_deck(storage, deck_id)
+    schemas = storage.list_schemas()
+    schema_ids = {schema["name"]: schema_id for schema_id, schema in schemas.items()}
+
+    cards: Dict[str, Dict[str, Any]] = {}
+    errors: List[Dict[str, Any]] = []
+    created = 0
+    new_ids = _new_card_ids(storage, deck_id, taken=cards.keys())
+    with storage.transaction():
+        for row_number, row in enumerate(rows):
+            if not isinstance(row, dict):
+                errors.append({"row": row_number, "error": "it's not an object"})
+                continue
+            card_id = str(row.pop("id", None) or next(new_ids))
+            if card_id in cards:
+                errors.append({"row": row_number, "id": card_id, "error": "duplicate ID"})
+                continue
+            if isinstance(row.get("schema"), str):
+                row["schema"] = schema_ids.get(row["schema"], row["schema"])
+            existing = storage.get_card(deck_id, card_id)
+            try:
+                cards[card_id] = prepare_card(schemas, {**(existing or {}), **row})
+            except ValueError as error:
+                errors.append({"row": row_number, "id": card_id, "error": str(error)})
+                continue
+            created += existing is None
+        storage.upsert_cards(deck_id, cards)
+
+    return {"created": created, "updated": len(cards) - created, "errors": errors}
+
+
+@router.post("/decks/{deck_id}/bulk/delete")
+def bulk_delete_cards_endpoint(
+    deck_id: str, selection=Depends(_json_body), storage=Depends(get_storage)
+):
+    """Deletes the cards listed in `ids`, or the ones having all the `tags` and the `schema_id`"""
+    _check_deck(storage, deck_id)
+    with storage.transaction():
+        card_ids = _selected_card_ids(storage, deck_id, selection)
+        found, errors = _existing(storage, deck_id, card_ids)
+        storage.delete_cards(deck_id, found)
+    return {"deleted": len(found), "errors": errors}
+
+
+@router.post("/decks/{deck_id}/bulk/retag")
+def bulk_retag_cards_endpoint(
+    deck_id: str, selection=Depends(_json_body), storage=Depends(get_storage)
+):
+    """
+    Adds the tags in `add` and removes the ones in `remove` from the cards selected like
+    for the bulk delete.
+    """
+    _check_deck(storage, deck_id)
+    with storage.transaction():
+        card_ids = _selected_card_ids(storage, deck_id, selection)
+        add = tags_of({"tags": selection.get("add")})
+        remove = set(tags_of({"tags": selection.get("remove")}))
+        schemas = storage.list_schemas()
+        found, errors = _existing(storage, deck_id, card_ids)
+        cards = {}
+        for card_id, card in found.items():
+            tags = [tag for tag in tags_of(card) if tag not in remove]
+            tags += [tag for tag in add if tag not in tags]
+            try:
+                cards[card_id] = prepare_card(schemas, {**card, "tags": tags})
+            except ValueError as error:
+                errors.append({"id": card_id, "error": str(error)})
+        storage.upsert_cards(deck_id, cards)
+    return {"retagged": len(cards), "errors": errors}
@@ -1,14 +1,16 @@
 from typing import Optional
 from pathlib import Path
-import shelve
 
-from jinja2 import Template
 import starlette.status as status
 from fastapi import APIRouter, Request, Depends, HTTPException
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 
-from flashcards_htmx.app import template, database
+from flashcards_htmx.app import template, cached, get_storage, get_readonly_storage, get_form
+from flashcards_htmx.constants import PAGE_SIZE
+from flashcards_htmx.api.utils import (
+    schema_templates, render_card, card_preview, check_cursor, split_tags
+)
 
 
 templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
@@ -16,52 +18,102 @@ router = APIRouter()
 
 
 
-@router.get("/decks/{deck_id}/cards", response_class=HTMLResponse)
-async def cards_page(
-    deck_id: str, request: Request, render=Depends(template("private/cards.html"))
+@router.get(
+    "/decks/{deck_id}/cards",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("deck/{deck_id}"))],
+)
+def cards_page(
+    deck_id: str,
+    request: Request,
+    render=Depends(template("private/cards.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
     return render(
         navbar_title=deck["name"],
         deck=deck,
         deck_id=deck_id,
         searchable=True,
         new_item_endpoint=request.url_for("create_card_page", deck_id=deck_id),
+        filters_endpoint=request.url_for("cards_search_component", deck_id=deck_id),
         new_item_text="New Card...",
     )
 
 
-@router.get("/htmx/components/decks/{deck_id}/cards", response_class=HTMLResponse)
-async def cards_component(
-    deck_id: str, render=Depends(template("responses/cards.html"))
+@router.get(
+    "/htmx/components/decks/{deck_id}/cards",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("deck/{deck_id}", "schemas", shared=True))],
+)
+def cards_component(
+    deck_id: str,
+    cursor: Optional[str] = None,
+    render=Depends(template("responses/cards.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
+
+    card_schemas = storage.list_schemas()
+    cards, next_cursor = storage.page_cards(deck_id, check_cursor(cursor), PAGE_SIZE)
+    cards = {
+        card_id: {
+            **card,
+            "schema_name": card_schemas[card["schema"]]["name"],
+            "preview": card_preview(storage, card),
+        }
+        for card_id, card in cards.items()
+    }
 
-        card_schemas = db["schemas"]
-        for card in deck["cards"].values():
-            card["schema_name"] = card_schemas[card["schema"]]["name"]
-            card["preview"] = Template(card_schemas[card["schema"]]["preview"]).render(**card)
+    return render(
+        deck=deck, deck_id=deck_id, cards=cards, cursor=cursor, next_cursor=next_cursor
+    )
 
-    return render(deck=deck, deck_id=deck_id)
+
+@router.get(
+    "/htmx/components/decks/{deck_id}/cards/search_filters",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("schemas"))],
+)
+def cards_search_component(
+    deck_id: str,
+    render=Depends(template("components/filter-modal.html")),
+    storage=Depends(get_readonly_storage),
+):
+    card_schemas = {
+        schema_id: schema["name"] for schema_id, schema in storage.list_schemas().items()
+    }
+    return render(
+        title="cards",
+        positive="Search",
+        negative="Cancel",
+        deck_id=deck_id,
+        card_schemas=card_schemas,
+    )
 
 
 @router.get("/decks/{deck_id}/cards/new", response_class=HTMLResponse)
-async def create_card_page(deck_id: str, render=Depends(template("private/card.html"))):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
-
-        id = len(db["decks"].get(deck_id, {}).get("cards", {})) + 1
-        card_schemas = db["schemas"]
-        for schema in card_schemas.values():
-            schema["rendered_form"] = Template(schema["form"]).render()
+def create_card_page(
+    deck_id: str,
+    render=Depends(template("private/card.html")),
+    storage=Depends(get_readonly_storage),
+):
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
+
+    id = storage.count_cards(deck_id) + 1
+    card_schemas = {
+        schema_id: {
+            **schema,
+            "rendered_form": schema_templates.render(schema_id, "form"),
+        }
+        for schema_id, schema in storage.list_schemas().items()
+    }
     return render(
         navbar_title=deck["name"],
         deck=deck,
@@ -76,22 +128,32 @@ async def create_card_page(deck_id: str, render=Depends(template("private/card.h
     )
 
 
-@router.get("/decks/{deck_id}/cards/{card_id}", response_class=HTMLResponse)
-async def edit_card_page(
-    deck_id: str, card_id: str, render=Depends(template("private/card.html"))
+@router.get(
+    "/decks/{deck_id}/cards/{card_id}",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("deck/{deck_id}", "schemas"))],
+)
+def edit_card_page(
+    deck_id: str,
+    card_id: str,
+    render=Depends(template("private/card.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
-
-        card_schemas = db["schemas"]
-        card = deck["cards"].get(card_id, {})
-        if not card:
-            raise HTTPException(status_code=404, detail="Card not found")
-
-        for schema in card_schemas.values():
-            schema["rendered_form"] = Template(schema["form"]).render(**card)
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
+
+    card = storage.get_card(deck_id, card_id)
+    if not card:
+        raise HTTPException(status_code=404, detail="Card not found")
+
+    card_schemas = {
+        schema_id: {
+            **schema,
+            "rendered_form": schema_templates.render(schema_id, "form", **card),
+        }
+        for schema_id, schema in storage.list_schemas().items()
+    }
 
     return render(
         navbar_title=deck["name"],
@@ -104,21 +166,29 @@ async def edit_card_page(
 
 
 @router.post("/decks/{deck_id}/cards/{card_id}", response_class=RedirectResponse)
-async def save_card_endpoint(deck_id: str, card_id: Optional[str], request: Request):
-    async with request.form() as form:
-        with shelve.open(database) as db:
-            deck = db["decks"].get(deck_id, {})
-
-            deck["cards"][card_id] = {
-                **deck["cards"].get(card_id, {"reviews": {}}),
-                **form
-            }
-            if deck["cards"][card_id]["tags"]:
-                deck["cards"][card_id]["tags"] = [tag.strip() for tag in form["tags"].split(",") if tag.strip()]
-
-            # Create empty reviews
-            for card_type in db["schemas"][deck["cards"][card_id]["schema"]]["cards"]:
-                deck["cards"][card_id]["reviews"][card_type] = deck["cards"][card_id]["reviews"].get(card_type, None)
+def save_card_endpoint(
+    deck_id: str,
+    card_id: Optional[str],
+    request: Request,
+    form=Depends(get_form),
+    storage=Depends(get_storage),
+):
+    if not storage.get_deck(deck_id):
+        raise HTTPException(status_code=404, detail="Deck not found")
+
+    card = {
+        **(storage.get_card(deck_id, card_id) or {"reviews": {}}),
+        **form
+    }
+    if card["tags"]:
+        card["tags"] = split_tags(form["tags"])
+
+    # Create empty reviews
+    schema = storage.get_schema(card["schema"])
+    for card_type in schema["cards"]:
+        card["reviews"][card_type] = card["reviews"].get(card_type, None)
+
+    storage.upsert_card(deck_id, card_id, render_card(card["schema"], schema, card))
 
     return RedirectResponse(
         request.url_for("cards_page", deck_id=deck_id),
@@ -130,22 +200,21 @@ async def save_card_endpoint(deck_id: str, card_id: Optional[str], request: Requ
     "/htmx/components/decks/{deck_id}/cards/{card_id}/confirm-delete",
     response_class=HTMLResponse,
 )
-async def card_confirm_delete_component(
+def card_confirm_delete_component(
     deck_id: str,
     card_id: str,
     render=Depends(template("components/message-modal.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
-        card = deck["cards"].get(card_id, {})
-        if not card:
-            raise HTTPException(status_code=404, detail="Card not found")
-        card_schemas = db["schemas"]
+    if not storage.get_deck(deck_id):
+        raise HTTPException(status_code=404, detail="Deck not found")
+    card = storage.get_card(deck_id, card_id)
+    if not card:
+        raise HTTPException(status_code=404, detail="Card not found")
+    preview = card_preview(storage, card)
     return render(
         title=f"Deleting card",
-        content=f"<p>Are you really sure you wanna delete this card?</p><br>" + Template(card_schemas[card["schema"]]["preview"]).render(**card),
+        content=f"<p>Are you really sure you wanna delete this card?</p><br>" + preview,
         positive=f"Yes, delete it",
         negative=f"No, don't delete",
         delete_endpoint="delete_card_endpoint",
@@ -154,17 +223,17 @@ async def card_confirm_delete_component(
 
 
 @router.get("/decks/{deck_id}/cards/{card_id}/delete", response_class=RedirectResponse)
-async def delete_card_endpoint(
+def delete_card_endpoint(
     request: Request,
     deck_id: str,
     card_id: str,
+    storage=Depends(get_storage),
 ):
-    with shelve.open(database) as db:
-        if deck_id not in db["decks"]:
-            raise HTTPException(status_code=404, detail="Deck not found")
-        if card_id not in db["decks"][deck_id]["cards"]:
-            raise HTTPException(status_code=404, detail="Card not found")
-        del db["decks"][deck_id]["cards"][card_id]
+    if not storage.get_deck(deck_id):
+        raise HTTPException(status_code=404, detail="Deck not found")
+    if not storage.get_card(deck_id, card_id):
+        raise HTTPException(status_code=404, detail="Card not found")
+    storage.delete_card(deck_id, card_id)
 
     return RedirectResponse(
         request.url_for("cards_page", deck_id=deck_id),
@@ -1,51 +1,70 @@
 from typing import Optional
 
 from pathlib import Path
-import shelve
-import json
-from copy import deepcopy
 from hashlib import md5
+from uuid import uuid4
 
 import starlette.status as status
-from fastapi import APIRouter, Request, Depends, HTTPException, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+from fastapi import APIRouter, Request, Depends, HTTPException, UploadFile, File, Form
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-
-from flashcards_htmx.app import template, database
-from flashcards_htmx.api.algorithms import ALGORITHMS
+from starlette.concurrency import run_in_threadpool
+
+from flashcards_htmx.app import template, cached, get_storage, get_readonly_storage, get_form
+from flashcards_htmx.constants import PAGE_SIZE
+from flashcards_htmx.api.algorithms import ALGORITHMS, replay_reviews
+from flashcards_htmx.api.utils import check_cursor, split_tags
+from flashcards_htmx.api.exports import (
+    deck_json, encoded, gzipped, decks_zip, export_filename, attachment
+)
+from flashcards_htmx.api.imports import (
+    DeckExists, InvalidImport, import_deck_file, import_progresses
+)
 
 
 templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
 router = APIRouter()
 
 
-@router.get("/home", response_class=HTMLResponse)
+@router.get("/home", response_class=HTMLResponse, dependencies=[Depends(cached())])
 async def home_page(request: Request, render=Depends(template("private/home.html"))):
     return render(
         navbar_title="Home",
         searchable=True,
         new_item_endpoint=request.url_for("create_deck_page"),
         upload_item_endpoint=request.url_for("import_deck_page"),
+        download_items_endpoint=request.url_for("export_decks_endpoint"),
+        filters_endpoint=request.url_for("decks_search_component"),
         new_item_text="New Deck...",
     )
 
 
-@router.get("/htmx/components/decks", response_class=HTMLResponse)
-async def decks_component(render=Depends(template("responses/decks.html"))):
-    with shelve.open(database) as db:
-        return render(decks=db["decks"])
+@router.get(
+    "/htmx/components/decks",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("decks", shared=True))],
+)
+def decks_component(
+    cursor: Optional[str] = None,
+    render=Depends(template("responses/decks.html")),
+    storage=Depends(get_readonly_storage),
+):
+    decks, next_cursor = storage.page_decks(check_cursor(cursor), PAGE_SIZE)
+    return render(decks=decks, cursor=cursor, next_cursor=next_cursor)
 
 
-@router.get("/htmx/components/decks/search_filters", response_class=HTMLResponse)
+@router.get(
+    "/htmx/components/decks/search_filters",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached())],
+)
 async def decks_search_component(
     render=Depends(template("components/filter-modal.html")),
 ):
-    return render(
-        title=f"decks", content=f"Content here", positive=f"Search", negative=f"Cancel"
-    )
+    return render(title="decks", positive="Search", negative="Cancel")
 
 
-@router.get("/decks/new", response_class=HTMLResponse)
+@router.get("/decks/new", response_class=HTMLResponse, dependencies=[Depends(cached())])
 async def create_deck_page(render=Depends(template("private/deck.html"))):
     return render(
         navbar_title="New Deck",
@@ -57,80 +76,122 @@ async def create_deck_page(render=Depends(template("private/deck.html"))):
 
 @router.get("/decks/import", response_class=HTMLResponse)
 async def import_deck_page(render=Depends(template("private/import.html"))):
-    return render(navbar_title="Import Deck")
+    return render(navbar_title="Import Deck", import_id=uuid4().hex)
 
 
 @router.post("/decks/import", response_class=RedirectResponse)
-async def import_deck_endpoint(file: UploadFile):
+async def import_deck_endpoint(
+    file: UploadFile,
+    import_id: str = Form(""),
+    render=Depends(template("private/import.html")),
+    storage=Depends(get_storage),
+):
+    import_id = import_id or uuid4().hex
+    progress = import_progresses.start(import_id)
     try:
-        contents = await file.read()
-        deck = json.loads(contents)
-        with shelve.open(database) as db:
-            deck_id = md5(deck["name"].encode()).hexdigest()
-            if deck_id in db["decks"]:
-                raise HTTPException(status_code=409, detail="Deck with this name already exists")
-            db["decks"][deck_id] = deck
-                
+        # Parsed and saved in batches by a worker thread, so other requests are still
+        # served meanwhile; the upload itself is spooled to disk by the form parser
+        await run_in_threadpool(import_deck_file, storage, file.file, progress)
+    except DeckExists as error:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(error))
+    except InvalidImport as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="There was an error importing the deck",
         )
     finally:
+        import_progresses.finish(import_id)
         await file.close()
+
+    if progress.skipped:
+        return HTMLResponse(
+            render(navbar_title="Import Deck", import_id=uuid4().hex, report=progress)
+        )
     return RedirectResponse(
         router.url_path_for("home_page"), status_code=status.HTTP_302_FOUND
     )
 
 
-@router.get("/decks/{deck_id}/export", response_class=FileResponse)
-async def export_deck_endpoint(request: Request):
-    with shelve.open(database) as db:
-        deck = deepcopy(db["decks"].get(request.path_params["deck_id"], {}))
-        if not deck:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
-
-        deck["cards"] = {
-            card_id: {
-                key: val for key, val in card.items() 
-                #if not key not in ["preview", "schema_name", "rendered_question", "rendered_answer"]
-            }
-            for card_id, card in deck["cards"].items()
-        }
-        path = Path(__file__).parent.parent / f"tmp/{deck['name']}.json"
-
-        with open(path, "w") as file:
-            json.dump(deck, file, indent=4)
-    return FileResponse(
-        path, media_type="application/octet-stream", filename=f"{deck['name']}.json"
+@router.get("/htmx/components/imports/{import_id}", response_class=HTMLResponse)
+async def import_progress_component(
+    import_id: str, render=Depends(template("responses/import-progress.html"))
+):
+    return render(progress=import_progresses.get(import_id))
+
+
+@router.get("/decks/export", response_class=StreamingResponse)
+def export_decks_endpoint(storage=Depends(get_readonly_storage)):
+    return StreamingResponse(
+        decks_zip(storage), media_type="application/zip", headers=attachment("decks.zip")
     )
 
 
-@router.get("/decks/{deck_id}", response_class=HTMLResponse)
-async def edit_deck_page(deck_id: str, render=Depends(template("private/deck.html"))):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
+@router.get("/decks/{deck_id}/export", response_class=StreamingResponse)
+def export_deck_endpoint(
+    deck_id: str, gzip: bool = False, storage=Depends(get_readonly_storage)
+):
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    # Streamed card by card straight from the storage: nothing is written to disk
+    content = encoded(deck_json(storage, deck_id, deck))
+    filename = export_filename(deck)
+    if gzip:
+        return StreamingResponse(
+            gzipped(content), media_type="application/gzip", headers=attachment(filename + ".gz")
+        )
+    return StreamingResponse(
+        content, media_type="application/octet-stream", headers=attachment(filename)
+    )
+
+
+@router.get(
+    "/decks/{deck_id}",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("deck/{deck_id}"))],
+)
+def edit_deck_page(
+    deck_id: str,
+    render=Depends(template("private/deck.html")),
+    storage=Depends(get_readonly_storage),
+):
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
     return render(navbar_title=deck["name"], deck=deck, deck_id=deck_id, algorithms=ALGORITHMS.keys())
 
 
 @router.post("/decks/{deck_id}", response_class=RedirectResponse)
-async def save_deck_endpoint(request: Request, deck_id: Optional[str] = None):
-    async with request.form() as form:
-        with shelve.open(database) as db:
-            if not deck_id:
-                deck_id = md5(form["name"].encode()).hexdigest()
-                if deck_id in db["decks"]:
-                    raise HTTPException(status_code=409, detail="Deck with this name already exists")
-
-            db["decks"][deck_id] = {
-                **db["decks"].get(deck_id, {"cards": {}}),
-                "name": form["name"],
-                "description": form["description"],
-                "tags": [tag.strip() for tag in form["tags"].split(",") if tag.strip()],
-                "algorithm": form["algorithm"]
-            }
+def save_deck_endpoint(
+    request: Request,
+    deck_id: Optional[str] = None,
+    form=Depends(get_form),
+    storage=Depends(get_storage),
+):
+    if not deck_id:
+        deck_id = md5(form["name"].encode()).hexdigest()
+        if storage.get_deck(deck_id):
+            raise HTTPException(status_code=409, detail="Deck with this name already exists")
+
+    previous = storage.get_deck(deck_id) or {}
+    storage.save_deck(deck_id, {
+        **previous,
+        "name": form["name"],
+        "description": form["description"],
+        "tags": split_tags(form["tags"]),
+        "algorithm": form["algorithm"],
+        **(
+            ALGORITHMS[form["algorithm"]].settings(form)
+            if form["algorithm"] in ALGORITHMS else {}
+        ),
+    })
+    algorithm_changed = previous and previous.get("algorithm") != form["algorithm"]
+    if algorithm_changed and form["algorithm"] in ALGORITHMS:
+        # The new algorithm's scores and models are computed from the reviews done so far
+        replay_reviews(storage, deck_id)
     return RedirectResponse(
         request.url_for("home_page"), status_code=status.HTTP_302_FOUND
     )
@@ -139,17 +200,21 @@ async def save_deck_endpoint(request: Request, deck_id: Optional[str] = None):
 @router.get(
     "/htmx/components/decks/{deck_id}/confirm-delete", response_class=HTMLResponse
 )
-async def deck_confirm_delete_component(
-    deck_id: str, render=Depends(template("components/message-modal.html"))
+def deck_confirm_delete_component(
+    deck_id: str,
+    render=Depends(template("components/message-modal.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
 
     return render(
         title=f"Deleting deck",
-        content=f"Are you really sure you wanna delete the deck '{deck['name']}'? It contains {len(deck['cards'])} cards.",
+        content=(
+            f"Are you really sure you wanna delete the deck '{deck['name']}'? "
+            f"It contains {storage.count_cards(deck_id)} cards."
+        ),
         positive=f"Yes, delete {deck['name']}",
         negative=f"No, don't delete",
         delete_endpoint="delete_deck_endpoint",
@@ -158,11 +223,12 @@ async def deck_confirm_delete_component(
 
 
 @router.get("/decks/{deck_id}/delete", response_class=RedirectResponse)
-async def delete_deck_endpoint(request: Request, deck_id: str):
-    with shelve.open(database) as db:
-        if deck_id not in db["decks"]:
-            raise HTTPException(status_code=404, detail="Deck not found")
-        del db["decks"][deck_id]
+def delete_deck_endpoint(
+    request: Request, deck_id: str, storage=Depends(get_storage)
+):
+    if not storage.get_deck(deck_id):
+        raise HTTPException(status_code=404, detail="Deck not found")
+    storage.delete_deck(deck_id)
 
     return RedirectResponse(
         request.url_for("home_page"), status_code=status.HTTP_302_FOUND
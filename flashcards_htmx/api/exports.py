@@ -0,0 +1,123 @@
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+import json
+import zlib
+from urllib.parse import quote
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from flashcards_htmx.api.utils import RENDERED_KEYS
+
+
+#: How many cards are read from the storage at once while exporting
+EXPORT_PAGE_SIZE = 500
+
+#: Size of the chunks sent to the client: smaller writes are joined up to this size
+CHUNK_SIZE = 64 * 1024
+
+
+def _indented(value: Any, depth: int) -> str:
+    """`value` dumped like `json.dump(..., indent=4)` would, when nested `depth` levels deep"""
+    return json.dumps(value, indent=4).replace("\n", "\n" + "    " * depth)
+
+
+def deck_json(storage, deck_id: str, deck: Dict[str, Any]) -> Iterator[str]:
+    """
+    Yields the deck as JSON, in the format read by `import_deck`, one card at a time.
+    Cards are read a page at a time, so memory use doesn't depend on the deck's size.
+    """
+    yield "{"
+    for key, value in deck.items():
+        yield f"\n    {json.dumps(key)}: {_indented(value, 1)},"
+    yield '\n    "cards": {'
+    separator = ""
+    cursor = None
+    while True:
+        cards, cursor = storage.page_cards(deck_id, cursor, EXPORT_PAGE_SIZE)
+        for card_id, card in cards.items():
+            card = {key: value for key, value in card.items() if key not in RENDERED_KEYS}
+            yield f"{separator}\n        {json.dumps(card_id)}: {_indented(card, 2)}"
+            separator = ","
+        if not cursor:
+            break
+    yield "\n    }\n}" if separator else "}\n}"
+
+
+def encoded(chunks: Iterable[str]) -> Iterator[bytes]:
+    """Encodes the strings as UTF-8, joining them into chunks of about `CHUNK_SIZE` bytes"""
+    buffer: List[bytes] = []
+    size = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        buffer.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Compresses the chunks as a single gzip file, as they come"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class _Pipe:
+    """
+    Write-only, unseekable file that keeps what's written until it's drained:
+    `ZipFile` writes into it and the response sends what it wrote so far.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def export_filename(deck: Dict[str, Any]) -> str:
+    return deck["name"].replace("/", "_") + ".json"
+
+
+def _all_decks(storage) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    cursor = None
+    while True:
+        decks, cursor = storage.page_decks(cursor, EXPORT_PAGE_SIZE)
+        yield from decks.items()
+        if not cursor:
+            break
+
+
+def decks_zip(storage) -> Iterator[bytes]:
+    """Yields a zip archive with one JSON file per deck, see `deck_json`"""
+    pipe = _Pipe()
+    with ZipFile(pipe, mode="w", compression=ZIP_DEFLATED) as archive:
+        for deck_id, deck in _all_decks(storage):
+            with archive.open(export_filename(deck), mode="w") as file:
+                for chunk in encoded(deck_json(storage, deck_id, deck)):
+                    file.write(chunk)
+                    data = pipe.drain()
+                    if data:
+                        yield data
+    yield pipe.drain()
+
+
+def attachment(filename: str) -> Dict[str, str]:
+    """Headers to download the response as a file, the same way `FileResponse` sets them"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return {"content-disposition": f"attachment; filename*=utf-8''{quoted}"}
+    return {"content-disposition": f'attachment; filename="{filename}"'}
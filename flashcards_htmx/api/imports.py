@@ -0,0 +1,294 @@
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import re
+import json
+import zlib
+import codecs
+from hashlib import md5
+from threading import Lock
+
+from flashcards_htmx.api.utils import RENDERED_KEYS, render_card
+
+
+#: How many cards are written to the storage in each transaction while importing
+IMPORT_BATCH_SIZE = 500
+
+#: How many bytes of the upload are read at once
+READ_SIZE = 64 * 1024
+
+#: Largest single JSON value (a card, or a deck field) accepted in an import
+MAX_VALUE_SIZE = 16 * 1024 * 1024
+
+#: How many skipped cards are reported with the reason they were skipped
+MAX_REPORTED_ERRORS = 20
+
+_NON_WHITESPACE = re.compile(r"\S")
+_NUMBER_CHARACTERS = frozenset("-+.eE0123456789")
+_decoder = json.JSONDecoder()
+
+
+class InvalidImport(ValueError):
+    """The uploaded file is not a deck that can be imported"""
+
+
+class DeckExists(InvalidImport):
+    """The uploaded deck has the name of an existing deck"""
+
+
+class ImportProgress:
+    """How far an import got, updated by the import and read by the progress component"""
+
+    def __init__(self):
+        self.deck_id: Optional[str] = None
+        self.cards = 0
+        self.skipped = 0
+        self.errors: List[Tuple[str, str]] = []
+        self.done = False
+
+    def skip(self, card_id: str, reason: str):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((card_id, reason))
+
+
+class ImportProgresses:
+    """The imports running in this process, by the ID the import form was rendered with"""
+
+    def __init__(self):
+        self._progresses: Dict[str, ImportProgress] = {}
+        self._lock = Lock()
+
+    def start(self, import_id: str) -> ImportProgress:
+        with self._lock:
+            progress = self._progresses[import_id] = ImportProgress()
+            return progress
+
+    def get(self, import_id: str) -> Optional[ImportProgress]:
+        with self._lock:
+            return self._progresses.get(import_id)
+
+    def finish(self, import_id: str):
+        with self._lock:
+            self._progresses.pop(import_id, None)
+
+
+import_progresses = ImportProgresses()
+
+
+def _read(file) -> Iterator[bytes]:
+    """The file's content, gunzipped if it's compressed (see the export's `?gzip=true`)"""
+    # At least the two bytes of gzip's magic number
+    data = file.read(max(READ_SIZE, 2))
+    if data[:2] != b"\x1f\x8b":
+        while data:
+            yield data
+            data = file.read(READ_SIZE)
+        return
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    while data:
+        # Bounded output for each read, so that a small upload can't expand all at once
+        while data:
+            yield decompressor.decompress(data, READ_SIZE)
+            data = decompressor.unconsumed_tail
+        data = file.read(READ_SIZE)
+    yield decompressor.flush()
+
+
+def _text(file) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    try:
+        for data in _read(file):
+            yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+    except (UnicodeDecodeError, zlib.error) as error:
+        raise InvalidImport(f"The file is not UTF-8 encoded JSON: {error}")
+
+
+class _Reader:
+    """
+    Incremental JSON reader: walks the members of objects one at a time, and decodes
+    each value with the standard JSON decoder once it's been read whole.
+    Only the part of the file that hasn't been decoded yet is kept in memory.
+    """
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._buffer = ""
+        self._position = 0
+        self._end = False
+
+    def _fill(self) -> bool:
+        if self._end:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._end = True
+            return False
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        if len(self._buffer) > MAX_VALUE_SIZE:
+            raise InvalidImport(f"Values larger than {MAX_VALUE_SIZE} bytes can't be imported")
+        return True
+
+    def peek(self) -> str:
+        """Skips the whitespace and returns the next character, or '' at the end of the file"""
+        while True:
+            match = _NON_WHITESPACE.search(self._buffer, self._position)
+            if match:
+                self._position = match.start()
+                return self._buffer[self._position]
+            self._position = len(self._buffer)
+            if not self._fill():
+                return ""
+
+    def expect(self, character: str):
+        found = self.peek()
+        if found != character:
+            raise InvalidImport(f"Expected '{character}' but found '{found or 'end of file'}'")
+        self._position += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._position)
+                # A number at the end of the buffer, or followed by what could be the rest
+                # of it (like "1" then ".5"), may continue in the next chunk
+                number = self._buffer[self._position] in _NUMBER_CHARACTERS
+                if self._end or (
+                    end < len(self._buffer)
+                    and not (number and self._buffer[end] in _NUMBER_CHARACTERS)
+                ):
+                    self._position = end
+                    return value
+            except json.JSONDecodeError as error:
+                if self._end:
+                    raise InvalidImport(f"Invalid JSON: {error}")
+            self._fill()
+
+    def members(self) -> Iterator[str]:
+        """
+        Yields the keys of the object starting here: each value must be consumed,
+        with `value()` or `members()`, before getting the next key.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self._position += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise InvalidImport(f"Expected a key but found {key!r}")
+            self.expect(":")
+            yield key
+            if self.peek() != ",":
+                self.expect("}")
+                return
+            self._position += 1
+
+
+def parse_deck(file) -> Iterator[Tuple[str, str, Any]]:
+    """
+    Reads a deck in the export's format from a binary file, yielding `("field", key, value)`
+    for each deck field and `("card", card_id, card)` for each card, in file order.
+    """
+    reader = _Reader(_text(file))
+    for key in reader.members():
+        if key == "cards":
+            for card_id in reader.members():
+                yield "card", card_id, reader.value()
+        else:
+            yield "field", key, reader.value()
+    if reader.peek():
+        raise InvalidImport("Unexpected content after the deck")
+
+
+def prepare_card(schemas: Dict[str, Dict[str, Any]], card: Any) -> Dict[str, Any]:
+    """
+    Validates an imported card against the stored schemas and returns it ready to be
+    saved, with a review for each of its schema's card types and its HTML rendered.
+    Raises `ValueError` if it can't be imported.
+    """
+    if not isinstance(card, dict):
+        raise ValueError("it's not an object")
+    schema = schemas.get(card.get("schema")) if isinstance(card.get("schema"), str) else None
+    if schema is None:
+        raise ValueError(f"unknown schema {card.get('schema')!r}")
+    reviews = card.get("reviews") or {}
+    if not isinstance(reviews, dict):
+        raise ValueError("its reviews are not an object")
+    card = {
+        "tags": [],
+        **{key: value for key, value in card.items() if key not in RENDERED_KEYS},
+        "reviews": {card_type: reviews.get(card_type) for card_type in schema["cards"]},
+    }
+    try:
+        return render_card(card["schema"], schema, card)
+    except Exception as error:
+        raise ValueError(f"it can't be rendered: {error}")
+
+
+class _DeckImport:
+    """State of a deck import: the deck's fields read so far and the cards not saved yet"""
+
+    def __init__(self, storage, progress: ImportProgress):
+        self.storage = storage
+        self.progress = progress
+        self.schemas = storage.list_schemas()
+        self.deck: Dict[str, Any] = {}
+        self.batch: List[Tuple[str, Dict[str, Any]]] = []
+
+    def save_deck(self):
+        name = self.deck.get("name")
+        if not isinstance(name, str) or not name:
+            raise InvalidImport("The deck's name is missing, or comes after its cards")
+        deck_id = md5(name.encode()).hexdigest()
+        if self.storage.get_deck(deck_id):
+            raise DeckExists("Deck with this name already exists")
+        self.storage.save_deck(deck_id, self.deck)
+        self.progress.deck_id = deck_id
+
+    def add_card(self, card_id: str, card: Any):
+        if self.progress.deck_id is None:
+            self.save_deck()
+        try:
+            self.batch.append((card_id, prepare_card(self.schemas, card)))
+        except ValueError as error:
+            self.progress.skip(card_id, str(error))
+        if len(self.batch) >= IMPORT_BATCH_SIZE:
+            self.save_batch()
+
+    def save_batch(self):
+        with self.storage.transaction():
+            for card_id, card in self.batch:
+                self.storage.upsert_card(self.progress.deck_id, card_id, card)
+        self.progress.cards += len(self.batch)
+        self.batch.clear()
+
+    def run(self, file):
+        for kind, key, value in parse_deck(file):
+            if kind == "field":
+                self.deck[key] = value
+            else:
+                self.add_card(key, value)
+        if self.progress.deck_id is None:
+            self.save_deck()
+        self.save_batch()
+        # Fields after the cards, if any, are saved now
+        self.storage.save_deck(self.progress.deck_id, self.deck)
+
+
+def import_deck_file(storage, file, progress: ImportProgress) -> str:
+    """
+    Imports the deck in the file card by card, writing `IMPORT_BATCH_SIZE` cards per
+    transaction, and returns its ID. Invalid cards are skipped and reported in `progress`.
+    If the file itself is invalid, whatever was imported is deleted again.
+    """
+    try:
+        _DeckImport(storage, progress).run(file)
+    except Exception:
+        if progress.deck_id is not None:
+            storage.delete_deck(progress.deck_id)
+        raise
+    finally:
+        progress.done = True
+    return progress.deck_id
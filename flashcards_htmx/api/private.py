@@ -4,14 +4,14 @@ from fastapi import APIRouter, Request, Depends
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 
-from flashcards_htmx.app import template
+from flashcards_htmx.app import template, cached
 
 
 templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
 router = APIRouter()
 
 
-@router.get("/settings", response_class=HTMLResponse)
+@router.get("/settings", response_class=HTMLResponse, dependencies=[Depends(cached())])
 async def profile_page(render=Depends(template("private/profile.html"))):
     return render(navbar_title="Settings")
 
@@ -0,0 +1,84 @@
+"""
+Group commit of the reviews: the reviews posted while a transaction is being committed
+wait for it, and are then all saved by the next transaction. A review posted alone is
+committed right away, while a burst of reviews costs one commit (and one fsync) per batch
+instead of one each.
+"""
+from typing import Callable, List, Optional
+from threading import Condition
+
+
+#: Most reviews saved by a single transaction
+REVIEW_BATCH_SIZE = 100
+
+
+class _PendingReview:
+
+    def __init__(self, save: Callable[[], None]):
+        self.save = save
+        self.done = False
+        self.error: Optional[Exception] = None
+
+
+class GroupCommit:
+    """
+    Batches the reviews saved concurrently into shared transactions. There's no writer
+    thread: whichever request finds no transaction running commits the pending reviews,
+    its own included, while the others wait for their review to be committed.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._pending: List[_PendingReview] = []
+        self._committing = False
+        #: How many transactions and reviews were committed, to measure the batching
+        self.transactions = 0
+        self.reviews = 0
+
+    def save(self, storage, save: Callable[[], None]):
+        """
+        Calls `save()`, that writes a review to the storage, in a transaction shared with
+        the other pending reviews. Returns once it's committed, or raises its error.
+        """
+        pending = _PendingReview(save)
+        with self._condition:
+            self._pending.append(pending)
+            while not pending.done:
+                if self._committing:
+                    self._condition.wait()
+                    continue
+                self._committing = True
+                batch = self._pending[:REVIEW_BATCH_SIZE]
+                del self._pending[:REVIEW_BATCH_SIZE]
+                self._condition.release()
+                try:
+                    self._commit(storage, batch)
+                finally:
+                    self._condition.acquire()
+                    self._committing = False
+                    self._condition.notify_all()
+        if pending.error is not None:
+            raise pending.error
+
+    def _commit(self, storage, batch: List[_PendingReview]):
+        try:
+            with storage.transaction():
+                for pending in batch:
+                    # A review that can't be saved fails alone, its writes undone: the
+                    # others are still saved
+                    try:
+                        with storage.savepoint():
+                            pending.save()
+                    except Exception as error:
+                        pending.error = error
+        except Exception as error:
+            for pending in batch:
+                pending.error = pending.error or error
+        finally:
+            for pending in batch:
+                pending.done = True
+        self.transactions += 1
+        self.reviews += len(batch)
+
+
+review_commits = GroupCommit()
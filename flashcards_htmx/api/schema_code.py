@@ -0,0 +1,310 @@
+"""
+Schemas written as code: the schema itself, a Python literal typed in the schema page,
+and the card types generated by a snippet of Python code, like the ones of the verbs in
+`flashcards_htmx/others`.
+
+Snippets are compiled once and cached by source. They run in a sandbox: their names are
+the card's fields, a few harmless builtins and `random`, they can't import anything nor
+define generators, and they can only reach the public attributes of the builtin types: no
+frame or code attributes, which lead to the modules and their builtins. They're stopped if
+they run longer than `CODE_TIME_BUDGET`. All of this is checked when the schema is saved,
+not when studying.
+
+The sandbox runs in worker processes, as a single call (like `sum(range(10**8))` or
+`'a' * 10**10`) can't be stopped between opcodes: their memory is limited, and they're
+killed if they don't answer within `CODE_KILL_TIMEOUT`.
+"""
+from typing import Any, Dict, List, Tuple
+import ast
+import sys
+import json
+import random
+import builtins
+import multiprocessing
+from time import perf_counter
+from types import CodeType, SimpleNamespace
+from functools import lru_cache
+
+try:
+    import resource
+except ImportError:  # Not on Windows: there, the workers' memory isn't limited
+    resource = None
+
+from jinja2 import Environment, TemplateSyntaxError
+
+
+#: Longest a card type's code can run for, in seconds
+CODE_TIME_BUDGET = 0.05
+
+#: Longest a worker can take to run a card type's code before it's killed, in seconds
+CODE_KILL_TIMEOUT = 0.25
+
+#: Most memory a card type's code can allocate, in bytes
+CODE_MEMORY_BUDGET = 256 * 1024 * 1024
+
+#: Largest question or answer template a card type's code can generate, in characters
+MAX_TEMPLATE_SIZE = 64 * 1024
+
+#: Largest schema accepted, in characters
+MAX_SCHEMA_SIZE = 256 * 1024
+
+#: The builtins available to the code
+SAFE_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in (
+        "abs", "all", "any", "bool", "dict", "enumerate", "float", "int", "len", "list",
+        "max", "min", "range", "reversed", "round", "set", "sorted", "str", "sum", "tuple",
+        "zip",
+    )
+}
+
+#: The `random` functions available to the code
+SAFE_RANDOM = SimpleNamespace(
+    choice=random.choice,
+    choices=random.choices,
+    randint=random.randint,
+    random=random.random,
+    sample=random.sample,
+    shuffle=random.shuffle,
+)
+
+#: The attributes the code can reach: methods of the builtin types and of `random`.
+#: Format strings are left out, as they can reach any attribute: '{0.__class__}'.format(x)
+SAFE_ATTRIBUTES = {
+    name
+    for type_ in (str, bytes, int, float, bool, list, tuple, dict, set, frozenset)
+    for name in dir(type_)
+    if not name.startswith("_")
+} - {"format", "format_map"} | set(vars(SAFE_RANDOM))
+
+_jinja2 = Environment()
+
+
+class InvalidSchema(ValueError):
+    """The schema can't be saved: the message says why"""
+
+
+class SchemaCodeError(RuntimeError):
+    """A card type's code failed, or went over its budget, while rendering a card"""
+
+
+class _Checker(ast.NodeVisitor):
+    """Rejects the code that could get out of the sandbox"""
+
+    def visit_Import(self, node):
+        raise InvalidSchema(f"line {node.lineno}: imports are not allowed")
+
+    visit_ImportFrom = visit_Import
+
+    def visit_Try(self, node):
+        # The code is stopped by raising an exception in it: it must not be able to catch it
+        raise InvalidSchema(f"line {node.lineno}: try blocks are not allowed")
+
+    visit_TryStar = visit_Try
+
+    def visit_Yield(self, node):
+        # Generators and coroutines carry their frame, from which the modules can be reached
+        raise InvalidSchema(f"line {node.lineno}: generators are not allowed")
+
+    visit_YieldFrom = visit_Await = visit_AsyncFunctionDef = visit_Yield
+
+    def visit_Attribute(self, node):
+        if node.attr not in SAFE_ATTRIBUTES:
+            raise InvalidSchema(f"line {node.lineno}: '{node.attr}' can't be accessed")
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        key = node.slice
+        if isinstance(key, ast.Constant) and isinstance(key.value, str) and key.value[:1] == "_":
+            raise InvalidSchema(f"line {node.lineno}: '{key.value}' can't be accessed")
+        self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id.startswith("__"):
+            raise InvalidSchema(f"line {node.lineno}: '{node.id}' can't be accessed")
+
+
+@lru_cache(maxsize=1024)
+def compile_card_code(source: str) -> CodeType:
+    """Checks and compiles a card type's code. Raises `InvalidSchema` if it's not valid."""
+    try:
+        tree = ast.parse(source, filename="<card type>", mode="exec")
+    except SyntaxError as error:
+        raise InvalidSchema(f"line {error.lineno}: {error.msg}")
+    _Checker().visit(tree)
+    return compile(tree, filename="<card type>", mode="exec")
+
+
+def _timeout(deadline: float):
+    def trace(frame, event, arg):
+        # Checked at every opcode: a loop on a single line has no line events
+        frame.f_trace_opcodes = True
+        if perf_counter() > deadline:
+            raise SchemaCodeError(f"The card type's code ran for more than {CODE_TIME_BUDGET}s")
+        return trace
+    return trace
+
+
+def _run_card_code(source: str, card: Dict[str, Any]) -> Tuple[str, str]:
+    """`run_card_code()`, in a worker process"""
+    namespace = {**card, "__builtins__": SAFE_BUILTINS, "random": SAFE_RANDOM}
+    previous_trace = sys.gettrace()
+    sys.settrace(_timeout(perf_counter() + CODE_TIME_BUDGET))
+    try:
+        exec(compile_card_code(source), namespace)
+    except SchemaCodeError:
+        raise
+    except Exception as error:
+        raise SchemaCodeError(f"The card type's code failed: {error!r}")
+    finally:
+        sys.settrace(previous_trace)
+
+    generated = namespace.get("card")
+    if not isinstance(generated, dict):
+        raise SchemaCodeError("The card type's code must define a `card` dict")
+    templates = generated.get("question"), generated.get("answer")
+    for template in templates:
+        if not isinstance(template, str):
+            raise SchemaCodeError("The card type's code must generate a question and an answer")
+        if len(template) > MAX_TEMPLATE_SIZE:
+            raise SchemaCodeError(f"Templates can't be longer than {MAX_TEMPLATE_SIZE} characters")
+    return templates
+
+
+def _limit_memory():
+    """Limits the worker's address space to what it uses now plus `CODE_MEMORY_BUDGET`"""
+    try:
+        with open("/proc/self/statm") as statm:
+            used = int(statm.read().split()[0]) * resource.getpagesize()
+    except OSError:  # Not on Linux: other systems don't enforce RLIMIT_AS anyway
+        return
+    limit = used + CODE_MEMORY_BUDGET
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _serve(connection):
+    """Main of the worker processes: runs the code they receive, one at a time"""
+    if resource is not None:
+        _limit_memory()
+    # Replies are JSON, not pickles: unpickling them could run code in the server
+    connection.send_bytes(b"[]")
+    while True:
+        try:
+            source, card = json.loads(connection.recv_bytes())
+        except EOFError:
+            return
+        try:
+            reply = json.dumps(["ok", *_run_card_code(source, card)])
+        except Exception as error:
+            reply = json.dumps(["error", str(error) or repr(error)])
+        connection.send_bytes(reply.encode())
+
+
+class _Worker:
+    """A process running card types' code, see `run_card_code()`"""
+
+    #: Workers are started fresh rather than forked from the server's threads
+    context = multiprocessing.get_context("spawn")
+
+    def __init__(self):
+        self.connection, child = self.context.Pipe()
+        self.process = self.context.Process(target=_serve, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        try:
+            # Ready once it imported this module and limited its memory
+            self.connection.recv_bytes()
+        except (OSError, EOFError) as error:
+            self.kill()
+            raise SchemaCodeError(f"The card types' code worker failed to start: {error!r}")
+
+    def run(self, source: str, card: Dict[str, Any]) -> List[str]:
+        """
+        Runs the code in the worker. If the worker doesn't answer in time, or dies (out of
+        memory, for example), it's killed and `SchemaCodeError` is raised.
+        """
+        try:
+            self.connection.send_bytes(json.dumps([source, card]).encode())
+            if self.connection.poll(CODE_KILL_TIMEOUT):
+                return json.loads(self.connection.recv_bytes(16 * MAX_TEMPLATE_SIZE))
+            error = f"was killed after {CODE_KILL_TIMEOUT}s"
+        except (OSError, EOFError, ValueError) as exception:
+            error = f"stopped its worker: {exception!r}"
+        self.kill()
+        raise SchemaCodeError(f"The card type's code {error}")
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+#: The workers waiting for code to run
+_workers: List[_Worker] = []
+
+
+def run_card_code(source: str, card: Dict[str, Any]) -> Tuple[str, str]:
+    """
+    Runs a card type's code for the card and returns the question and answer templates
+    it generated, in the `card` dict it must define.
+    """
+    worker = None
+    while worker is None:
+        try:
+            worker = _workers.pop()
+        except IndexError:
+            worker = _Worker()
+        if not worker.process.is_alive():
+            # Died while waiting: replaced by another one
+            worker.kill()
+            worker = None
+    status, *reply = worker.run(source, card)
+    _workers.append(worker)
+    if status == "error":
+        raise SchemaCodeError(reply[0])
+    question, answer = reply
+    return question, answer
+
+
+def _check_template(name: str, source: Any):
+    if not isinstance(source, str):
+        raise InvalidSchema(f"'{name}' must be a string")
+    try:
+        _jinja2.parse(source)
+    except TemplateSyntaxError as error:
+        raise InvalidSchema(f"'{name}', line {error.lineno}: {error.message}")
+
+
+def _check_card_type(card_type: str, card_schema: Any):
+    if isinstance(card_schema, str):
+        compile_card_code(card_schema)
+    elif isinstance(card_schema, dict):
+        for key in ("question", "answer"):
+            _check_template(f"{card_type}.{key}", card_schema.get(key))
+    else:
+        raise InvalidSchema(f"Card type '{card_type}' must be a dict or a string of code")
+
+
+def parse_schema(code: str) -> Dict[str, Any]:
+    """
+    Reads a schema typed as a Python dict literal, without running it, and checks that
+    its templates and card types' code are valid. Raises `InvalidSchema` if not.
+    """
+    if len(code) > MAX_SCHEMA_SIZE:
+        raise InvalidSchema(f"Schemas can't be longer than {MAX_SCHEMA_SIZE} characters")
+    try:
+        schema = ast.literal_eval(code.strip())
+    except (SyntaxError, ValueError) as error:
+        raise InvalidSchema(f"The schema must be a dict of strings: {error}")
+    if not isinstance(schema, dict):
+        raise InvalidSchema("The schema must be a dict")
+    for key in ("name", "description"):
+        if not isinstance(schema.get(key), str):
+            raise InvalidSchema(f"'{key}' must be a string")
+    for key in ("form", "preview"):
+        _check_template(key, schema.get(key))
+    if not isinstance(schema.get("cards"), dict) or not schema["cards"]:
+        raise InvalidSchema("'cards' must be a dict with at least one card type")
+    for card_type, card_schema in schema["cards"].items():
+        _check_card_type(card_type, card_schema)
+    return schema
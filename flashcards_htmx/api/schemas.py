@@ -1,21 +1,22 @@
 from pathlib import Path
-import shelve
 from textwrap import dedent
 from hashlib import md5
 
 import starlette.status as status
-from fastapi import APIRouter, Request, Depends, HTTPException
+from fastapi import APIRouter, Request, Depends, HTTPException, BackgroundTasks
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 
-from flashcards_htmx.app import template, database
+from flashcards_htmx.app import template, cached, get_storage, get_readonly_storage, get_form
+from flashcards_htmx.api.utils import schema_templates, rerender_cards
+from flashcards_htmx.api.schema_code import InvalidSchema, parse_schema
 
 
 templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
 router = APIRouter()
 
 
-@router.get("/schemas", response_class=HTMLResponse)
+@router.get("/schemas", response_class=HTMLResponse, dependencies=[Depends(cached())])
 async def schemas_page(
     request: Request, render=Depends(template("private/schemas.html"))
 ):
@@ -27,26 +28,30 @@ async def schemas_page(
     )
 
 
-@router.get("/htmx/components/schemas", response_class=HTMLResponse)
-async def schemas_component(render=Depends(template("responses/schemas.html"))):
-    with shelve.open(database) as db:
-        schemas = db["schemas"]
-        for schema in schemas.values():
-            schema["usage"] = 0
-
-        # Get all the cards that uses this schema across all decks
-        for deck in db["decks"].values():
-            for card in deck["cards"].values():
-                if card["schema"] in schemas:
-                    schemas[card["schema"]]["usage"] += 1
+@router.get(
+    "/htmx/components/schemas",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("schemas", shared=True))],
+)
+def schemas_component(
+    render=Depends(template("responses/schemas.html")),
+    storage=Depends(get_readonly_storage),
+):
+    usage = storage.usage_by_schema()
+    schemas = {
+        schema_id: {**schema, "usage": usage.get(schema_id, 0)}
+        for schema_id, schema in storage.list_schemas().items()
+    }
 
-        return render(schemas=schemas)
+    return render(schemas=schemas)
 
 
 @router.get("/schemas/new", response_class=HTMLResponse)
-async def create_schema_page(render=Depends(template("private/schema-code.html"))):
-    with shelve.open(database) as db:
-        schema_id = str(len(db["schemas"]) + 1)
+def create_schema_page(
+    render=Depends(template("private/schema-code.html")),
+    storage=Depends(get_readonly_storage),
+):
+    schema_id = str(len(storage.list_schemas()) + 1)
     return render(
         navbar_title="New Schema",
         schema_id=schema_id,
@@ -60,29 +65,30 @@ async def create_schema_page(render=Depends(template("private/schema-code.html")
                 <label for='answer'>Answer</label>
                 <input type='text' name='answer'  value={{ answer }}>
             """),
+            "preview": "{{ question }} -> {{ answer }}",
             "cards": {
                 "card": {
-                    "sides": {
-                        "Question": "{{ question }}",
-                        "Answer": "{{ answer }}",
-                    },
-                    "preview": "{{ question }} -> {{ answer }}",
-                    "flip_order": "['Question', 'Answer']",
+                    "question": "{{ question }}",
+                    "answer": "{{ answer }}",
                 },
             }
         }
     )
 
 
-@router.get("/schemas/view/{schema_id}", response_class=HTMLResponse)
-async def view_schema_page(
-    schema_id: str, render=Depends(template("private/schema-readonly.html"))
+@router.get(
+    "/schemas/view/{schema_id}",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("schema/{schema_id}"))],
+)
+def view_schema_page(
+    schema_id: str,
+    render=Depends(template("private/schema-readonly.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        schema = dict(**db["schemas"].get(schema_id, {}))  # To avoid automatic creation of a new schema
-        del schema["usage"]
-        if not schema:
-            raise HTTPException(status_code=404, detail="Schema not found")
+    schema = storage.get_schema(schema_id)
+    if not schema:
+        raise HTTPException(status_code=404, detail="Schema not found")
     return render(
         navbar_title=schema["name"],
         schema_id=schema_id,
@@ -91,16 +97,16 @@ async def view_schema_page(
 
 
 @router.get("/schemas/new/{schema_id}", response_class=HTMLResponse)
-async def clone_schema_page(
-    schema_id: str, render=Depends(template("private/schema-code.html"))
+def clone_schema_page(
+    schema_id: str,
+    render=Depends(template("private/schema-code.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        schema = dict(**db["schemas"].get(schema_id, {}))  # To avoid automatic creation of a new schema
-        if not schema:
-            raise HTTPException(status_code=404, detail="Schema not found")
-        schema["name"] = f"Clone of {schema['name']}"
-        del schema["usage"]
-        schema_id = md5(schema["name"].encode()).hexdigest()
+    schema = storage.get_schema(schema_id)
+    if not schema:
+        raise HTTPException(status_code=404, detail="Schema not found")
+    schema["name"] = f"Clone of {schema['name']}"
+    schema_id = md5(schema["name"].encode()).hexdigest()
     return render(
         navbar_title=schema["name"],
         schema_id=schema_id,
@@ -109,16 +115,24 @@ async def clone_schema_page(
 
 
 @router.post("/schema/new", response_class=RedirectResponse)
-async def save_schema_endpoint(request: Request):
-    async with request.form() as form:
-        schema = eval(form["code"])
-        schema_id = md5(schema["name"].encode()).hexdigest()
-        with shelve.open(database) as db:
-            if schema_id in db["schemas"]:
-                raise HTTPException(
-                    status_code=409, detail="Schema with this ID already exists"
-                )
-            db["schemas"][schema_id] = schema
+def save_schema_endpoint(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    form=Depends(get_form),
+    storage=Depends(get_storage),
+):
+    try:
+        schema = parse_schema(form["code"])
+    except InvalidSchema as error:
+        raise HTTPException(status_code=400, detail=f"Invalid schema: {error}")
+    schema_id = md5(schema["name"].encode()).hexdigest()
+    if storage.get_schema(schema_id):
+        raise HTTPException(
+            status_code=409, detail="Schema with this ID already exists"
+        )
+    storage.save_schema(schema_id, schema)
+    schema_templates.invalidate(schema_id)
+    background_tasks.add_task(rerender_cards, storage, schema_id=schema_id)
     return RedirectResponse(
         request.url_for("schemas_page"), status_code=status.HTTP_302_FOUND
     )
@@ -127,13 +141,14 @@ async def save_schema_endpoint(request: Request):
 @router.get(
     "/htmx/components/schema/{schema_id}/confirm-delete", response_class=HTMLResponse
 )
-async def schema_confirm_delete_component(
-    schema_id: str, render=Depends(template("components/message-modal.html"))
+def schema_confirm_delete_component(
+    schema_id: str,
+    render=Depends(template("components/message-modal.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        schema = db["schemas"].get(schema_id, {})
-        if not schema:
-            raise HTTPException(status_code=404, detail="Schema not found")
+    schema = storage.get_schema(schema_id)
+    if not schema:
+        raise HTTPException(status_code=404, detail="Schema not found")
 
     return render(
         title=f"Deleting schema",
@@ -146,11 +161,13 @@ async def schema_confirm_delete_component(
 
 
 @router.get("/schemas/{schema_id}/delete", response_class=RedirectResponse)
-async def delete_schema_endpoint(request: Request, schema_id: str):
-    with shelve.open(database) as db:
-        if schema_id not in db["schemas"]:
-            raise HTTPException(status_code=404, detail="Schema not found")
-        del db["schemas"][schema_id]
+def delete_schema_endpoint(
+    request: Request, schema_id: str, storage=Depends(get_storage)
+):
+    if not storage.get_schema(schema_id):
+        raise HTTPException(status_code=404, detail="Schema not found")
+    storage.delete_schema(schema_id)
+    schema_templates.invalidate(schema_id)
 
     return RedirectResponse(
         request.url_for("schemas_page"), status_code=status.HTTP_302_FOUND
@@ -0,0 +1,63 @@
+from typing import Optional
+from pathlib import Path
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import HTMLResponse
+from fastapi.templating import Jinja2Templates
+
+from flashcards_htmx.app import template, get_readonly_storage
+from flashcards_htmx.constants import PAGE_SIZE
+from flashcards_htmx.api.utils import card_preview, split_tags
+
+
+templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
+router = APIRouter()
+
+
+@router.get("/htmx/components/search", response_class=HTMLResponse)
+def search_component(
+    q: str = "",
+    deck_id: Optional[str] = None,
+    tags: str = "",
+    schema_id: Optional[str] = None,
+    render=Depends(template("responses/search.html")),
+    storage=Depends(get_readonly_storage),
+):
+    deck_id = deck_id or None
+    schema_id = schema_id or None
+    tags = split_tags(tags)
+    filtered = bool(tags or schema_id)
+    # Decks have no schema, so they never match a schema filter
+    with_decks = not deck_id and not schema_id
+
+    if q:
+        found = storage.search(q, deck_id, PAGE_SIZE, tags, schema_id)
+    elif filtered:
+        found = [
+            (found_deck_id, None)
+            for found_deck_id in (storage.filter_decks(tags, PAGE_SIZE) if with_decks else [])
+        ] + storage.filter_cards(deck_id, tags, schema_id, PAGE_SIZE)
+    else:
+        found = []
+
+    decks = {}
+    cards = []
+    card_schemas = storage.list_schemas()
+    for found_deck_id, card_id in found:
+        if card_id is None:
+            decks[found_deck_id] = storage.get_deck(found_deck_id)
+            continue
+        card = storage.get_card(found_deck_id, card_id)
+        card = {
+            **card,
+            "schema_name": card_schemas.get(card["schema"], {}).get("name", ""),
+            "preview": card_preview(storage, card),
+        }
+        cards.append((found_deck_id, card_id, card))
+    return render(
+        query=q or ", ".join(tags),
+        decks=decks,
+        cards=cards,
+        deck_id=deck_id,
+        tags=",".join(tags),
+    )
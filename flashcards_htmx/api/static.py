@@ -0,0 +1,159 @@
+"""
+Static files, served from memory with their content's hash in their name: the pages link
+them through `static_url()`, so browsers can keep them forever and download them again
+only once they changed. They're also served compressed with gzip or brotli, compressed
+once after startup instead of at every request.
+"""
+from typing import Dict, Optional
+import os
+import gzip
+import mimetypes
+from pathlib import Path
+from hashlib import sha256
+from threading import get_ident
+
+try:
+    import brotli
+except ImportError:  # Optional: without it, only the gzip variants are served
+    brotli = None
+
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import Response
+
+from flashcards_htmx.constants import STATIC_CACHE
+
+
+#: Cache-Control of the files requested by their hashed name, that never changes content
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+#: Cache-Control of the files requested by their plain name
+REVALIDATE = "no-cache"
+
+#: Compression of the variants, by `Content-Encoding` in order of preference
+COMPRESSIONS = {
+    "br": lambda data: brotli.compress(data, quality=11),
+    "gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+}
+
+
+def _accepted(accept_encoding: str) -> Dict[str, float]:
+    """The encodings listed in the `Accept-Encoding` header, with their `q` value"""
+    accepted = {}
+    for coding in accept_encoding.lower().split(","):
+        name, *params = coding.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        accepted[name.strip()] = quality
+    return accepted
+
+
+class StaticFile:
+    """A static file with its compressed variants, by `Content-Encoding`"""
+
+    def __init__(self, path: str, data: bytes):
+        self.path = path
+        self.hash = sha256(data).hexdigest()[:16]
+        name = Path(path)
+        self.hashed_path = str(name.with_name(f"{name.stem}.{self.hash}{name.suffix}"))
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.variants: Dict[str, bytes] = {"identity": data}
+
+    def compress(self, encoding: str, cache: Optional[Path] = None):
+        """Adds the variant compressed with `encoding`, if it's smaller than the file"""
+        cached = cache / f"{self.hash}.{encoding}" if cache else None
+        if cached and cached.exists():
+            data = cached.read_bytes()
+        else:
+            data = COMPRESSIONS[encoding](self.variants["identity"])
+            if cached:
+                # Renamed once written: other processes may be reading the same cache
+                written = cached.with_name(f"{cached.name}.{os.getpid()}.{get_ident()}")
+                written.write_bytes(data)
+                written.replace(cached)
+        if len(data) < len(self.variants["identity"]):
+            self.variants[encoding] = data
+
+    def encoding_for(self, accept_encoding: str) -> str:
+        """The best variant for the `Accept-Encoding` header"""
+        accepted = _accepted(accept_encoding)
+        for encoding in COMPRESSIONS:
+            if encoding in self.variants and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+        return "identity"
+
+
+class StaticFiles:
+    """The files of the `static` folder, read once when created"""
+
+    def __init__(self, directory: Path):
+        #: By their path in the folder
+        self.files: Dict[str, StaticFile] = {}
+        for path in sorted(directory.rglob("*")):
+            if path.is_file():
+                relative_path = path.relative_to(directory).as_posix()
+                self.files[relative_path] = StaticFile(relative_path, path.read_bytes())
+        self._hashed = {file.hashed_path: file for file in self.files.values()}
+        #: Changes whenever any file changes
+        self.version = sha256(" ".join(self._hashed).encode()).hexdigest()
+
+    def get(self, path: str) -> Optional[StaticFile]:
+        """The file by its plain or hashed path"""
+        return self._hashed.get(path) or self.files.get(path)
+
+    def compress(self):
+        """
+        Compresses all the files, reusing the variants saved in `STATIC_CACHE` if set.
+        Files are served uncompressed until their variants are ready: the gzip ones take
+        a fraction of a second, while brotli's best compression takes several seconds.
+        """
+        cache = None
+        if STATIC_CACHE:
+            cache = Path(STATIC_CACHE)
+            cache.mkdir(parents=True, exist_ok=True)
+        for encoding in reversed(list(COMPRESSIONS)):
+            if encoding == "br" and brotli is None:
+                continue
+            for static_file in self.files.values():
+                static_file.compress(encoding, cache)
+
+    def url(self, path: str) -> str:
+        """URL of the file at `path` in the `static` folder, by its hashed name"""
+        static_file = self.files.get(path)
+        return f"/static/{static_file.hashed_path if static_file else path}"
+
+
+static_files = StaticFiles(Path(__file__).parent.parent / "static")
+router = APIRouter()
+
+
+def static_url(path: str) -> str:
+    """Template function: `{{ static_url('css/modal.css') }}`"""
+    return static_files.url(path)
+
+
+@router.api_route(
+    "/static/{path:path}", methods=["GET", "HEAD"], name="static", include_in_schema=False
+)
+async def static_file_endpoint(request: Request, path: str):
+    static_file = static_files.get(path)
+    if not static_file:
+        raise HTTPException(status_code=404, detail="File not found")
+    encoding = static_file.encoding_for(request.headers.get("Accept-Encoding", ""))
+    headers = {
+        "Cache-Control": IMMUTABLE if path == static_file.hashed_path else REVALIDATE,
+        "ETag": f'"{static_file.hash}-{encoding}"',
+        "Vary": "Accept-Encoding",
+    }
+    if headers["ETag"] in request.headers.get("If-None-Match", ""):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(
+        static_file.variants[encoding], media_type=static_file.media_type, headers=headers
+    )
@@ -1,14 +1,16 @@
+from typing import Optional
+import time
 from pathlib import Path
-import shelve
 
-from jinja2 import Template
-import starlette.status as status
-from fastapi import APIRouter, Request, Depends, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 
-from flashcards_htmx.app import template, database
+from flashcards_htmx.app import template, cached, get_storage, get_readonly_storage
 from flashcards_htmx.api.algorithms import ALGORITHMS
+from flashcards_htmx.api.reviews import review_commits
+from flashcards_htmx.api.schema_code import SchemaCodeError
+from flashcards_htmx.api.utils import split_tags
 
 
 templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
@@ -16,32 +18,44 @@ router = APIRouter()
 
 
 
-@router.get("/study/{deck_id}", response_class=HTMLResponse)
-async def study_page(deck_id: str, render=Depends(template("private/study.html"))):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
-    return render(navbar_title=deck["name"], deck=deck, deck_id=deck_id)
-
-
-@router.get("/htmx/components/decks/{deck_id}/study", response_class=HTMLResponse)
-async def study_component(
-    deck_id: str, render=Depends(template("responses/study.html"))
+@router.get(
+    "/study/{deck_id}",
+    response_class=HTMLResponse,
+    dependencies=[Depends(cached("deck/{deck_id}"))],
+)
+def study_page(
+    deck_id: str,
+    tags: str = "",
+    render=Depends(template("private/study.html")),
+    storage=Depends(get_readonly_storage),
 ):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
+    return render(
+        navbar_title=deck["name"], deck=deck, deck_id=deck_id, tags=",".join(split_tags(tags))
+    )
 
-        if not len(deck["cards"]):
-            return render(card_id=None, deck_id=deck_id)
 
-        algorithm = ALGORITHMS[deck["algorithm"]]
-        card_id, card_type, question, answer = algorithm.next_card(
-            deck, db["schemas"]
-        )
-        buttons = algorithm.buttons()
+def _next_card(render, storage, deck_id: str, deck, tags: str) -> str:
+    """Renders the next card to study, picked by the deck's algorithm"""
+    # A session can be restricted to the cards having all the given tags
+    tags = split_tags(tags)
+    card_ids = [card_id for _, card_id in storage.filter_cards(deck_id, tags)] if tags else None
+    if not (card_ids if tags else storage.count_cards(deck_id)):
+        return render(card_id=None, deck_id=deck_id)
+
+    algorithm = ALGORITHMS[deck["algorithm"]]
+    try:
+        picked = algorithm.next_card(storage, deck_id, deck, card_ids=card_ids)
+    except SchemaCodeError:
+        # The card type's code is broken: the template shows an error instead of the card
+        return render(error=True, deck_id=deck_id)
+    if picked is None:
+        # The cards have no card type to review
+        return render(card_id=None, deck_id=deck_id)
+    card_id, card_type, question, answer = picked
+    buttons = algorithm.buttons()
 
     return render(
         deck=deck,
@@ -50,27 +64,62 @@ async def study_component(
         card_type=card_type,
         question=question,
         answer=answer,
-        buttons=buttons
+        buttons=buttons,
+        tags=",".join(tags),
+        # Sent back with the review, to log how long the answer took
+        shown=round(time.time(), 3),
     )
 
 
+@router.get("/htmx/components/decks/{deck_id}/study", response_class=HTMLResponse)
+def study_component(
+    deck_id: str,
+    tags: str = "",
+    render=Depends(template("responses/study.html")),
+    storage=Depends(get_readonly_storage),
+):
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
+    return _next_card(render, storage, deck_id, deck, tags)
+
+
 @router.post(
     "/htmx/components/decks/{deck_id}/study/{card_id}/{card_type}/{result}",
-    response_class=RedirectResponse,
+    response_class=HTMLResponse,
 )
-async def save_review_component(
-    deck_id: str, card_id: str, card_type: str, result: str, request: Request
+def save_review_component(
+    deck_id: str,
+    card_id: str,
+    card_type: str,
+    result: str,
+    tags: str = "",
+    shown: Optional[float] = None,
+    render=Depends(template("responses/study.html")),
+    storage=Depends(get_storage),
 ):
-    with shelve.open(database) as db:
-        deck = db["decks"].get(deck_id, {})
-        if not deck:
-            raise HTTPException(status_code=404, detail="Deck not found")
-
-        algorithm = ALGORITHMS[deck["algorithm"]]
-        algorithm.process_result(deck, card_id, card_type, result)
-
-    return RedirectResponse(
-        request.url_for("study_component", deck_id=deck_id),
-        status_code=status.HTTP_302_FOUND,
-    )
-
+    """
+    Saves the review and responds with the next card right away, instead of redirecting
+    to `study_component`: answering a card costs a single round trip.
+    """
+    deck = storage.get_deck(deck_id)
+    if not deck:
+        raise HTTPException(status_code=404, detail="Deck not found")
+
+    card = storage.get_card(deck_id, card_id)
+    if not card or card_type not in card["reviews"]:
+        raise HTTPException(status_code=404, detail="Card not found")
+
+    algorithm = ALGORITHMS[deck["algorithm"]]
+    now = time.time()
+    latency = now - shown if shown is not None and shown <= now else None
+
+    def save():
+        # The review is computed from the previous one: both happen in the same transaction,
+        # or concurrent reviews of the card could overwrite each other
+        algorithm.process_result(storage, deck_id, card_id, card_type, result, now=now)
+        storage.log_review(deck_id, card_id, card_type, result, now, latency)
+
+    review_commits.save(storage, save)
+    # Committed, and the storage's indexes updated: the next card accounts for this review
+    return _next_card(render, storage, deck_id, deck, tags)
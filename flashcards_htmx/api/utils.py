@@ -1,13 +1,196 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from time import monotonic
+from functools import lru_cache
+from threading import Lock
 
-def get_question_answer_from_schema(card_schema, card_data):
-    import random
+from fastapi import HTTPException
+from jinja2 import BaseLoader, TemplateNotFound
+from jinja2.sandbox import SandboxedEnvironment
+
+from flashcards_htmx.api.schema_code import run_card_code
+
+
+#: How often, in seconds, a compiled schema template is checked against the stored schema's
+#: version, in case another process changed it
+SCHEMA_RELOAD_INTERVAL = 1.0
+
+
+class SchemaLoader(BaseLoader):
+    """
+    Loads the templates of the schemas from the storage, by `"<schema_id>/<field>"`:
+    the field is `form`, `preview`, or `cards/<card_type>/question` or `answer`.
+
+    Compiled templates stay in the environment's cache while they're up to date: until
+    `SchemaTemplates.invalidate()` is called for their schema, or its version changes in
+    the storage, checked at most every `SCHEMA_RELOAD_INTERVAL` seconds.
+    """
+
+    def __init__(self, templates: "SchemaTemplates"):
+        self._templates = templates
+
+    @staticmethod
+    def source(schema: Dict[str, Any], field: str) -> Any:
+        if field.startswith("cards/"):
+            card_type, side = field[len("cards/"):].rsplit("/", 1)
+            return schema["cards"][card_type][side]
+        return schema[field]
+
+    def get_source(self, environment, name: str) -> Tuple[str, None, Callable[[], bool]]:
+        schema_id, field = name.split("/", 1)
+        storage = self._templates.storage
+        # Read first: the template is reloaded if the schema changed right after
+        [stored_version] = storage.get_versions([f"schema/{schema_id}"])
+        try:
+            source = self.source(storage.get_schema(schema_id), field)
+        except (TypeError, KeyError):
+            raise TemplateNotFound(name)
+        version = self._templates.version(schema_id)
+        checked = monotonic()
+
+        def uptodate() -> bool:
+            nonlocal checked
+            if self._templates.version(schema_id) != version:
+                return False
+            if monotonic() - checked < SCHEMA_RELOAD_INTERVAL:
+                return True
+            checked = monotonic()
+            return storage.get_versions([f"schema/{schema_id}"]) == [stored_version]
+
+        return source, None, uptodate
+
+
+class SchemaTemplates:
+    """
+    Sandboxed Jinja2 environment for the templates written by the users in the schemas,
+    so they can't reach anything but the card's fields. Templates are loaded from the
+    storage by `SchemaLoader`, and compiled once: Jinja2 caches them.
+    """
+
+    def __init__(self, cache_size: int = 1024):
+        self.storage = None
+        self._versions: Dict[str, int] = {}
+        self._lock = Lock()
+        self.environment = SandboxedEnvironment(
+            loader=SchemaLoader(self), cache_size=cache_size, auto_reload=True
+        )
+        # The templates generated by the code of the card types, by source
+        self._generated = lru_cache(maxsize=cache_size)(self.environment.from_string)
+
+    def open(self, storage):
+        """Loads the templates from this storage from now on"""
+        self.storage = storage
+        self.environment.cache.clear()
+
+    def version(self, schema_id: str) -> int:
+        return self._versions.get(schema_id, 0)
+
+    def invalidate(self, schema_id: str):
+        """Drops the compiled templates of the schema, that changed or was deleted"""
+        with self._lock:
+            self._versions[schema_id] = self.version(schema_id) + 1
+
+    def render(self, schema_id: str, field: str, **context: Any) -> str:
+        """Renders a template of the schema, see `SchemaLoader` for the fields"""
+        template = self.environment.get_template(f"{schema_id}/{field}")
+        return template.render(**context)
+
+    def render_generated(self, source: str, **context: Any) -> str:
+        """Renders a template generated by the code of a card type"""
+        return self._generated(source).render(**context)
 
+
+#: Compiled templates of all the card schemas, loaded from the storage opened at startup
+schema_templates = SchemaTemplates()
+
+
+#: Card keys holding HTML rendered at save time, see `render_card()`
+RENDERED_KEYS = ("preview", "rendered_question", "rendered_answer")
+
+
+def get_question_answer_from_schema(card_schema, card_data):
     if isinstance(card_schema, str):
-        rendering_context = locals() | card_data
-        exec(card_schema, {}, rendering_context)
-        question_template = rendering_context["card"]["question"]
-        answer_template = rendering_context["card"]["answer"]
+        # Card types generated by code, see `flashcards_htmx.api.schema_code`
+        question_template, answer_template = run_card_code(card_schema, card_data)
     else:
         question_template = card_schema["question"]
         answer_template = card_schema["answer"]
-    return question_template, answer_template
\ No newline at end of file
+    return question_template, answer_template
+
+
+def render_card(schema_id: str, schema: Dict[str, Any], card: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns a copy of the card with its preview and the question and answer of each
+    card type rendered, ready to be stored along with the card.
+
+    Card types generated by code (see `get_question_answer_from_schema()`) can change
+    at every review, so they're left out and rendered when studied.
+    """
+    card = {key: value for key, value in card.items() if key not in RENDERED_KEYS}
+    rendered = {
+        "preview": schema_templates.render(schema_id, "preview", **card),
+        "rendered_question": {},
+        "rendered_answer": {},
+    }
+    for card_type, card_schema in schema["cards"].items():
+        if isinstance(card_schema, str):
+            continue
+        rendered["rendered_question"][card_type] = schema_templates.render(
+            schema_id, f"cards/{card_type}/question", **card
+        )
+        rendered["rendered_answer"][card_type] = schema_templates.render(
+            schema_id, f"cards/{card_type}/answer", **card
+        )
+    return {**card, **rendered}
+
+
+def card_preview(storage, card: Dict[str, Any]) -> str:
+    """The card's preview, rendered now only if it wasn't at save time"""
+    if "preview" in card:
+        return card["preview"]
+    return schema_templates.render(card["schema"], "preview", **card)
+
+
+def card_question_answer(storage, card_type: str, card: Dict[str, Any]) -> Tuple[str, str]:
+    """The question and answer of the card type, rendered now only if they weren't at save time"""
+    if card_type in card.get("rendered_question", {}):
+        return card["rendered_question"][card_type], card["rendered_answer"][card_type]
+    card_schema = storage.get_schema(card["schema"])["cards"][card_type]
+    if not isinstance(card_schema, str):
+        question = schema_templates.render(card["schema"], f"cards/{card_type}/question", **card)
+        answer = schema_templates.render(card["schema"], f"cards/{card_type}/answer", **card)
+        return question, answer
+    question_template, answer_template = get_question_answer_from_schema(card_schema, card)
+    question = schema_templates.render_generated(question_template, **card)
+    answer = schema_templates.render_generated(answer_template, **card)
+    return question, answer
+
+
+def rerender_cards(storage, schema_id: Optional[str] = None, deck_id: Optional[str] = None):
+    """
+    Renders again the stored cards using the schema, or the cards of the deck.
+    Meant to run as a background task: each card is updated in its own short
+    transaction, so that reviews done in the meantime are never overwritten.
+    Only the affected cards are read, looked up in the schema index.
+    """
+    for card_deck_id, card_id in storage.filter_cards(deck_id, schema_id=schema_id):
+        with storage.transaction():
+            card = storage.get_card(card_deck_id, card_id)
+            schema = storage.get_schema(card["schema"]) if card else None
+            if schema:
+                card = render_card(card["schema"], schema, card)
+                storage.upsert_card(card_deck_id, card_id, card)
+
+
+def check_cursor(cursor: Optional[str]) -> Optional[str]:
+    """
+    Pagination cursor from a query string. The storages' cursors are sequence numbers:
+    anything else is answered with a 400 instead of failing in the storage.
+    """
+    if cursor and not (cursor.isascii() and cursor.isdigit()):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return cursor or None
+
+
+def split_tags(tags: str) -> List[str]:
+    """Tags typed in a form or query string as a comma-separated list"""
+    return [tag.strip() for tag in tags.split(",") if tag.strip()]
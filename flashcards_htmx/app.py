@@ -1,24 +1,50 @@
-from typing import *
-import shelve
+from typing import Any, Optional
 
+import sys
+import dbm
 from pathlib import Path
+from hashlib import sha1
 from datetime import datetime
+from threading import Lock, Thread
+from contextlib import asynccontextmanager
+from collections import OrderedDict
 import importlib.metadata
-from functools import partial
-from textwrap import dedent
-from hashlib import md5
 
-from jinja2 import Environment, pass_context
+import anyio.to_thread
+
+from jinja2 import Environment, FileSystemBytecodeCache, pass_context
 from jinja2.loaders import PackageLoader
-from fastapi import Request, Depends
+from fastapi import Request, Response
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse
+from starlette.datastructures import FormData
 from fastapi.exceptions import HTTPException, StarletteHTTPException
 
+from flashcards_htmx.constants import (
+    STORAGE,
+    DATABASE,
+    LEGACY_DATABASE,
+    TEMPLATES_CACHE,
+    PRECOMPILE_TEMPLATES,
+    FRAGMENT_CACHE_SIZE,
+    WORKER_THREADS,
+)
+from flashcards_htmx.storage import (
+    Storage,
+    ReadOnlyStorage,
+    STORAGE_BACKENDS,
+    migrate_from_shelve,
+)
+from flashcards_htmx.api.utils import schema_templates
+from flashcards_htmx.api.static import static_files, static_url
+
 
 __version__ = importlib.metadata.version("flashcards_htmx")
 
+#: Cache-Control of the cached pages and fragments, see `cached()`: browsers keep them,
+#: but check that they're still up to date every time they use them
+CACHE_CONTROL = "private, no-cache"
+
 '''
 Data structure:
 
@@ -57,82 +83,196 @@ Data structure:
 '''
 
 
-database = "flashcards.db"
-shelve.open = partial(shelve.open, writeback=True)
-
-with shelve.open(database) as db:
-    db.setdefault("decks", {})
-    db.setdefault(
-        "schemas",
-        {
-            md5("Question & Answer".encode()).hexdigest(): {
-                "name": "Question & Answer",
-                "description": "Simple schema with a question and an answer.",
-
-                "form": dedent("""
-                    <label for='question'>Question</label>
-                    <input type='text' name='question' value='{{ question }}'>
-
-                    <label for='answer'>Answer</label>
-                    <input type='text' name='answer' value='{{ answer }}'>
-                """),
-                "preview": "{{ question }} -> {{ answer }}",
-                "cards": {
-                    "card": {
-                        "question": "{{ question }}",
-                        "answer": "{{ answer }}",
-                    }
-                }
-            },
-            md5("Question & Answer with reverse".encode()).hexdigest(): {
-                "name": "Question & Answer with reverse",
-                "description": "Generates two cards: question -> answer and answer -> question.",
-                "form": dedent("""
-                    <label for='question'>Question:</label>
-                    <input type='text' name='question' value='{{ question }}'>
-
-                    <label for='answer'>Answer:</label>
-                    <input type='text' name='answer'  value='{{ answer }}'>
-                """),
-                "preview": "{{ question }} <-> {{ answer }}",
-                "cards": {
-                    "direct": {
-                        "question": "{{ question }}",
-                        "answer": "{{ answer }}",
-                    },
-                    "reverse": {
-                        "question": "{{ answer }}",
-                        "answer": "{{ question }}",
-                    }
-                }
-            },
-        },
-    )
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the storage once at startup and share it across all requests"""
+    # The routes using the storage are plain functions, run by FastAPI in this threadpool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = WORKER_THREADS
+    first_run = not Path(DATABASE).exists()
+    app.state.storage = STORAGE_BACKENDS[STORAGE](DATABASE)
+    app.state.storage.open()
+    schema_templates.open(app.state.storage)
+    rendered_fragments.clear()
+    # In the background: the pages can link the static files before they're compressed
+    Thread(target=static_files.compress, daemon=True).start()
+    if STORAGE == "sqlite" and first_run and dbm.whichdb(LEGACY_DATABASE):
+        migrate_from_shelve(LEGACY_DATABASE, app.state.storage)
+    if PRECOMPILE_TEMPLATES:
+        for name in jinja2_env.list_templates(extensions=["html"]):
+            jinja2_env.get_template(name)
+    yield
+    app.state.storage.close()
+
+
+# The dependencies below are coroutines only so that FastAPI calls them on the event loop
+# instead of sending each of them to the threadpool: they never block.
+
+
+async def get_storage(request: Request) -> Storage:
+    """Get the storage dependency opened at startup"""
+    return request.app.state.storage
+
+
+async def get_readonly_storage(request: Request) -> ReadOnlyStorage:
+    """Get a read-only view on the storage, for the routes that only display data"""
+    return ReadOnlyStorage(request.app.state.storage)
+
+
+async def get_form(request: Request) -> FormData:
+    """Get the submitted form, read on the event loop so that the route can run in a thread"""
+    return await request.form()
+
+
+class FragmentCache:
+    """
+    LRU cache of rendered pages by ETag, bounded by the memory their HTML takes. Entries
+    are never invalidated: a write changes the ETags of the pages showing what it wrote,
+    and the pages rendered before it are no longer requested and get evicted.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._pages: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            html = self._pages.get(key)
+            if html is not None:
+                self._pages.move_to_end(key)
+            return html
+
+    def put(self, key: str, html: str):
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._pages:
+                return
+            self._pages[key] = html
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self.bytes -= sys.getsizeof(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self.bytes = 0
+
 
+#: Pages rendered by the routes using `cached(..., shared=True)`, shared by all browsers
+rendered_fragments = FragmentCache(int(FRAGMENT_CACHE_SIZE * 1024 * 1024))
 
-def get_jinja2():
-    """Get Jinja2 dependency function. you can define more functions, filters or global vars here"""
 
-    @pass_context
-    def url_for(context: dict, name: str, **path_params: Any) -> str:
-        request = context["request"]
-        return request.url_for(name, **path_params)
+class CachedResponse(Exception):
+    """Raised by `cached()` to answer the request without running the route"""
 
-    env = Environment(loader=PackageLoader("flashcards_htmx"), autoescape=True)
+    def __init__(self, response: Response):
+        self.response = response
+
+
+def cached(*versions: str, shared: bool = False):
+    """
+    Dependency of the GET routes whose page only depends on the URL, the templates and
+    the storage's `versions` (see `Storage.get_versions()`), formatted with the path
+    parameters like `"deck/{deck_id}"`. Sets a strong ETag computed from them, and
+    answers 304 when the browser sent it in `If-None-Match`, before the route runs:
+    the route's other dependencies and its templates are never touched.
+
+    With `shared`, the page rendered by the route is also kept in `rendered_fragments`
+    and served to every browser requesting it until its ETag changes, without running
+    the route again.
+    """
+
+    async def check(request: Request, response: Response):
+        names = [name.format(**request.path_params) for name in versions]
+        values = []
+        if names:
+            values = await anyio.to_thread.run_sync(
+                request.app.state.storage.get_versions, names
+            )
+        digest = sha1(f"{TEMPLATES_VERSION} {request.url} {values}".encode())
+        headers = {"ETag": f'"{digest.hexdigest()}"', "Cache-Control": CACHE_CONTROL}
+        sent = request.headers.get("If-None-Match", "")
+        if sent.strip() == "*" or headers["ETag"] in [etag.strip() for etag in sent.split(",")]:
+            raise CachedResponse(Response(status_code=304, headers=headers))
+        if shared:
+            html = rendered_fragments.get(headers["ETag"])
+            if html is not None:
+                raise CachedResponse(HTMLResponse(html, headers=headers))
+            # Picked up by `template()` when the route renders the page
+            request.state.fragment_key = headers["ETag"]
+        response.headers.update(headers)
+
+    return check
+
+
+@pass_context
+def url_for(context: dict, name: str, **path_params: Any) -> str:
+    request = context["request"]
+    return request.url_for(name, **path_params)
+
+
+def build_jinja2() -> Environment:
+    """
+    Build the Jinja2 environment shared by all requests, so parsed templates stay
+    in its cache. You can define more functions, filters or global vars here
+    """
+    bytecode_cache = None
+    if TEMPLATES_CACHE:
+        Path(TEMPLATES_CACHE).mkdir(parents=True, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(TEMPLATES_CACHE)
+
+    env = Environment(
+        loader=PackageLoader("flashcards_htmx"),
+        autoescape=True,
+        auto_reload=False,
+        bytecode_cache=bytecode_cache,
+    )
     env.globals["url_for"] = url_for
+    env.globals["static_url"] = static_url
     env.globals["this_year"] = datetime.utcnow().year
-
     return env
 
 
+jinja2_env = build_jinja2()
+
+
+def templates_version() -> str:
+    """
+    Hash of the app's version, templates and static files (linked by their hash), part of
+    the ETags of the pages
+    """
+    digest = sha1(f"{__version__} {static_files.version}".encode())
+    for name in sorted(jinja2_env.list_templates()):
+        source, _, _ = jinja2_env.loader.get_source(jinja2_env, name)
+        digest.update(name.encode() + source.encode())
+    return digest.hexdigest()
+
+
+#: Changes with every release, and with any change to the templates or static files
+TEMPLATES_VERSION = templates_version()
+
+
+def get_jinja2() -> Environment:
+    """Get Jinja2 dependency function"""
+    return jinja2_env
+
+
 def template(tpl: str):
     """Get view render function using Jinja2 environment injected above"""
 
-    def func_view(request: Request, env: Environment = Depends(get_jinja2)):
-        template = env.get_template(tpl)
+    async def func_view(request: Request):
+        template = get_jinja2().get_template(tpl)
 
         def render(*args, **kwargs):
-            return template.render(request=request, *args, **kwargs)
+            html = template.render(request=request, *args, **kwargs)
+            key = getattr(request.state, "fragment_key", None)
+            if key is not None:
+                rendered_fragments.put(key, html)
+            return html
 
         return render
 
@@ -144,9 +284,7 @@ app = FastAPI(
     title="Flashcards HTMX webserver",
     description="API Docs for flashcards-htmx",
     version=__version__,
-)
-app.mount(
-    "/static", StaticFiles(directory=Path(__file__).parent / "static"), name="static"
+    lifespan=lifespan,
 )
 
 
@@ -159,12 +297,20 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     return HTMLResponse(response, status_code=exc.status_code)
 
 
+@app.exception_handler(CachedResponse)
+async def cached_response_handler(request: Request, exc: CachedResponse):
+    return exc.response
+
+
 from flashcards_htmx.api.public import router as public_router  # noqa: F401, E402
 from flashcards_htmx.api.private import router as private_router  # noqa: F401, E402
 from flashcards_htmx.api.study import router as study_router  # noqa: F401, E402
 from flashcards_htmx.api.decks import router as decks_router  # noqa: F401, E402
 from flashcards_htmx.api.cards import router as cards_router  # noqa: F401, E402
 from flashcards_htmx.api.schemas import router as schemas_router  # noqa: F401, E402
+from flashcards_htmx.api.search import router as search_router  # noqa: F401, E402
+from flashcards_htmx.api.bulk import router as bulk_router  # noqa: F401, E402
+from flashcards_htmx.api.static import router as static_router  # noqa: F401, E402
 
 app.include_router(public_router)
 app.include_router(private_router)
@@ -172,3 +318,6 @@ app.include_router(study_router)
 app.include_router(decks_router)
 app.include_router(cards_router)
 app.include_router(schemas_router)
+app.include_router(search_router)
+app.include_router(bulk_router)
+app.include_router(static_router)
@@ -5,3 +5,32 @@ DOMAIN = os.environ.get("FLASHCARDS_DOMAIN", "localhost")
 
 #: API server address
 API_SERVER = os.environ.get("FLASHCARDS_API_SERVER", "localhost:8001")
+
+#: Storage backend, one of `flashcards_htmx.storage.STORAGE_BACKENDS`.
+#: Only `sqlite` can be shared by several processes, like the workers of `uvicorn --workers`
+STORAGE = os.environ.get("FLASHCARDS_STORAGE", "sqlite")
+
+#: Path of the database file
+DATABASE = os.environ.get("FLASHCARDS_DATABASE", "flashcards.sqlite3")
+
+#: Folder where Jinja2 stores the compiled page templates across restarts (disabled if empty)
+TEMPLATES_CACHE = os.environ.get("FLASHCARDS_TEMPLATES_CACHE", "")
+
+#: Folder where the compressed static files are kept across restarts, instead of being compressed
+#: again at every startup (disabled if empty)
+STATIC_CACHE = os.environ.get("FLASHCARDS_STATIC_CACHE", "")
+
+#: Whether to compile all the page templates at startup instead of on their first request
+PRECOMPILE_TEMPLATES = os.environ.get("FLASHCARDS_PRECOMPILE_TEMPLATES", "") not in ("", "0")
+
+#: Path of the legacy shelve database, migrated into DATABASE when that is first created
+LEGACY_DATABASE = os.environ.get("FLASHCARDS_LEGACY_DATABASE", "flashcards.db")
+
+#: How many cards or decks are rendered per page of the infinite scroll lists
+PAGE_SIZE = int(os.environ.get("FLASHCARDS_PAGE_SIZE", 50))
+
+#: How many megabytes of rendered fragments each process keeps, see `flashcards_htmx.app.cached()`
+FRAGMENT_CACHE_SIZE = float(os.environ.get("FLASHCARDS_FRAGMENT_CACHE_SIZE", 32))
+
+#: How many threads run the routes that access the storage, so that it never blocks the event loop
+WORKER_THREADS = int(os.environ.get("FLASHCARDS_WORKER_THREADS", 16))
@@ -0,0 +1,38 @@
+"""
+Maintenance commands to run against the configured storage while the server is stopped.
+
+    python -m flashcards_htmx.maintenance recount-usage
+"""
+import argparse
+
+from flashcards_htmx.constants import STORAGE, DATABASE
+from flashcards_htmx.storage import STORAGE_BACKENDS
+
+
+def recount_usage(storage):
+    """Rebuilds the schema usage counters from the cards"""
+    storage.recount_usage()
+    for schema_id, count in storage.usage_by_schema().items():
+        print(f"{schema_id}: {count} cards")
+
+
+COMMANDS = {
+    "recount-usage": recount_usage,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args()
+
+    storage = STORAGE_BACKENDS[STORAGE](DATABASE)
+    storage.open()
+    try:
+        COMMANDS[args.command](storage)
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+from typing import Dict, Type
+
+from flashcards_htmx.storage.base import Storage, ReadOnlyStorage  # noqa: F401
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS  # noqa: F401
+from flashcards_htmx.storage.memory import MemoryStorage
+from flashcards_htmx.storage.shelf import ShelveStorage, migrate_from_shelve  # noqa: F401
+from flashcards_htmx.storage.sqlite import SQLiteStorage
+
+
+STORAGE_BACKENDS: Dict[str, Type[Storage]] = {
+    "memory": MemoryStorage,
+    "shelve": ShelveStorage,
+    "sqlite": SQLiteStorage,
+}
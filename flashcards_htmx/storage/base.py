@@ -0,0 +1,357 @@
+from typing import Any, ContextManager, Dict, Iterable, List, Optional, Tuple
+from abc import ABC, abstractmethod
+
+from flashcards_htmx.storage.indexes import ReviewIndex, ModelIndex
+
+
+#: Recall model of a card type: `(alpha, beta, t, last_review timestamp)`
+Model = Tuple[float, float, float, float]
+
+#: Entry of the review log: `(card_id, card_type, result, timestamp, latency in seconds)`
+LoggedReview = Tuple[str, str, str, float, Optional[float]]
+
+
+class Storage(ABC):
+    """
+    Interface every storage backend implements. Routers and algorithms only talk
+    to the storage through these methods, so backends can be swapped freely.
+
+    Decks are returned without their cards, cards with their `reviews` dict.
+    Returned records are copies: changing them has no effect on the storage.
+
+    Backends keep `review_index` and `model_index` up to date by calling the
+    `_card_written()`, `_card_deleted()`, `_deck_deleted()` and `_indexes_lost()`
+    hooks on every write. Backends shared by several processes also override
+    `_sync_indexes()`, called before each use of the indexes.
+
+    Backends also bump the counters of `get_versions()` on every write, so that the
+    pages can tell whether what they display changed without reading it.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.review_index = ReviewIndex(self.list_reviews, self._sync_indexes)
+        self.model_index = ModelIndex(
+            lambda deck_id: (self.list_reviews(deck_id), self.list_models(deck_id)),
+            self._sync_indexes,
+        )
+        self._indexes = [self.review_index, self.model_index]
+
+    def _card_written(self, deck_id: str, card_id: str, reviews: Dict[str, Optional[int]]):
+        for index in self._indexes:
+            index.update_card(deck_id, card_id, reviews)
+
+    def _card_deleted(self, deck_id: str, card_id: str):
+        for index in self._indexes:
+            index.remove_card(deck_id, card_id)
+
+    def _deck_deleted(self, deck_id: str):
+        for index in self._indexes:
+            index.forget(deck_id)
+
+    def _indexes_lost(self):
+        for index in self._indexes:
+            index.forget()
+
+    def _sync_indexes(self):
+        """Drops the indexes that other processes' writes made stale"""
+
+    @abstractmethod
+    def get_versions(self, names: List[str]) -> List[int]:
+        """
+        Returns the counters bumped by every write to what they're named after:
+
+        - `decks`: the decks' data, of any deck;
+        - `deck/<deck_id>`: the deck's data and its cards;
+        - `schemas`: the schemas, and the cards using them;
+        - `schema/<schema_id>`: the schema.
+
+        Reviews don't bump any counter. Counters are shared by all the processes using
+        the storage, and start from a random value, so that a counter that was lost
+        (with a storage that doesn't persist them) doesn't repeat its old values.
+        """
+
+    @abstractmethod
+    def open(self):
+        ...
+
+    @abstractmethod
+    def close(self):
+        ...
+
+    @abstractmethod
+    def transaction(self) -> ContextManager:
+        """
+        Groups all the writes done in the block into a single transaction.
+        Nested blocks join the outer transaction.
+        """
+
+    @abstractmethod
+    def savepoint(self) -> ContextManager:
+        """
+        Within a transaction: if the block raises, its writes are undone while the writes
+        done before it are kept, and the transaction can go on.
+        """
+
+    #
+    # Decks
+    #
+
+    @abstractmethod
+    def list_decks(self) -> Dict[str, Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def page_decks(
+        self, cursor: Optional[str] = None, limit: int = 50
+    ) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+        """
+        Returns up to `limit` decks in creation order, starting after `cursor`,
+        and the cursor of the next page (`None` on the last page).
+        """
+
+    @abstractmethod
+    def get_deck(self, deck_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def save_deck(self, deck_id: str, deck: Dict[str, Any]):
+        """Creates or updates the deck's data. Its cards, if any, are ignored."""
+
+    def import_deck(self, deck_id: str, deck: Dict[str, Any]):
+        """Saves the deck and all of its cards in one transaction."""
+        with self.transaction():
+            self.save_deck(deck_id, deck)
+            self.upsert_cards(deck_id, deck.get("cards", {}))
+
+    @abstractmethod
+    def delete_deck(self, deck_id: str):
+        """Deletes the deck with all its cards and reviews."""
+
+    @abstractmethod
+    def count_cards(self, deck_id: str) -> int:
+        ...
+
+    #
+    # Cards
+    #
+
+    @abstractmethod
+    def list_cards(self, deck_id: str) -> Dict[str, Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def page_cards(
+        self, deck_id: str, cursor: Optional[str] = None, limit: int = 50
+    ) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+        """
+        Returns up to `limit` cards of the deck in creation order, starting after
+        `cursor`, and the cursor of the next page (`None` on the last page).
+        """
+
+    @abstractmethod
+    def get_card(self, deck_id: str, card_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def upsert_card(self, deck_id: str, card_id: str, card: Dict[str, Any]):
+        """
+        Creates or replaces the card. The card types listed in `card["reviews"]`
+        are the only ones kept for the card.
+        """
+
+    @abstractmethod
+    def delete_card(self, deck_id: str, card_id: str):
+        ...
+
+    def upsert_cards(self, deck_id: str, cards: Dict[str, Dict[str, Any]]):
+        """Creates or replaces all the cards in one transaction, see `upsert_card()`."""
+        with self.transaction():
+            for card_id, card in cards.items():
+                self.upsert_card(deck_id, card_id, card)
+
+    def delete_cards(self, deck_id: str, card_ids: Iterable[str]):
+        """Deletes all the cards in one transaction."""
+        with self.transaction():
+            for card_id in card_ids:
+                self.delete_card(deck_id, card_id)
+
+    #
+    # Reviews
+    #
+
+    @abstractmethod
+    def list_reviews(self, deck_id: str) -> List[Tuple[str, str, Optional[int]]]:
+        """Returns `(card_id, card_type, score)` for every card type of the deck."""
+
+    @abstractmethod
+    def record_review(self, deck_id: str, card_id: str, card_type: str, score: Optional[int]):
+        ...
+
+    def lowest_score(self, deck_id: str) -> Optional[int]:
+        """
+        Returns the lowest score of the deck's card types (unreviewed ones count as 0), or
+        `None` if the deck has none. Unlike `review_index`, it accounts for the reviews
+        recorded by the current transaction.
+        """
+        return self.review_index.minimum(deck_id)
+
+    @abstractmethod
+    def list_models(self, deck_id: str) -> Dict[Tuple[str, str], Model]:
+        """Returns the recall models of the reviewed card types by `(card_id, card_type)`."""
+
+    @abstractmethod
+    def get_model(self, deck_id: str, card_id: str, card_type: str) -> Optional[Model]:
+        ...
+
+    @abstractmethod
+    def save_model(self, deck_id: str, card_id: str, card_type: str, model: Model):
+        ...
+
+    @abstractmethod
+    def log_review(
+        self,
+        deck_id: str,
+        card_id: str,
+        card_type: str,
+        result: str,
+        timestamp: float,
+        latency: Optional[float] = None,
+    ):
+        """
+        Appends a review to the deck's review log. Entries are never changed: they're
+        only deleted along with their card or deck.
+        """
+
+    @abstractmethod
+    def list_review_log(self, deck_id: str) -> List[LoggedReview]:
+        """Returns the deck's review log, oldest review first."""
+
+    @abstractmethod
+    def clear_reviews(self, deck_id: str):
+        """
+        Resets the scores and deletes the recall models of the deck's card types,
+        before they're rebuilt from the review log.
+        """
+
+    #
+    # Schemas
+    #
+
+    @abstractmethod
+    def list_schemas(self) -> Dict[str, Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def get_schema(self, schema_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def save_schema(self, schema_id: str, schema: Dict[str, Any]):
+        ...
+
+    @abstractmethod
+    def delete_schema(self, schema_id: str):
+        ...
+
+    @abstractmethod
+    def usage_by_schema(self) -> Dict[str, int]:
+        """
+        Returns how many cards use each schema, across all decks. Backends keep
+        these counters up to date on every card write instead of counting cards.
+        """
+
+    @abstractmethod
+    def recount_usage(self):
+        """Rebuilds the counters of `usage_by_schema()` by counting all the cards."""
+
+    #
+    # Search
+    #
+
+    @abstractmethod
+    def search(
+        self,
+        query: str,
+        deck_id: Optional[str] = None,
+        limit: Optional[int] = 50,
+        tags: List[str] = (),
+        schema_id: Optional[str] = None,
+    ) -> List[Tuple[str, Optional[str]]]:
+        """
+        Full-text search over the decks' names, descriptions and tags, and over the
+        cards' fields and tags. Returns `(deck_id, card_id)` for the matching cards
+        and `(deck_id, None)` for the matching decks. With `deck_id`, only the cards
+        of that deck are searched. With `limit=None`, all the matches are returned.
+
+        With `tags` and `schema_id`, only the decks and cards having all the tags, and
+        the cards of that schema, are returned: the filters are applied with the
+        secondary indexes of `filter_cards()` before the limit.
+
+        Backends keep their search index up to date on every deck and card write.
+        """
+
+    @abstractmethod
+    def filter_decks(self, tags: List[str], limit: Optional[int] = None) -> List[str]:
+        """
+        Returns the IDs of the decks having all the tags, looked up in a tag index.
+        """
+
+    @abstractmethod
+    def filter_cards(
+        self,
+        deck_id: Optional[str] = None,
+        tags: List[str] = (),
+        schema_id: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Tuple[str, str]]:
+        """
+        Returns `(deck_id, card_id)` for the cards having all the tags and the schema,
+        in the deck or in all decks. Tags and schemas are looked up in secondary
+        indexes and intersected, so the cost depends on the size of the results
+        and not on the number of cards.
+        """
+
+
+class ReadOnlyStorage:
+    """
+    Read-only view on a storage, given to the routes that only display data.
+
+    Reads go straight to the wrapped storage. Writes and transactions raise, so
+    displaying a page can never write back to the database: the records the
+    routes get are copies, and whatever they compute for the templates belongs
+    in per-request view models.
+    """
+
+    READS = {
+        "path",
+        "review_index",
+        "model_index",
+        "get_versions",
+        "list_decks",
+        "page_decks",
+        "get_deck",
+        "count_cards",
+        "list_cards",
+        "page_cards",
+        "get_card",
+        "list_reviews",
+        "lowest_score",
+        "list_models",
+        "get_model",
+        "list_review_log",
+        "list_schemas",
+        "get_schema",
+        "usage_by_schema",
+        "search",
+        "filter_decks",
+        "filter_cards",
+    }
+
+    def __init__(self, storage: Storage):
+        self._storage = storage
+
+    def __getattr__(self, name: str) -> Any:
+        if name not in self.READS:
+            raise PermissionError(f"'{name}' is not available on a read-only storage")
+        return getattr(self._storage, name)
@@ -0,0 +1,48 @@
+from textwrap import dedent
+from hashlib import md5
+
+
+#: Schemas every new database starts with
+DEFAULT_SCHEMAS = {
+    md5("Question & Answer".encode()).hexdigest(): {
+        "name": "Question & Answer",
+        "description": "Simple schema with a question and an answer.",
+
+        "form": dedent("""
+            <label for='question'>Question</label>
+            <input type='text' name='question' value='{{ question }}'>
+
+            <label for='answer'>Answer</label>
+            <input type='text' name='answer' value='{{ answer }}'>
+        """),
+        "preview": "{{ question }} -> {{ answer }}",
+        "cards": {
+            "card": {
+                "question": "{{ question }}",
+                "answer": "{{ answer }}",
+            }
+        }
+    },
+    md5("Question & Answer with reverse".encode()).hexdigest(): {
+        "name": "Question & Answer with reverse",
+        "description": "Generates two cards: question -> answer and answer -> question.",
+        "form": dedent("""
+            <label for='question'>Question:</label>
+            <input type='text' name='question' value='{{ question }}'>
+
+            <label for='answer'>Answer:</label>
+            <input type='text' name='answer'  value='{{ answer }}'>
+        """),
+        "preview": "{{ question }} <-> {{ answer }}",
+        "cards": {
+            "direct": {
+                "question": "{{ question }}",
+                "answer": "{{ answer }}",
+            },
+            "reverse": {
+                "question": "{{ answer }}",
+                "answer": "{{ question }}",
+            }
+        }
+    },
+}
@@ -0,0 +1,482 @@
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import re
+import random
+from abc import ABC, abstractmethod
+from heapq import heappush, heappop
+from bisect import bisect_left, bisect_right, insort
+from threading import RLock
+from contextlib import contextmanager
+
+import numpy as np
+
+from flashcards_htmx.ebisu import log_recall_norm
+
+
+#: How far the reviews can move from `ModelArrays.epoch`, in seconds, before it's moved
+EPOCH_DRIFT = 24 * 60 * 60
+
+
+class ScoreBuckets:
+    """
+    Card types of a deck grouped by review score (unreviewed card types count as 0).
+
+    A min-heap of the scores tracks the lowest one, and each bucket is a list with
+    a position map, so adding, moving and removing a card type is O(log n) at most
+    and picking a random card type among the lowest scores is O(1).
+    """
+
+    def __init__(self, reviews: List[Tuple[str, str, Optional[int]]] = ()):
+        self._buckets: Dict[int, List[Tuple[str, str]]] = {}
+        self._positions: Dict[Tuple[str, str], int] = {}
+        self._scores: Dict[Tuple[str, str], int] = {}
+        self._card_types: Dict[str, Set[str]] = {}
+        self._heap: List[int] = []
+        self._in_heap: Set[int] = set()
+        for card_id, card_type, score in reviews:
+            self.set(card_id, card_type, score)
+
+    def __len__(self):
+        return len(self._scores)
+
+    def set(self, card_id: str, card_type: str, score: Optional[int]):
+        self.remove(card_id, card_type)
+        key = (card_id, card_type)
+        score = score or 0
+        bucket = self._buckets.setdefault(score, [])
+        if score not in self._in_heap:
+            heappush(self._heap, score)
+            self._in_heap.add(score)
+        self._positions[key] = len(bucket)
+        bucket.append(key)
+        self._scores[key] = score
+        self._card_types.setdefault(card_id, set()).add(card_type)
+
+    def remove(self, card_id: str, card_type: str):
+        key = (card_id, card_type)
+        score = self._scores.pop(key, None)
+        if score is None:
+            return
+        bucket = self._buckets[score]
+        position = self._positions.pop(key)
+        last = bucket.pop()
+        if last != key:
+            bucket[position] = last
+            self._positions[last] = position
+        if not bucket:
+            del self._buckets[score]
+        self._card_types[card_id].discard(card_type)
+        if not self._card_types[card_id]:
+            del self._card_types[card_id]
+
+    def remove_card(self, card_id: str):
+        for card_type in list(self._card_types.get(card_id, ())):
+            self.remove(card_id, card_type)
+
+    def update_card(self, card_id: str, reviews: Dict[str, Optional[int]]):
+        self.remove_card(card_id)
+        for card_type, score in reviews.items():
+            self.set(card_id, card_type, score)
+
+    def minimum(self) -> Optional[int]:
+        while self._heap and self._heap[0] not in self._buckets:
+            self._in_heap.discard(heappop(self._heap))
+        return self._heap[0] if self._heap else None
+
+    def pick(self, max_score: int) -> Optional[Tuple[str, str]]:
+        """Uniformly picks a `(card_id, card_type)` among the ones scoring `max_score` or less"""
+        minimum = self.minimum()
+        if minimum is None:
+            return None
+        buckets = [
+            self._buckets[score]
+            for score in range(minimum, max_score + 1)
+            if score in self._buckets
+        ]
+        position = random.randrange(sum(len(bucket) for bucket in buckets))
+        for bucket in buckets:
+            if position < len(bucket):
+                return bucket[position]
+            position -= len(bucket)
+
+    def pick_among(self, card_ids: Iterable[str], from_minimum: int) -> Optional[Tuple[str, str]]:
+        """
+        Like `pick`, but only among the card types of the given cards, and with the
+        threshold relative to their lowest score. It's O(k) in the card types of the
+        given cards, as the buckets can't tell them apart from the others.
+        """
+        scores = {
+            (card_id, card_type): self._scores[(card_id, card_type)]
+            for card_id in card_ids
+            for card_type in self._card_types.get(card_id, ())
+        }
+        if not scores:
+            return None
+        threshold = min(scores.values()) + from_minimum
+        return random.choice([key for key, score in scores.items() if score <= threshold])
+
+
+class ModelArrays:
+    """
+    Recall models `(alpha, beta, t, last_review)` of the card types of a deck, stored
+    column by column in a NumPy array so that recall can be predicted for the whole
+    deck at once. Card types never reviewed have NaN models.
+
+    A fifth row holds the part of each model's predicted log recall that doesn't
+    depend on time, so that it's computed once per review instead of once per pick.
+
+    The models are also kept in float32, with `1 / t` instead of `t` and the last
+    review relative to `epoch`, so that the weakest ones are screened at float32
+    speed (see `ebisu.weakest`). The epoch follows the reviews, to keep the elapsed
+    times precise in float32.
+    """
+
+    def __init__(
+        self,
+        reviews: List[Tuple[str, str, Optional[int]]] = (),
+        models: Dict[Tuple[str, str], Tuple[float, float, float, float]] = None,
+    ):
+        models = models or {}
+        self.keys: List[Tuple[str, str]] = []
+        self._positions: Dict[Tuple[str, str], int] = {}
+        self._card_types: Dict[str, Set[str]] = {}
+        self._models = np.full((5, max(len(reviews), 16)), np.nan)
+        self._estimates = np.full(self._models.shape, np.nan, dtype=np.float32)
+        self.epoch = max((model[3] for model in models.values()), default=0.0)
+        for card_id, card_type, _ in reviews:
+            self.set(card_id, card_type, models.get((card_id, card_type)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def models(self) -> np.ndarray:
+        """View on the `alpha, beta, t, last_review, norm` rows, one column per card type"""
+        return self._models[:, : len(self.keys)]
+
+    @property
+    def estimates(self) -> np.ndarray:
+        """View on the float32 `alpha, beta, 1 / t, last_review - epoch, norm` rows"""
+        return self._estimates[:, : len(self.keys)]
+
+    def positions(self, card_ids: Iterable[str]) -> np.ndarray:
+        """Columns of the card types of the given cards, to restrict `models` and `keys`"""
+        return np.array(
+            [
+                self._positions[(card_id, card_type)]
+                for card_id in card_ids
+                for card_type in self._card_types.get(card_id, ())
+            ],
+            dtype=np.intp,
+        )
+
+    def set(self, card_id: str, card_type: str, model: Optional[Tuple[float, ...]]):
+        key = (card_id, card_type)
+        position = self._positions.get(key)
+        if position is None:
+            position = len(self.keys)
+            if position == self._models.shape[1]:
+                grown = np.full((5, position * 2), np.nan)
+                grown[:, :position] = self._models
+                self._models = grown
+                grown = np.full(grown.shape, np.nan, dtype=np.float32)
+                grown[:, :position] = self._estimates
+                self._estimates = grown
+            self.keys.append(key)
+            self._positions[key] = position
+            self._card_types.setdefault(card_id, set()).add(card_type)
+        if model is None:
+            self._models[:, position] = np.nan
+            self._estimates[:, position] = np.nan
+            return
+        alpha, beta, t, last_review = model
+        if last_review > self.epoch + EPOCH_DRIFT:
+            self.epoch = last_review
+            self._estimates[3] = self._models[3] - self.epoch
+        norm = log_recall_norm(alpha, beta)
+        self._models[:, position] = (alpha, beta, t, last_review, norm)
+        self._estimates[:, position] = (alpha, beta, 1 / t, last_review - self.epoch, norm)
+
+    def remove(self, card_id: str, card_type: str):
+        key = (card_id, card_type)
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        last = self.keys.pop()
+        if last != key:
+            self.keys[position] = last
+            self._positions[last] = position
+            self._models[:, position] = self._models[:, len(self.keys)]
+            self._estimates[:, position] = self._estimates[:, len(self.keys)]
+        self._models[:, len(self.keys)] = np.nan
+        self._estimates[:, len(self.keys)] = np.nan
+        self._card_types[card_id].discard(card_type)
+        if not self._card_types[card_id]:
+            del self._card_types[card_id]
+
+    def remove_card(self, card_id: str):
+        for card_type in list(self._card_types.get(card_id, ())):
+            self.remove(card_id, card_type)
+
+    def update_card(self, card_id: str, reviews: Dict[str, Optional[int]]):
+        for card_type in self._card_types.get(card_id, set()) - set(reviews):
+            self.remove(card_id, card_type)
+        for card_type in reviews:
+            if (card_id, card_type) not in self._positions:
+                self.set(card_id, card_type, None)
+
+
+class DeckIndex(ABC):
+    """
+    Keeps an in-memory structure for each deck, built from the storage the first
+    time the deck needs it and then updated by the storage on every write.
+
+    The storage is never read while holding the index lock, as the storage calls
+    the index while holding its own lock. `sync` is called before each use, so that
+    the storage can drop the indexes first if they're stale.
+    """
+
+    def __init__(self, load: Callable[[str], Any], sync: Callable[[], None] = lambda: None):
+        self._load = load
+        self._sync = sync
+        self._decks: Dict[str, Any] = {}
+        self._writes = 0
+        self._lock = RLock()
+
+    @abstractmethod
+    def _build(self, data: Any) -> Any:
+        """Builds the index of a deck from what `load` returned for it"""
+
+    def _deck(self, deck_id: str) -> Any:
+        self._sync()
+        with self._lock:
+            if deck_id in self._decks:
+                return self._decks[deck_id]
+            writes = self._writes
+        index = self._build(self._load(deck_id))
+        with self._lock:
+            # Keep it only if no write happened while loading, or it might be stale
+            if writes == self._writes:
+                self._decks[deck_id] = index
+        return index
+
+    @contextmanager
+    def deck(self, deck_id: str) -> Iterator[Any]:
+        index = self._deck(deck_id)
+        with self._lock:
+            yield index
+
+    def _write(self, deck_id: str, function: Callable[[Any], None]):
+        with self._lock:
+            self._writes += 1
+            if deck_id in self._decks:
+                function(self._decks[deck_id])
+
+    def update_card(self, deck_id: str, card_id: str, reviews: Dict[str, Optional[int]]):
+        self._write(deck_id, lambda index: index.update_card(card_id, reviews))
+
+    def remove_card(self, deck_id: str, card_id: str):
+        self._write(deck_id, lambda index: index.remove_card(card_id))
+
+    def forget(self, deck_id: Optional[str] = None):
+        """Drops the index of the deck, or of all decks: it's rebuilt on the next use"""
+        with self._lock:
+            self._writes += 1
+            if deck_id is None:
+                self._decks.clear()
+            else:
+                self._decks.pop(deck_id, None)
+
+
+class ReviewIndex(DeckIndex):
+    """Review scores of each deck's card types, see `ScoreBuckets`"""
+
+    def _build(self, reviews: List[Tuple[str, str, Optional[int]]]) -> ScoreBuckets:
+        return ScoreBuckets(reviews)
+
+    def minimum(self, deck_id: str) -> Optional[int]:
+        with self.deck(deck_id) as buckets:
+            return buckets.minimum()
+
+    def pick(self, deck_id: str, max_score: int) -> Optional[Tuple[str, str]]:
+        with self.deck(deck_id) as buckets:
+            return buckets.pick(max_score)
+
+    def pick_among(
+        self, deck_id: str, card_ids: Iterable[str], from_minimum: int
+    ) -> Optional[Tuple[str, str]]:
+        with self.deck(deck_id) as buckets:
+            return buckets.pick_among(card_ids, from_minimum)
+
+    def update(self, deck_id: str, card_id: str, card_type: str, score: Optional[int]):
+        self._write(deck_id, lambda buckets: buckets.set(card_id, card_type, score))
+
+
+class ModelIndex(DeckIndex):
+    """Recall models of each deck's card types, see `ModelArrays`"""
+
+    def _build(self, data) -> ModelArrays:
+        reviews, models = data
+        return ModelArrays(reviews, models)
+
+    def update(
+        self, deck_id: str, card_id: str, card_type: str, model: Tuple[float, float, float, float]
+    ):
+        self._write(deck_id, lambda arrays: arrays.set(card_id, card_type, model))
+
+
+class KeyOrder:
+    """
+    Creation order of the keys of a dict, for keyset pagination. Every key gets an
+    increasing sequence number, like the `seq` of the SQLite storage's decks and cards,
+    and cursors are sequence numbers: pages stay consistent while keys are added and
+    removed.
+
+    The sequence numbers live only in memory, so cursors are valid until the
+    storage is opened again.
+    """
+
+    def __init__(self, keys: List[str] = ()):
+        self._keys: List[str] = list(keys)
+        self._sequences: List[int] = list(range(len(self._keys)))
+        self._sequence_of: Dict[str, int] = dict(zip(self._keys, self._sequences))
+        self._next = len(self._keys)
+
+    def add(self, key: str):
+        if key not in self._sequence_of:
+            self._keys.append(key)
+            self._sequences.append(self._next)
+            self._sequence_of[key] = self._next
+            self._next += 1
+
+    def remove(self, key: str):
+        sequence = self._sequence_of.pop(key, None)
+        if sequence is not None:
+            position = bisect_left(self._sequences, sequence)
+            del self._keys[position]
+            del self._sequences[position]
+
+    def page(self, cursor: Optional[str], limit: int) -> Tuple[List[str], Optional[str]]:
+        """Returns the keys after the cursor, and the cursor of the next page if any"""
+        start = bisect_right(self._sequences, int(cursor)) if cursor else 0
+        end = start + limit
+        next_cursor = str(self._sequences[end - 1]) if end < len(self._keys) else None
+        return self._keys[start:end], next_cursor
+
+
+#: Record keys that hold no user content: they're left out of the search index
+NOT_SEARCHED = {
+    "schema",
+    "reviews",
+    "algorithm",
+    "preview",
+    "rendered_question",
+    "rendered_answer",
+}
+
+
+def searchable_text(record: Dict[str, Any]) -> str:
+    """The user content of a deck or card (fields, tags, name, description) as one string"""
+    parts = []
+    for key, value in record.items():
+        if key in NOT_SEARCHED:
+            continue
+        if isinstance(value, str):
+            parts.append(value)
+        elif isinstance(value, (list, tuple)):
+            parts.extend(item for item in value if isinstance(item, str))
+    return " ".join(parts)
+
+
+def tags_of(record: Dict[str, Any]) -> List[str]:
+    """The record's tags, whether stored as a list or as a comma-separated string"""
+    tags = record.get("tags") or []
+    if isinstance(tags, str):
+        tags = tags.split(",")
+    return [tag.strip() for tag in tags if tag.strip()]
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.casefold())
+
+
+class TextIndex:
+    """
+    In-process inverted index: each token maps to the set of keys of the records
+    containing it. A query matches the records containing all of its tokens, the
+    last one as a prefix (so results follow what's being typed), found by bisecting
+    the sorted vocabulary.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[Any]] = {}
+        self._tokens: Dict[Any, Set[str]] = {}
+        self._vocabulary: List[str] = []
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def add(self, key: Any, text: str):
+        self.remove(key)
+        tokens = set(tokenize(text))
+        self._tokens[key] = tokens
+        for token in tokens:
+            if token not in self._postings:
+                self._postings[token] = set()
+                insort(self._vocabulary, token)
+            self._postings[token].add(key)
+
+    def remove(self, key: Any):
+        for token in self._tokens.pop(key, ()):
+            postings = self._postings[token]
+            postings.discard(key)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect_left(self._vocabulary, token)]
+
+    def _prefixed(self, prefix: str) -> Set[Any]:
+        keys: Set[Any] = set()
+        position = bisect_left(self._vocabulary, prefix)
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(prefix):
+            keys |= self._postings[self._vocabulary[position]]
+            position += 1
+        return keys
+
+    def search(self, query: str) -> Set[Any]:
+        """Returns the keys of all the records matching the query"""
+        tokens = tokenize(query)
+        if not tokens:
+            return set()
+        matches = [self._postings.get(token, set()) for token in tokens[:-1]]
+        matches.append(self._prefixed(tokens[-1]))
+        matches.sort(key=len)
+        return set.intersection(*matches)
+
+
+class SetIndex:
+    """
+    Secondary index from values (like tags or schemas) to the set of keys of the
+    records having them. Queries intersect the sets of all the requested values,
+    starting from the smallest one.
+    """
+
+    def __init__(self):
+        self._keys: Dict[str, Set[Any]] = {}
+        self._values: Dict[Any, Set[str]] = {}
+
+    def set(self, key: Any, values: List[str]):
+        self.remove(key)
+        self._values[key] = set(values)
+        for value in self._values[key]:
+            self._keys.setdefault(value, set()).add(key)
+
+    def remove(self, key: Any):
+        for value in self._values.pop(key, ()):
+            keys = self._keys[value]
+            keys.discard(key)
+            if not keys:
+                del self._keys[value]
+
+    def search(self, values: List[str]) -> Set[Any]:
+        """Returns the keys of the records having all the values"""
+        matches = sorted((self._keys.get(value, set()) for value in values), key=len)
+        return set.intersection(*matches) if matches else set()
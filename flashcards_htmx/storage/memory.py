@@ -0,0 +1,486 @@
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
+from copy import deepcopy
+from random import randrange
+from heapq import nsmallest
+from threading import RLock
+from contextlib import contextmanager
+
+from flashcards_htmx.storage.base import Storage, Model, LoggedReview
+from flashcards_htmx.storage.indexes import (
+    KeyOrder,
+    SetIndex,
+    TextIndex,
+    searchable_text,
+    tags_of,
+)
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS
+
+
+#: Journaled value of the keys that didn't exist
+_MISSING = object()
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps everything in plain dictionaries, nothing is persisted.
+    Subclasses can persist the data by overriding `_flush()`, which is called
+    when the outermost transaction exits, with the sections of `_data` it changed.
+
+    Writes are applied right away: to undo them when a transaction or savepoint
+    fails, each write first journals the value it replaces, and the section of
+    `_data` it's in, with `_journal()`.
+    Values replaced as a whole are journaled by reference, without a copy, so the
+    writes must journal the values they change in place at the finest level.
+
+    Reads take the lock too: routes run in a thread pool, and iterating over a dict
+    while another thread writes to it fails.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        super().__init__(path)
+        self._data: Dict[str, Any] = {}
+        self._lock = RLock()
+        self._depth = 0
+        self._orders: Dict[Optional[str], KeyOrder] = {}
+        self._text_index: Optional[TextIndex] = None
+        self._filter_indexes: Dict[str, SetIndex] = {}
+        #: `(container, key, value replaced)`, or `(list, None, length)` for appends
+        self._undo_log: List[Tuple[Union[dict, list], Any, Any]] = []
+        self._journaled: Set[Tuple[int, Any]] = set()
+        #: Sections of `_data` written by the current transaction
+        self._changed: Set[str] = set()
+
+    def open(self):
+        self._orders = {}
+        self._text_index = None
+        self._data = {
+            "decks": {},
+            "schemas": deepcopy(DEFAULT_SCHEMAS),
+            "models": {},
+            "usage": {},
+            "log": {},
+            "versions": {},
+        }
+
+    def close(self):
+        pass
+
+    @contextmanager
+    def transaction(self) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self._data
+            except BaseException:
+                if self._depth == 1:
+                    self._undo()
+                raise
+            finally:
+                self._depth -= 1
+            if not self._depth:
+                self._undo_log.clear()
+                self._journaled.clear()
+                changed, self._changed = self._changed, set()
+                self._flush(changed)
+
+    @contextmanager
+    def savepoint(self) -> Iterator[Dict[str, Any]]:
+        with self.transaction() as data:
+            start = len(self._undo_log)
+            try:
+                yield data
+            except BaseException:
+                self._undo(start)
+                raise
+
+    def _journal(self, section: str, container: Union[dict, list], key: Any = None):
+        """
+        Saves the value at `container[key]` before it's replaced or deleted, or the length
+        of the `container` list before it's appended to. Only the first write of each
+        transaction is journaled: that's the value to restore. `section` is the key of
+        `_data` holding the container.
+        """
+        self._changed.add(section)
+        marker = (id(container), key)
+        if marker in self._journaled:
+            return
+        self._journaled.add(marker)
+        if isinstance(container, list):
+            self._undo_log.append((container, None, len(container)))
+        else:
+            self._undo_log.append((container, key, container.get(key, _MISSING)))
+
+    def _undo(self, start: int = 0):
+        """Restores the values journaled since the `start` entry of the undo log"""
+        if not start:
+            self._changed.clear()
+        while len(self._undo_log) > start:
+            container, key, value = self._undo_log.pop()
+            self._journaled.discard((id(container), key))
+            if isinstance(container, list):
+                del container[value:]
+            elif value is _MISSING:
+                container.pop(key, None)
+            else:
+                container[key] = value
+        # The structures derived from the data are rebuilt on their next use
+        self._orders = {}
+        self._text_index = None
+        self._indexes_lost()
+
+    def _flush(self, changed: Set[str]):
+        pass
+
+    def get_versions(self, names: List[str]) -> List[int]:
+        with self._lock:
+            return [self._data["versions"].get(name, 0) for name in names]
+
+    def _touch(self, *names: str):
+        """Bumps the counters of `get_versions()`"""
+        versions = self._data["versions"]
+        for name in names:
+            self._journal("versions", versions, name)
+            versions[name] = versions.get(name, randrange(2 ** 31)) + 1
+
+    def _order(self, deck_id: Optional[str] = None) -> KeyOrder:
+        """Creation order of the decks, or of the cards of the deck"""
+        with self._lock:
+            if deck_id not in self._orders:
+                if deck_id is None:
+                    keys = self._data["decks"]
+                else:
+                    keys = self._data["decks"].get(deck_id, {}).get("cards", {})
+                self._orders[deck_id] = KeyOrder(keys)
+            return self._orders[deck_id]
+
+    #
+    # Decks
+    #
+
+    def list_decks(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {deck_id: self.get_deck(deck_id) for deck_id in self._data["decks"]}
+
+    def page_decks(
+        self, cursor: Optional[str] = None, limit: int = 50
+    ) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+        with self._lock:
+            deck_ids, next_cursor = self._order().page(cursor, limit)
+            return {deck_id: self.get_deck(deck_id) for deck_id in deck_ids}, next_cursor
+
+    def get_deck(self, deck_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            deck = self._data["decks"].get(deck_id)
+            if deck is None:
+                return None
+            return {key: value for key, value in deck.items() if key != "cards"}
+
+    def save_deck(self, deck_id: str, deck: Dict[str, Any]):
+        with self.transaction() as db:
+            cards = db["decks"].get(deck_id, {}).get("cards", {})
+            self._journal("decks", db["decks"], deck_id)
+            db["decks"][deck_id] = {**deepcopy(deck), "cards": cards}
+            self._order().add(deck_id)
+            self._index((deck_id, ""), deck)
+            self._touch("decks", f"deck/{deck_id}")
+
+    def delete_deck(self, deck_id: str):
+        with self.transaction() as db:
+            for section in ("decks", "models", "log"):
+                self._journal(section, db[section], deck_id)
+            deck = db["decks"].pop(deck_id, None)
+            self._order().remove(deck_id)
+            self._orders.pop(deck_id, None)
+            self._index((deck_id, ""))
+            for card_id in (deck or {}).get("cards", {}):
+                self._index((deck_id, card_id))
+            for card in (deck or {}).get("cards", {}).values():
+                self._count_usage(card["schema"], -1)
+            db["models"].pop(deck_id, None)
+            db["log"].pop(deck_id, None)
+            self._deck_deleted(deck_id)
+            self._touch("decks", f"deck/{deck_id}", "schemas")
+
+    def count_cards(self, deck_id: str) -> int:
+        with self._lock:
+            return len(self._data["decks"].get(deck_id, {}).get("cards", {}))
+
+    #
+    # Cards
+    #
+
+    def list_cards(self, deck_id: str) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            cards = self._data["decks"].get(deck_id, {}).get("cards", {})
+            return {card_id: self.get_card(deck_id, card_id) for card_id in cards}
+
+    def page_cards(
+        self, deck_id: str, cursor: Optional[str] = None, limit: int = 50
+    ) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+        with self._lock:
+            card_ids, next_cursor = self._order(deck_id).page(cursor, limit)
+            cards = {card_id: self.get_card(deck_id, card_id) for card_id in card_ids}
+            return cards, next_cursor
+
+    def get_card(self, deck_id: str, card_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            card = self._data["decks"].get(deck_id, {}).get("cards", {}).get(card_id)
+            if card is None:
+                return None
+            return {**card, "reviews": dict(card.get("reviews", {}))}
+
+    def upsert_card(self, deck_id: str, card_id: str, card: Dict[str, Any]):
+        with self.transaction() as db:
+            previous = db["decks"][deck_id]["cards"].get(card_id)
+            if previous:
+                self._count_usage(previous["schema"], -1)
+            else:
+                self._order(deck_id).add(card_id)
+            self._index((deck_id, card_id), card)
+            self._count_usage(card["schema"], 1)
+            self._journal("decks", db["decks"][deck_id]["cards"], card_id)
+            db["decks"][deck_id]["cards"][card_id] = {
+                **deepcopy(card),
+                "reviews": dict(card.get("reviews", {})),
+            }
+            models = db["models"].get(deck_id, {}).get(card_id, {})
+            for card_type in set(models) - set(card.get("reviews", {})):
+                self._journal("models", models, card_type)
+                del models[card_type]
+            self._card_written(deck_id, card_id, card.get("reviews", {}))
+            self._touch(f"deck/{deck_id}", "schemas")
+
+    def delete_card(self, deck_id: str, card_id: str):
+        with self.transaction() as db:
+            self._journal("decks", db["decks"][deck_id]["cards"], card_id)
+            card = db["decks"][deck_id]["cards"].pop(card_id, None)
+            if card:
+                self._count_usage(card["schema"], -1)
+                self._order(deck_id).remove(card_id)
+                self._index((deck_id, card_id))
+            if deck_id in db["models"]:
+                self._journal("models", db["models"][deck_id], card_id)
+                db["models"][deck_id].pop(card_id, None)
+            if db["log"].get(deck_id):
+                self._journal("log", db["log"], deck_id)
+                db["log"][deck_id] = [
+                    review for review in db["log"][deck_id] if review[0] != card_id
+                ]
+            self._card_deleted(deck_id, card_id)
+            self._touch(f"deck/{deck_id}", "schemas")
+
+    #
+    # Reviews
+    #
+
+    def list_reviews(self, deck_id: str) -> List[Tuple[str, str, Optional[int]]]:
+        with self._lock:
+            cards = self._data["decks"].get(deck_id, {}).get("cards", {})
+            return [
+                (card_id, card_type, score)
+                for card_id, card in cards.items()
+                for card_type, score in card.get("reviews", {}).items()
+            ]
+
+    def record_review(self, deck_id: str, card_id: str, card_type: str, score: Optional[int]):
+        with self.transaction() as db:
+            reviews = db["decks"][deck_id]["cards"][card_id].setdefault("reviews", {})
+            self._journal("decks", reviews, card_type)
+            reviews[card_type] = score
+            self.review_index.update(deck_id, card_id, card_type, score)
+
+    def list_models(self, deck_id: str) -> Dict[Tuple[str, str], Model]:
+        with self._lock:
+            return {
+                (card_id, card_type): tuple(model)
+                for card_id, models in self._data["models"].get(deck_id, {}).items()
+                for card_type, model in models.items()
+            }
+
+    def get_model(self, deck_id: str, card_id: str, card_type: str) -> Optional[Model]:
+        with self._lock:
+            model = self._data["models"].get(deck_id, {}).get(card_id, {}).get(card_type)
+        return tuple(model) if model is not None else None
+
+    def save_model(self, deck_id: str, card_id: str, card_type: str, model: Model):
+        with self.transaction() as db:
+            models = db["models"].setdefault(deck_id, {}).setdefault(card_id, {})
+            self._journal("models", models, card_type)
+            models[card_type] = tuple(model)
+            self.model_index.update(deck_id, card_id, card_type, model)
+
+    def log_review(
+        self,
+        deck_id: str,
+        card_id: str,
+        card_type: str,
+        result: str,
+        timestamp: float,
+        latency: Optional[float] = None,
+    ):
+        with self.transaction() as db:
+            log = db["log"].setdefault(deck_id, [])
+            self._journal("log", log)
+            log.append(
+                (card_id, card_type, result, timestamp, latency)
+            )
+
+    def list_review_log(self, deck_id: str) -> List[LoggedReview]:
+        with self._lock:
+            return list(self._data["log"].get(deck_id, []))
+
+    def clear_reviews(self, deck_id: str):
+        with self.transaction() as db:
+            for card in db["decks"].get(deck_id, {}).get("cards", {}).values():
+                self._journal("decks", card, "reviews")
+                card["reviews"] = dict.fromkeys(card.get("reviews", {}))
+            self._journal("models", db["models"], deck_id)
+            db["models"].pop(deck_id, None)
+            # Rebuilt from the storage on their next use
+            self._deck_deleted(deck_id)
+
+    #
+    # Schemas
+    #
+
+    def list_schemas(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                schema_id: self.get_schema(schema_id) for schema_id in self._data["schemas"]
+            }
+
+    def get_schema(self, schema_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            schema = self._data["schemas"].get(schema_id)
+            return deepcopy(schema) if schema is not None else None
+
+    def save_schema(self, schema_id: str, schema: Dict[str, Any]):
+        with self.transaction() as db:
+            self._journal("schemas", db["schemas"], schema_id)
+            db["schemas"][schema_id] = deepcopy(schema)
+            self._touch("schemas", f"schema/{schema_id}")
+
+    def delete_schema(self, schema_id: str):
+        with self.transaction() as db:
+            self._journal("schemas", db["schemas"], schema_id)
+            db["schemas"].pop(schema_id, None)
+            self._touch("schemas", f"schema/{schema_id}")
+
+    def usage_by_schema(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._data["usage"])
+
+    def _count_usage(self, schema_id: str, change: int):
+        usage = self._data["usage"]
+        self._journal("usage", usage, schema_id)
+        usage[schema_id] = usage.get(schema_id, 0) + change
+        if not usage[schema_id]:
+            del usage[schema_id]
+
+    def recount_usage(self):
+        with self.transaction() as db:
+            self._journal("usage", db, "usage")
+            db["usage"] = {}
+            for deck in db["decks"].values():
+                for card in deck["cards"].values():
+                    self._count_usage(card["schema"], 1)
+            self._touch("schemas")
+
+    #
+    # Search
+    #
+
+    def _index(self, key: Tuple[str, str], record: Optional[Dict[str, Any]] = None):
+        """
+        Updates the search and filter indexes, if built, with the record (or its
+        removal). Decks are indexed with an empty card ID.
+        """
+        if self._text_index is None:
+            return
+        if record is None:
+            self._text_index.remove(key)
+            for index in self._filter_indexes.values():
+                index.remove(key)
+            return
+        self._text_index.add(key, searchable_text(record))
+        if key[1]:
+            self._filter_indexes["card_tags"].set(key, tags_of(record))
+            self._filter_indexes["card_schemas"].set(key, [record["schema"]])
+        else:
+            self._filter_indexes["deck_tags"].set(key, tags_of(record))
+
+    def _build_indexes(self):
+        """Builds the search and filter indexes on first use: they're then kept up to date"""
+        with self._lock:
+            if self._text_index is not None:
+                return
+            self._text_index = TextIndex()
+            self._filter_indexes = {
+                "deck_tags": SetIndex(),
+                "card_tags": SetIndex(),
+                "card_schemas": SetIndex(),
+            }
+            for deck_id, deck in self._data["decks"].items():
+                self._index((deck_id, ""), deck)
+                for card_id, card in deck["cards"].items():
+                    self._index((deck_id, card_id), card)
+
+    def search(
+        self,
+        query: str,
+        deck_id: Optional[str] = None,
+        limit: Optional[int] = 50,
+        tags: List[str] = (),
+        schema_id: Optional[str] = None,
+    ) -> List[Tuple[str, Optional[str]]]:
+        self._build_indexes()
+        with self._lock:
+            keys = self._text_index.search(query)
+            if tags or schema_id:
+                # Decks have no schema: they never match a schema filter
+                decks = self._filter_indexes["deck_tags"].search(tags) if not schema_id else set()
+                matches = [self._filter_indexes["card_tags"].search(tags)] if tags else []
+                if schema_id:
+                    matches.append(self._filter_indexes["card_schemas"].search([schema_id]))
+                keys &= decks | set.intersection(*matches)
+        if deck_id is not None:
+            keys = {key for key in keys if key[0] == deck_id and key[1]}
+        keys = nsmallest(limit, keys) if limit is not None else sorted(keys)
+        return [(key[0], key[1] or None) for key in keys]
+
+    def filter_decks(self, tags: List[str], limit: Optional[int] = None) -> List[str]:
+        self._build_indexes()
+        with self._lock:
+            if tags:
+                keys = self._filter_indexes["deck_tags"].search(tags)
+            else:
+                keys = {(deck_id, "") for deck_id in self._data["decks"]}
+        keys = nsmallest(limit, keys) if limit is not None else sorted(keys)
+        return [deck_id for deck_id, _ in keys]
+
+    def filter_cards(
+        self,
+        deck_id: Optional[str] = None,
+        tags: List[str] = (),
+        schema_id: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Tuple[str, str]]:
+        self._build_indexes()
+        with self._lock:
+            matches = []
+            if tags:
+                matches.append(self._filter_indexes["card_tags"].search(tags))
+            if schema_id:
+                matches.append(self._filter_indexes["card_schemas"].search([schema_id]))
+            if matches:
+                keys = set.intersection(*sorted(matches, key=len))
+                if deck_id is not None:
+                    keys = {key for key in keys if key[0] == deck_id}
+            else:
+                decks = [deck_id] if deck_id is not None else list(self._data["decks"])
+                keys = {
+                    (card_deck_id, card_id)
+                    for card_deck_id in decks
+                    for card_id in self._data["decks"].get(card_deck_id, {}).get("cards", {})
+                }
+        return nsmallest(limit, keys) if limit is not None else sorted(keys)
@@ -0,0 +1,101 @@
+from typing import Set
+import shelve
+from copy import deepcopy
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from flashcards_htmx.storage.base import Storage
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS
+from flashcards_htmx.storage.memory import MemoryStorage
+
+
+class ShelveStorage(MemoryStorage):
+    """
+    Long-lived handle on the shelve file.
+
+    The file is opened once at startup and its content is unpickled only then:
+    reads are served from memory, while writes are serialized by a lock and
+    flushed to disk when the outermost `transaction()` block exits. Only the
+    sections the transaction changed are pickled again.
+
+    Each process would overwrite the others' writes with its own copy of the data,
+    so the file is locked while open: run several workers with the SQLite storage.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._shelf = None
+        self._lock_file = None
+
+    def _lock_shelf(self):
+        if fcntl is None:
+            return
+        self._lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(
+                f"{self.path} is open in another process: the shelve storage supports a "
+                "single process, use the sqlite storage to run several workers"
+            )
+
+    def open(self):
+        self._lock_shelf()
+        self._shelf = shelve.open(self.path)
+        self._orders = {}
+        self._text_index = None
+        self._data = {
+            "decks": self._shelf.get("decks", {}),
+            "schemas": self._shelf.get("schemas", deepcopy(DEFAULT_SCHEMAS)),
+            "models": self._shelf.get("models", {}),
+            "usage": self._shelf.get("usage", {}),
+            "log": self._shelf.get("log", {}),
+            "versions": self._shelf.get("versions", {}),
+        }
+        with self.transaction():
+            self._changed.update(key for key in self._data if key not in self._shelf)
+            if "usage" not in self._shelf:
+                self.recount_usage()
+
+    def close(self):
+        if self._shelf is not None:
+            self._shelf.close()
+            self._shelf = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _flush(self, changed: Set[str]):
+        for key in changed:
+            self._shelf[key] = self._data[key]
+        self._shelf.sync()
+
+
+def migrate_from_shelve(shelve_path: str, storage: Storage):
+    """
+    One-shot copy of a legacy shelve database (the old `flashcards.db`) into
+    another storage. Everything is written in a single transaction. The view-only fields the old
+    routes used to save along with the records are dropped.
+    """
+    with shelve.open(shelve_path, flag="r") as legacy:
+        with storage.transaction():
+            for schema_id, schema in legacy.get("schemas", {}).items():
+                schema = {
+                    key: value for key, value in schema.items()
+                    if key not in ("usage", "rendered_form")
+                }
+                storage.save_schema(schema_id, schema)
+            for deck_id, deck in legacy.get("decks", {}).items():
+                cards = {
+                    card_id: {
+                        key: value for key, value in card.items()
+                        if key not in ("schema_name", "preview")
+                    }
+                    for card_id, card in deck.get("cards", {}).items()
+                }
+                storage.import_deck(deck_id, {**deck, "cards": cards})
@@ -0,0 +1,754 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+import json
+import sqlite3
+from threading import RLock, get_ident
+from contextlib import contextmanager
+
+from flashcards_htmx.storage.base import Storage, Model, LoggedReview
+from flashcards_htmx.storage.indexes import searchable_text, tags_of, tokenize
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS
+
+
+#: How many seconds a write waits for the ones of other processes before failing
+BUSY_TIMEOUT = 30
+
+TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS schemas (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS decks (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        id TEXT NOT NULL UNIQUE,
+        data TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cards (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        deck_id TEXT NOT NULL REFERENCES decks(id) ON DELETE CASCADE,
+        id TEXT NOT NULL,
+        schema TEXT NOT NULL,
+        data TEXT NOT NULL,
+        UNIQUE (deck_id, id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS cards_by_schema ON cards(schema)",
+    "CREATE INDEX IF NOT EXISTS cards_by_deck ON cards(deck_id)",
+    """
+    CREATE TABLE IF NOT EXISTS reviews (
+        deck_id TEXT NOT NULL,
+        card_id TEXT NOT NULL,
+        card_type TEXT NOT NULL,
+        score INTEGER,
+        PRIMARY KEY (deck_id, card_id, card_type),
+        FOREIGN KEY (deck_id, card_id) REFERENCES cards(deck_id, id) ON DELETE CASCADE
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS reviews_by_score ON reviews(deck_id, score)",
+    """
+    CREATE TABLE IF NOT EXISTS models (
+        deck_id TEXT NOT NULL,
+        card_id TEXT NOT NULL,
+        card_type TEXT NOT NULL,
+        alpha REAL NOT NULL,
+        beta REAL NOT NULL,
+        t REAL NOT NULL,
+        last_review REAL NOT NULL,
+        PRIMARY KEY (deck_id, card_id, card_type),
+        FOREIGN KEY (deck_id, card_id) REFERENCES cards(deck_id, id) ON DELETE CASCADE
+    )
+    """,
+    # Append-only: rows are only deleted along with their card
+    """
+    CREATE TABLE IF NOT EXISTS review_log (
+        deck_id TEXT NOT NULL,
+        card_id TEXT NOT NULL,
+        card_type TEXT NOT NULL,
+        result TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        latency REAL,
+        FOREIGN KEY (deck_id, card_id) REFERENCES cards(deck_id, id) ON DELETE CASCADE
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS review_log_by_card ON review_log(deck_id, card_id)",
+    """
+    CREATE TABLE IF NOT EXISTS schema_usage (
+        schema TEXT PRIMARY KEY,
+        cards INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS count_inserted_card AFTER INSERT ON cards
+    BEGIN
+        INSERT INTO schema_usage (schema, cards) VALUES (new.schema, 1)
+        ON CONFLICT (schema) DO UPDATE SET cards = cards + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS count_deleted_card AFTER DELETE ON cards
+    BEGIN
+        UPDATE schema_usage SET cards = cards - 1 WHERE schema = old.schema;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS count_updated_card AFTER UPDATE OF schema ON cards
+    WHEN old.schema != new.schema
+    BEGIN
+        UPDATE schema_usage SET cards = cards - 1 WHERE schema = old.schema;
+        INSERT INTO schema_usage (schema, cards) VALUES (new.schema, 1)
+        ON CONFLICT (schema) DO UPDATE SET cards = cards + 1;
+    END
+    """,
+    # Counters of `get_versions()`, bumped once by each transaction that wrote what
+    # they're named after
+    """
+    CREATE TABLE IF NOT EXISTS versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )
+    """,
+    # Tag indexes
+    """
+    CREATE TABLE IF NOT EXISTS deck_tags (
+        deck_id TEXT NOT NULL REFERENCES decks(id) ON DELETE CASCADE,
+        tag TEXT NOT NULL,
+        PRIMARY KEY (tag, deck_id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS deck_tags_by_deck ON deck_tags(deck_id)",
+    """
+    CREATE TABLE IF NOT EXISTS card_tags (
+        deck_id TEXT NOT NULL,
+        card_id TEXT NOT NULL,
+        tag TEXT NOT NULL,
+        PRIMARY KEY (tag, deck_id, card_id),
+        FOREIGN KEY (deck_id, card_id) REFERENCES cards(deck_id, id) ON DELETE CASCADE
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS card_tags_by_card ON card_tags(deck_id, card_id)",
+    "CREATE INDEX IF NOT EXISTS cards_by_schema_and_deck ON cards(schema, deck_id)",
+    # Full-text indexes: the rowid of each row is the `seq` of the deck or card it indexes
+    "CREATE VIRTUAL TABLE IF NOT EXISTS decks_search USING fts5(content)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS cards_search USING fts5(content)",
+    """
+    CREATE TRIGGER IF NOT EXISTS unindex_deleted_deck AFTER DELETE ON decks
+    BEGIN
+        DELETE FROM decks_search WHERE rowid = old.seq;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS unindex_deleted_card AFTER DELETE ON cards
+    BEGIN
+        DELETE FROM cards_search WHERE rowid = old.seq;
+    END
+    """,
+]
+
+
+class SQLiteStorage(Storage):
+    """
+    Normalized storage: decks, cards, reviews and schemas live in separate tables,
+    so saving a card or a review touches only its own rows.
+
+    Cards are looked up by their unique `(deck_id, id)`, by schema through the
+    `cards_by_schema` index, and reviews by score through `reviews_by_score`.
+    Decks and cards are numbered in creation order by their `seq` primary key, never
+    reused: their pages are keyset-paginated on it, and `cards_by_deck` keeps it in
+    order within each deck.
+    Triggers on `cards` keep the per-schema counters of `schema_usage` up to date.
+    Every review is also appended to `review_log`, from which `reviews` and `models`
+    can be rebuilt.
+    Decks and cards are full-text indexed by the FTS5 tables `decks_search` and
+    `cards_search`, whose rowids are the `seq` of the indexed rows, and their tags
+    are indexed by `deck_tags` and `card_tags`.
+    The counters of `get_versions()` are kept in `versions`.
+
+    Writes go through a single connection, one transaction at a time. The database
+    is in WAL mode, so reads use a pool of other connections and neither wait for
+    the writes nor see them until they're committed. For the same reason, the
+    in-memory indexes are only updated once a write is committed.
+
+    Several processes can share the database, like the workers of `uvicorn --workers N`:
+    each transaction takes the database's write lock when it begins, so the writes of
+    different processes never interleave, and the in-memory indexes are dropped whenever
+    another process committed a write since they were last used.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = RLock()
+        self._writer: Optional[int] = None
+        self._readers: List[sqlite3.Connection] = []
+        self._committed: List[Callable[[], None]] = []
+        self._touched: Set[str] = set()
+        self._data_version: Optional[int] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None
+        )
+        connection.execute("PRAGMA foreign_keys = ON")
+        return connection
+
+    def open(self):
+        self._connection = self._connect()
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        # The tables are rebuilt without their foreign keys' actions, which can only be
+        # turned off outside of a transaction
+        self._connection.execute("PRAGMA foreign_keys = OFF")
+        try:
+            with self.transaction() as connection:
+                self._add_sequence_numbers(connection)
+        finally:
+            self._connection.execute("PRAGMA foreign_keys = ON")
+        with self.transaction() as connection:
+            existing = {name for (name,) in connection.execute("SELECT name FROM sqlite_master")}
+            for table in TABLES:
+                connection.execute(table)
+            # Fill the tables derived from the others when upgrading older databases
+            for table, fill in (
+                ("schema_usage", self.recount_usage),
+                ("cards_search", self._index_all),
+                ("card_tags", self._index_all_tags),
+            ):
+                if table not in existing:
+                    fill()
+            if not connection.execute("SELECT 1 FROM schemas LIMIT 1").fetchone():
+                for schema_id, schema in DEFAULT_SCHEMAS.items():
+                    self.save_schema(schema_id, schema)
+
+    def _add_sequence_numbers(self, connection: sqlite3.Connection):
+        """
+        Upgrades the databases whose `decks` and `cards` have no `seq` column: their
+        rowids were implicit, and VACUUM can renumber those. The tables are rebuilt with
+        their rowids as `seq`, and the search indexes from them.
+        """
+        columns = [column for _, column, *_ in connection.execute("PRAGMA table_info(decks)")]
+        if not columns or "seq" in columns:
+            return
+        for table, copied in (("decks", "id, data"), ("cards", "deck_id, id, schema, data")):
+            [create] = [statement for statement in TABLES if f"EXISTS {table} (" in statement]
+            connection.execute(create.replace(f"EXISTS {table} (", f"EXISTS new_{table} ("))
+            connection.execute(
+                f"INSERT INTO new_{table} (seq, {copied}) "
+                f"SELECT rowid, {copied} FROM {table} ORDER BY rowid"
+            )
+            # Also drops its indexes and triggers, created again by `open()`
+            connection.execute(f"DROP TABLE {table}")
+            connection.execute(f"ALTER TABLE new_{table} RENAME TO {table}")
+        if connection.execute("PRAGMA foreign_key_check").fetchone():
+            raise sqlite3.IntegrityError("Foreign keys broken by the upgrade of the decks")
+        if connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'cards_search'"
+        ).fetchone():
+            self._index_all()
+
+    def close(self):
+        while self._readers:
+            self._readers.pop().close()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            if self._connection.in_transaction:
+                yield self._connection
+                return
+            # Take the write lock now: reading first and then writing could fail if another
+            # process wrote in between
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._sync_indexes()
+            self._writer = get_ident()
+            try:
+                yield self._connection
+                self._bump_versions()
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                self._committed.clear()
+                self._touched.clear()
+                self._indexes_lost()
+                raise
+            finally:
+                self._writer = None
+            self._connection.execute("COMMIT")
+            committed, self._committed = self._committed, []
+            for function in committed:
+                function()
+
+    @contextmanager
+    def savepoint(self) -> Iterator[sqlite3.Connection]:
+        with self.transaction() as connection:
+            committed, touched = len(self._committed), set(self._touched)
+            connection.execute("SAVEPOINT block")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK TO block")
+                connection.execute("RELEASE block")
+                # The indexes and counters must not see the writes undone
+                del self._committed[committed:]
+                self._touched = touched
+                raise
+            connection.execute("RELEASE block")
+
+    def _sync_indexes(self):
+        """
+        Drops the in-memory indexes if another process committed a write since the last
+        check: the `data_version` of the write connection only changes on their commits.
+        """
+        if not self._lock.acquire(blocking=False):
+            # A transaction is running: it checked when it began, and other processes
+            # can't write until it's over
+            return
+        try:
+            if self._connection is None:
+                return
+            (version,) = self._connection.execute("PRAGMA data_version").fetchone()
+            if self._data_version is not None and version != self._data_version:
+                self._indexes_lost()
+            self._data_version = version
+        finally:
+            self._lock.release()
+
+    def get_versions(self, names: List[str]) -> List[int]:
+        versions = dict(self._query(
+            f"SELECT name, version FROM versions WHERE name IN ({', '.join('?' * len(names))})",
+            *names,
+        ))
+        return [versions.get(name, 0) for name in names]
+
+    def _touch(self, *names: str):
+        """Bumps the counters of `get_versions()` when the current transaction commits"""
+        self._touched.update(names)
+
+    def _bump_versions(self):
+        # Once per transaction: importing a deck bumps each counter once, not once per card
+        touched, self._touched = self._touched, set()
+        if not touched:
+            return
+        self._connection.executemany(
+            "INSERT INTO versions (name, version) VALUES (?, abs(random() % 2147483648)) "
+            "ON CONFLICT (name) DO UPDATE SET version = version + 1",
+            [(name,) for name in touched],
+        )
+
+    def _after_commit(self, function: Callable[..., None], *args: Any):
+        """Updates the in-memory indexes once the current transaction is committed"""
+        self._committed.append(lambda: function(*args))
+
+    def _query(self, query: str, *params: Any) -> List[tuple]:
+        if self._writer == get_ident() or self.path == ":memory:":
+            # Within a transaction, reads must see its writes
+            with self._lock:
+                return self._connection.execute(query, params).fetchall()
+        try:
+            connection = self._readers.pop()
+        except IndexError:
+            connection = self._connect()
+        try:
+            return connection.execute(query, params).fetchall()
+        finally:
+            self._readers.append(connection)
+
+    #
+    # Decks
+    #
+
+    def list_decks(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            deck_id: json.loads(data)
+            for deck_id, data in self._query("SELECT id, data FROM decks ORDER BY seq")
+        }
+
+    def page_decks(
+        self, cursor: Optional[str] = None, limit: int = 50
+    ) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+        rows = self._query(
+            "SELECT seq, id, data FROM decks WHERE seq > ? ORDER BY seq LIMIT ?",
+            int(cursor or 0), limit + 1,
+        )
+        next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+        return {deck_id: json.loads(data) for _, deck_id, data in rows[:limit]}, next_cursor
+
+    def get_deck(self, deck_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._query("SELECT data FROM decks WHERE id = ?", deck_id)
+        return json.loads(rows[0][0]) if rows else None
+
+    def save_deck(self, deck_id: str, deck: Dict[str, Any]):
+        data = {key: value for key, value in deck.items() if key != "cards"}
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO decks (id, data) VALUES (?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET data = excluded.data",
+                (deck_id, json.dumps(data)),
+            )
+            self._index_text(
+                "decks_search", "SELECT seq FROM decks WHERE id = ?", (deck_id,), data
+            )
+            connection.execute("DELETE FROM deck_tags WHERE deck_id = ?", (deck_id,))
+            connection.executemany(
+                "INSERT OR IGNORE INTO deck_tags (deck_id, tag) VALUES (?, ?)",
+                [(deck_id, tag) for tag in tags_of(data)],
+            )
+            self._touch("decks", f"deck/{deck_id}")
+
+    def delete_deck(self, deck_id: str):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM decks WHERE id = ?", (deck_id,))
+            self._after_commit(self._deck_deleted, deck_id)
+            self._touch("decks", f"deck/{deck_id}", "schemas")
+
+    def count_cards(self, deck_id: str) -> int:
+        return self._query("SELECT COUNT(*) FROM cards WHERE deck_id = ?", deck_id)[0][0]
+
+    #
+    # Cards
+    #
+
+    def _reviews(self, deck_id: str, card_ids: Optional[List[str]] = None):
+        query = "SELECT card_id, card_type, score FROM reviews WHERE deck_id = ?"
+        params = [deck_id]
+        if card_ids is not None:
+            query += f" AND card_id IN ({', '.join('?' * len(card_ids))})"
+            params.extend(card_ids)
+        reviews: Dict[str, Dict[str, Optional[int]]] = {}
+        for review_card_id, card_type, score in self._query(query, *params):
+            reviews.setdefault(review_card_id, {})[card_type] = score
+        return reviews
+
+    def list_cards(self, deck_id: str) -> Dict[str, Dict[str, Any]]:
+        reviews = self._reviews(deck_id)
+        return {
+            card_id: {**json.loads(data), "schema": schema, "reviews": reviews.get(card_id, {})}
+            for card_id, schema, data in self._query(
+                "SELECT id, schema, data FROM cards WHERE deck_id = ? ORDER BY seq", deck_id
+            )
+        }
+
+    def page_cards(
+        self, deck_id: str, cursor: Optional[str] = None, limit: int = 50
+    ) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+        rows = self._query(
+            "SELECT seq, id, schema, data FROM cards "
+            "WHERE deck_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            deck_id, int(cursor or 0), limit + 1,
+        )
+        next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+        rows = rows[:limit]
+        reviews = self._reviews(deck_id, [card_id for _, card_id, _, _ in rows])
+        cards = {
+            card_id: {**json.loads(data), "schema": schema, "reviews": reviews.get(card_id, {})}
+            for _, card_id, schema, data in rows
+        }
+        return cards, next_cursor
+
+    def get_card(self, deck_id: str, card_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._query(
+            "SELECT schema, data FROM cards WHERE deck_id = ? AND id = ?", deck_id, card_id
+        )
+        if not rows:
+            return None
+        schema, data = rows[0]
+        reviews = self._reviews(deck_id, [card_id]).get(card_id, {})
+        return {**json.loads(data), "schema": schema, "reviews": reviews}
+
+    def upsert_card(self, deck_id: str, card_id: str, card: Dict[str, Any]):
+        data = {key: value for key, value in card.items() if key not in ("schema", "reviews")}
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO cards (deck_id, id, schema, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (deck_id, id) DO UPDATE "
+                "SET schema = excluded.schema, data = excluded.data",
+                (deck_id, card_id, card["schema"], json.dumps(data)),
+            )
+            self._index_text(
+                "cards_search",
+                "SELECT seq FROM cards WHERE deck_id = ? AND id = ?",
+                (deck_id, card_id),
+                data,
+            )
+            connection.execute(
+                "DELETE FROM card_tags WHERE deck_id = ? AND card_id = ?", (deck_id, card_id)
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO card_tags (deck_id, card_id, tag) VALUES (?, ?, ?)",
+                [(deck_id, card_id, tag) for tag in tags_of(data)],
+            )
+            card_types = list(card.get("reviews", {}))
+            for table in ("reviews", "models"):
+                connection.execute(
+                    f"DELETE FROM {table} WHERE deck_id = ? AND card_id = ? "
+                    f"AND card_type NOT IN ({', '.join('?' * len(card_types))})",
+                    (deck_id, card_id, *card_types),
+                )
+            for card_type, score in card.get("reviews", {}).items():
+                self.record_review(deck_id, card_id, card_type, score)
+            self._after_commit(self._card_written, deck_id, card_id, card.get("reviews", {}))
+            self._touch(f"deck/{deck_id}", "schemas")
+
+    def delete_card(self, deck_id: str, card_id: str):
+        with self.transaction() as connection:
+            connection.execute(
+                "DELETE FROM cards WHERE deck_id = ? AND id = ?", (deck_id, card_id)
+            )
+            self._after_commit(self._card_deleted, deck_id, card_id)
+            self._touch(f"deck/{deck_id}", "schemas")
+
+    #
+    # Reviews
+    #
+
+    def list_reviews(self, deck_id: str) -> List[Tuple[str, str, Optional[int]]]:
+        return self._query(
+            "SELECT card_id, card_type, score FROM reviews WHERE deck_id = ?", deck_id
+        )
+
+    def lowest_score(self, deck_id: str) -> Optional[int]:
+        if self._writer != get_ident():
+            return self.review_index.minimum(deck_id)
+        # The index is updated once the transaction commits: within it, ask the database
+        # (both lookups use the reviews_by_score index)
+        ((lowest, unreviewed),) = self._query(
+            "SELECT (SELECT min(score) FROM reviews WHERE deck_id = ?), "
+            "EXISTS (SELECT 1 FROM reviews WHERE deck_id = ? AND score IS NULL)",
+            deck_id, deck_id,
+        )
+        scores = ([lowest] if lowest is not None else []) + ([0] if unreviewed else [])
+        return min(scores, default=None)
+
+    def record_review(self, deck_id: str, card_id: str, card_type: str, score: Optional[int]):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO reviews (deck_id, card_id, card_type, score) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (deck_id, card_id, card_type) DO UPDATE SET score = excluded.score",
+                (deck_id, card_id, card_type, score),
+            )
+            self._after_commit(self.review_index.update, deck_id, card_id, card_type, score)
+
+    def list_models(self, deck_id: str) -> Dict[Tuple[str, str], Model]:
+        return {
+            (card_id, card_type): tuple(model)
+            for card_id, card_type, *model in self._query(
+                "SELECT card_id, card_type, alpha, beta, t, last_review FROM models "
+                "WHERE deck_id = ?",
+                deck_id,
+            )
+        }
+
+    def get_model(self, deck_id: str, card_id: str, card_type: str) -> Optional[Model]:
+        rows = self._query(
+            "SELECT alpha, beta, t, last_review FROM models "
+            "WHERE deck_id = ? AND card_id = ? AND card_type = ?",
+            deck_id, card_id, card_type,
+        )
+        return tuple(rows[0]) if rows else None
+
+    def save_model(self, deck_id: str, card_id: str, card_type: str, model: Model):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO models (deck_id, card_id, card_type, alpha, beta, t, last_review) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (deck_id, card_id, card_type) DO UPDATE SET "
+                "alpha = excluded.alpha, beta = excluded.beta, t = excluded.t, "
+                "last_review = excluded.last_review",
+                (deck_id, card_id, card_type, *model),
+            )
+            self._after_commit(self.model_index.update, deck_id, card_id, card_type, model)
+
+    def log_review(
+        self,
+        deck_id: str,
+        card_id: str,
+        card_type: str,
+        result: str,
+        timestamp: float,
+        latency: Optional[float] = None,
+    ):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO review_log (deck_id, card_id, card_type, result, timestamp, latency) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (deck_id, card_id, card_type, result, timestamp, latency),
+            )
+
+    def list_review_log(self, deck_id: str) -> List[LoggedReview]:
+        return self._query(
+            "SELECT card_id, card_type, result, timestamp, latency FROM review_log "
+            "WHERE deck_id = ? ORDER BY rowid",
+            deck_id,
+        )
+
+    def clear_reviews(self, deck_id: str):
+        with self.transaction() as connection:
+            connection.execute("UPDATE reviews SET score = NULL WHERE deck_id = ?", (deck_id,))
+            connection.execute("DELETE FROM models WHERE deck_id = ?", (deck_id,))
+            # Rebuilt from the storage on their next use
+            self._after_commit(self._deck_deleted, deck_id)
+
+    #
+    # Schemas
+    #
+
+    def list_schemas(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            schema_id: json.loads(data)
+            for schema_id, data in self._query("SELECT id, data FROM schemas ORDER BY rowid")
+        }
+
+    def get_schema(self, schema_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._query("SELECT data FROM schemas WHERE id = ?", schema_id)
+        return json.loads(rows[0][0]) if rows else None
+
+    def save_schema(self, schema_id: str, schema: Dict[str, Any]):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO schemas (id, data) VALUES (?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET data = excluded.data",
+                (schema_id, json.dumps(schema)),
+            )
+            self._touch("schemas", f"schema/{schema_id}")
+
+    def delete_schema(self, schema_id: str):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM schemas WHERE id = ?", (schema_id,))
+            self._touch("schemas", f"schema/{schema_id}")
+
+    def usage_by_schema(self) -> Dict[str, int]:
+        return dict(self._query("SELECT schema, cards FROM schema_usage WHERE cards > 0"))
+
+    def recount_usage(self):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM schema_usage")
+            connection.execute(
+                "INSERT INTO schema_usage (schema, cards) "
+                "SELECT schema, COUNT(*) FROM cards GROUP BY schema"
+            )
+            self._touch("schemas")
+
+    #
+    # Search
+    #
+
+    def _index_text(self, table: str, seq_query: str, params: tuple, record: Dict[str, Any]):
+        """Replaces the indexed text of the row selected by `seq_query`"""
+        with self.transaction() as connection:
+            (rowid,) = connection.execute(seq_query, params).fetchone()
+            connection.execute(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+            connection.execute(
+                f"INSERT INTO {table} (rowid, content) VALUES (?, ?)",
+                (rowid, searchable_text(record)),
+            )
+
+    def _index_all(self):
+        """Fills the search indexes from scratch, for databases created before them"""
+        with self.transaction() as connection:
+            for table, source in (("decks_search", "decks"), ("cards_search", "cards")):
+                connection.execute(f"DELETE FROM {table}")
+                for rowid, data in connection.execute(f"SELECT seq, data FROM {source}"):
+                    connection.execute(
+                        f"INSERT INTO {table} (rowid, content) VALUES (?, ?)",
+                        (rowid, searchable_text(json.loads(data))),
+                    )
+
+    def search(
+        self,
+        query: str,
+        deck_id: Optional[str] = None,
+        limit: Optional[int] = 50,
+        tags: List[str] = (),
+        schema_id: Optional[str] = None,
+    ) -> List[Tuple[str, Optional[str]]]:
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        # Quote every token so that user input is never parsed as FTS5 syntax,
+        # and match the last one as a prefix
+        match = " ".join(f'"{token}"' for token in tokens) + "*"
+        limit = -1 if limit is None else limit
+        # The filters are looked up in the tag indexes for each text match, and the
+        # limit is applied after them
+        has_tags = "".join(
+            " AND EXISTS (SELECT 1 FROM {table} WHERE tag = ? AND {key})" for _ in tags
+        )
+        results = []
+        # Decks have no schema: they never match a schema filter
+        if deck_id is None and not schema_id:
+            results += [
+                (found_deck_id, None)
+                for (found_deck_id,) in self._query(
+                    "SELECT decks.id FROM decks_search "
+                    "JOIN decks ON decks.seq = decks_search.rowid "
+                    "WHERE decks_search MATCH ?"
+                    + has_tags.format(table="deck_tags", key="deck_id = decks.id")
+                    + " ORDER BY rank LIMIT ?",
+                    match, *tags, limit,
+                )
+            ]
+        results += self._query(
+            "SELECT cards.deck_id, cards.id FROM cards_search "
+            "JOIN cards ON cards.seq = cards_search.rowid "
+            "WHERE cards_search MATCH ? AND (? IS NULL OR cards.deck_id = ?) "
+            "AND (? IS NULL OR cards.schema = ?)"
+            + has_tags.format(
+                table="card_tags", key="deck_id = cards.deck_id AND card_id = cards.id"
+            )
+            + " ORDER BY rank LIMIT ?",
+            match, deck_id, deck_id, schema_id, schema_id, *tags,
+            limit - len(results) if limit >= 0 else -1,
+        )
+        return results
+
+    def _index_all_tags(self):
+        """Fills the tag indexes from scratch, for databases created before them"""
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM deck_tags")
+            connection.execute("DELETE FROM card_tags")
+            for deck_id, data in connection.execute("SELECT id, data FROM decks"):
+                connection.executemany(
+                    "INSERT OR IGNORE INTO deck_tags (deck_id, tag) VALUES (?, ?)",
+                    [(deck_id, tag) for tag in tags_of(json.loads(data))],
+                )
+            for deck_id, card_id, data in connection.execute(
+                "SELECT deck_id, id, data FROM cards"
+            ):
+                connection.executemany(
+                    "INSERT OR IGNORE INTO card_tags (deck_id, card_id, tag) VALUES (?, ?, ?)",
+                    [(deck_id, card_id, tag) for tag in tags_of(json.loads(data))],
+                )
+
+    def filter_decks(self, tags: List[str], limit: Optional[int] = None) -> List[str]:
+        if tags:
+            query = " INTERSECT ".join(["SELECT deck_id FROM deck_tags WHERE tag = ?"] * len(tags))
+        else:
+            query = "SELECT id FROM decks"
+        query += " ORDER BY 1 LIMIT ?"
+        limit = -1 if limit is None else limit
+        return [deck_id for (deck_id,) in self._query(query, *tags, limit)]
+
+    def filter_cards(
+        self,
+        deck_id: Optional[str] = None,
+        tags: List[str] = (),
+        schema_id: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Tuple[str, str]]:
+        in_deck = " AND deck_id = ?" if deck_id is not None else ""
+        deck_params = [deck_id] if deck_id is not None else []
+        queries, params = [], []
+        for tag in tags:
+            queries.append("SELECT deck_id, card_id FROM card_tags WHERE tag = ?" + in_deck)
+            params += [tag, *deck_params]
+        if schema_id or not queries:
+            queries.append(
+                "SELECT deck_id, id FROM cards WHERE (? IS NULL OR schema = ?)" + in_deck
+            )
+            params += [schema_id, schema_id, *deck_params]
+        query = " INTERSECT ".join(queries) + " ORDER BY 1, 2 LIMIT ?"
+        return self._query(query, *params, -1 if limit is None else limit)
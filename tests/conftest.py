@@ -0,0 +1,37 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from flashcards_htmx import app as app_module
+from flashcards_htmx.api import static
+from flashcards_htmx.storage import STORAGE_BACKENDS
+
+
+@pytest.fixture(params=list(STORAGE_BACKENDS))
+def storage(request, tmp_path):
+    """An empty storage, of each backend in turn"""
+    storage = STORAGE_BACKENDS[request.param](str(tmp_path / "flashcards"))
+    storage.open()
+    yield storage
+    storage.close()
+
+
+@pytest.fixture(scope="session")
+def static_cache(tmp_path_factory):
+    """
+    Cache of the compressed static files, filled once: each startup compresses them in
+    the background otherwise, which takes seconds.
+    """
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(static, "STATIC_CACHE", str(tmp_path_factory.mktemp("static")))
+        static.static_files.compress()
+        return static.STATIC_CACHE
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch, static_cache):
+    """A client of the app, on an empty database"""
+    monkeypatch.setattr(app_module, "DATABASE", str(tmp_path / "flashcards.sqlite3"))
+    monkeypatch.setattr(app_module, "LEGACY_DATABASE", str(tmp_path / "flashcards.db"))
+    monkeypatch.setattr(static, "STATIC_CACHE", static_cache)
+    with TestClient(app_module.app) as client:
+        yield client
@@ -0,0 +1,76 @@
+"""
+The algorithms' picks: Ebisu's screening of the weakest model, and the selections with
+no card type to pick.
+"""
+import time
+
+import numpy as np
+import pytest
+
+from flashcards_htmx.api.algorithms import ALGORITHMS
+from flashcards_htmx.ebisu import predict_log_recall, weakest
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS
+from flashcards_htmx.storage.indexes import ModelArrays
+
+
+def make_deck(algorithm, cards=("1", "2")):
+    return {
+        "name": "Deck",
+        "description": "",
+        "tags": [],
+        "algorithm": algorithm,
+        "cards": {
+            card_id: {
+                # Question & Answer with reverse
+                "schema": list(DEFAULT_SCHEMAS)[1],
+                "tags": [],
+                "question": card_id,
+                "answer": card_id,
+                "reviews": {"direct": None},
+            }
+            for card_id in cards
+        },
+    }
+
+
+@pytest.mark.parametrize("span", [60, 24 * 60 * 60, 400 * 24 * 60 * 60])
+@pytest.mark.parametrize("unit", [30, 30 * 60, 24 * 60 * 60])
+def test_weakest_is_exact(span, unit):
+    rng = np.random.default_rng(span + unit)
+    now = time.time()
+    arrays = ModelArrays()
+    for card in range(2000):
+        alpha = rng.uniform(0.5, 20)
+        beta, t = alpha * rng.uniform(0.3, 3), rng.uniform(0.1, 100)
+        model = (alpha, beta, t, now - rng.uniform(0, span))
+        arrays.set(str(card), "direct", model if card % 5 else None)
+    alpha, beta, t, last_review, norm = arrays.models
+    expected = predict_log_recall(alpha, beta, t, (now - last_review) / unit, norm)
+
+    position, log_recall = weakest(arrays.models, arrays.estimates, now, arrays.epoch, unit)
+    assert position == np.nanargmin(expected)
+    assert log_recall == pytest.approx(np.nanmin(expected), abs=1e-9)
+
+
+def test_epoch_follows_the_reviews():
+    now = time.time()
+    arrays = ModelArrays([("1", "direct", None)], {("1", "direct"): (3, 3, 3, now - 10 ** 7)})
+    arrays.set("2", "direct", (3, 3, 3, now))
+    assert arrays.epoch == now
+    assert arrays.estimates[3].tolist() == [-10 ** 7, 0]
+
+
+@pytest.mark.parametrize("card_ids", [[], ["missing"]])
+def test_ebisu_with_no_card_type_to_pick(storage, card_ids):
+    storage.import_deck("deck", make_deck("Ebisu"))
+    deck = storage.get_deck("deck")
+    assert ALGORITHMS["Ebisu"].next_card(storage, "deck", deck, card_ids=card_ids) is None
+    storage.import_deck("empty", make_deck("Ebisu", cards=()))
+    assert ALGORITHMS["Ebisu"].next_card(storage, "empty", storage.get_deck("empty")) is None
+
+
+@pytest.mark.parametrize("card_ids", [None, [], ["missing"]])
+def test_hardest_first_with_no_card_type_to_pick(storage, card_ids):
+    storage.import_deck("deck", make_deck("HardestFirst", cards=()))
+    deck = storage.get_deck("deck")
+    assert ALGORITHMS["HardestFirst"].next_card(storage, "deck", deck, card_ids=card_ids) is None
@@ -0,0 +1,99 @@
+"""
+HTTP caching of the pages by `cached()`: ETags follow the storage's versions, and the
+shared pages are rendered once for every browser.
+"""
+from flashcards_htmx.app import rendered_fragments
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS
+
+
+DECKS = "/htmx/components/decks"
+
+
+def save_deck(storage, deck_id):
+    storage.save_deck(deck_id, {
+        "name": deck_id, "description": "", "tags": [], "algorithm": "Random"
+    })
+
+
+def save_card(storage, deck_id, card_id):
+    storage.upsert_card(deck_id, card_id, {
+        "schema": list(DEFAULT_SCHEMAS)[0], "tags": [], "question": "q", "answer": "a"
+    })
+
+
+def study(deck_id):
+    return f"/study/{deck_id}"
+
+
+def test_if_none_match(client):
+    response = client.get(DECKS)
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+
+    for sent in (etag, f'"other", {etag}', "*"):
+        response = client.get(DECKS, headers={"If-None-Match": sent})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert not response.content
+    assert client.get(DECKS, headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_writes_change_the_etag(client):
+    storage = client.app.state.storage
+    etag = client.get(DECKS).headers["ETag"]
+    save_deck(storage, "deck")
+    response = client.get(DECKS, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert "deck" in response.text
+
+
+def test_etags_depend_on_the_url(client):
+    assert client.get(DECKS).headers["ETag"] != client.get(f"{DECKS}?cursor=1").headers["ETag"]
+
+
+def test_per_deck_versions(client):
+    storage = client.app.state.storage
+    save_deck(storage, "a")
+    save_deck(storage, "b")
+    etags = {deck_id: client.get(study(deck_id)).headers["ETag"] for deck_id in "ab"}
+
+    # Only the pages of the deck written to change
+    save_card(storage, "a", "1")
+    assert client.get(study("a")).headers["ETag"] != etags["a"]
+    assert client.get(study("b")).headers["ETag"] == etags["b"]
+    # The decks list doesn't show the cards
+    etag = client.get(DECKS).headers["ETag"]
+    save_card(storage, "a", "2")
+    assert client.get(DECKS).headers["ETag"] == etag
+
+
+def test_shared_pages_are_rendered_once(client, monkeypatch):
+    storage = client.app.state.storage
+    save_deck(storage, "deck")
+    rendered = []
+    page_decks = storage.page_decks
+    monkeypatch.setattr(
+        storage, "page_decks", lambda *args: rendered.append(args) or page_decks(*args)
+    )
+    first = client.get(DECKS)
+    assert rendered_fragments.get(first.headers["ETag"]) == first.text
+
+    # Another browser gets the same page without the route running
+    second = client.get(DECKS)
+    assert (second.status_code, second.text) == (200, first.text)
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert len(rendered) == 1
+
+    # Until a write changes the ETag
+    save_deck(storage, "other")
+    assert "other" in client.get(DECKS).text
+    assert len(rendered) == 2
+
+
+def test_pages_not_shared(client):
+    storage = client.app.state.storage
+    save_deck(storage, "deck")
+    response = client.get(study("deck"))
+    assert response.status_code == 200
+    assert rendered_fragments.get(response.headers["ETag"]) is None
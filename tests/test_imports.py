@@ -0,0 +1,145 @@
+"""
+Deck imports: the incremental JSON reader must parse the file the same way whatever its
+chunks, and a failed import must leave nothing behind.
+"""
+import io
+import gzip
+import json
+from hashlib import md5
+
+import pytest
+
+from flashcards_htmx.api import imports
+from flashcards_htmx.api.imports import (
+    ImportProgress,
+    InvalidImport,
+    import_deck_file,
+    parse_deck,
+)
+from flashcards_htmx.api.utils import schema_templates
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS
+
+
+SCHEMA_ID = list(DEFAULT_SCHEMAS)[0]
+
+DECK = {
+    "name": "Deck éè 日本語 \U0001f600",
+    "description": "\"Quoted\", back\\slash\ttab\nnew line \u0000  ",
+    "tags": ["a", "b"],
+    "algorithm": "HardestFirst",
+    "cards": {
+        "1": {"schema": SCHEMA_ID, "question": "\U0001f600", "answer": "a", "tags": []},
+        "2": {
+            "schema": SCHEMA_ID,
+            "question": "{\"not\": [\"a key\"]}",
+            "answer": "b",
+            "tags": ["x"],
+            "reviews": {"card": 12345},
+            "nested": {"list": [1, 2.5e-3, {"deep": [True, False, None]}], "empty": {}},
+        },
+    },
+    "after_cards": -0.125,
+}
+
+
+@pytest.fixture
+def storage(storage):
+    """Cards are rendered with the templates of this storage's schemas"""
+    schema_templates.open(storage)
+    return storage
+
+
+def parse(data: bytes):
+    return list(parse_deck(io.BytesIO(data)))
+
+
+def expected(deck):
+    return [
+        ("card", card_id, card) if key == "cards" else ("field", key, value)
+        for key, value in deck.items()
+        for card_id, card in (value.items() if key == "cards" else [(None, None)])
+    ]
+
+
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_parse_deck(ensure_ascii, indent):
+    data = json.dumps(DECK, ensure_ascii=ensure_ascii, indent=indent).encode()
+    assert parse(data) == expected(DECK)
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 3, 7])
+def test_parse_deck_in_chunks(monkeypatch, read_size):
+    # Splits the escapes, the UTF-8 sequences and the numbers across chunks
+    monkeypatch.setattr(imports, "READ_SIZE", read_size)
+    data = json.dumps(DECK, ensure_ascii=False).encode("utf-8-sig")
+    assert parse(data) == expected(DECK)
+    assert parse(b'{"number": 12345}') == [("field", "number", 12345)]
+
+
+@pytest.mark.parametrize("read_size", [1, 64 * 1024])
+def test_parse_gzipped_deck(monkeypatch, read_size):
+    monkeypatch.setattr(imports, "READ_SIZE", read_size)
+    data = json.dumps(DECK, ensure_ascii=False).encode()
+    assert parse(gzip.compress(data)) == expected(DECK)
+
+
+@pytest.mark.parametrize("data", [
+    pytest.param(b"", id="empty"),
+    pytest.param(b"[]", id="not_an_object"),
+    pytest.param(b'{"name": "a"', id="unterminated_object"),
+    pytest.param(b'{"name": "a}', id="unterminated_string"),
+    pytest.param(b'{"name" "a"}', id="missing_colon"),
+    pytest.param(b'{"name": "a",}', id="trailing_comma"),
+    pytest.param(b'{1: "a"}', id="number_key"),
+    pytest.param(b'{"cards": {"1": tru}}', id="invalid_literal"),
+    pytest.param(b'{"name": "a"} {}', id="content_after"),
+    pytest.param(b'{"name": "\xff"}', id="not_utf8"),
+    pytest.param(b"\x1f\x8b\x08\x00 not gzip", id="broken_gzip"),
+])
+def test_parse_malformed_deck(data):
+    with pytest.raises(InvalidImport):
+        parse(data)
+
+
+def test_value_size_is_bounded(monkeypatch):
+    monkeypatch.setattr(imports, "MAX_VALUE_SIZE", 100)
+    with pytest.raises(InvalidImport, match="larger than"):
+        parse(json.dumps({"name": "a" * 1000}).encode())
+
+
+def test_import_deck_file(storage):
+    progress = ImportProgress()
+    data = gzip.compress(json.dumps(DECK).encode())
+    deck_id = import_deck_file(storage, io.BytesIO(data), progress)
+    assert deck_id == md5(DECK["name"].encode()).hexdigest()
+    assert (progress.cards, progress.skipped, progress.done) == (2, 0, True)
+    assert storage.get_deck(deck_id)["after_cards"] == -0.125
+    card = storage.get_card(deck_id, "2")
+    assert card["nested"] == DECK["cards"]["2"]["nested"]
+    assert card["reviews"] == {"card": 12345}
+    assert "preview" in card
+
+
+def test_invalid_cards_are_skipped(storage):
+    progress = ImportProgress()
+    deck = {**DECK, "cards": {**DECK["cards"], "3": {"schema": "missing"}, "4": []}}
+    deck_id = import_deck_file(storage, io.BytesIO(json.dumps(deck).encode()), progress)
+    assert (progress.cards, progress.skipped) == (2, 2)
+    assert [card_id for card_id, _ in progress.errors] == ["3", "4"]
+    assert list(storage.list_cards(deck_id)) == ["1", "2"]
+
+
+def test_failed_import_is_deleted(storage, monkeypatch):
+    # The first batch of cards is saved before the file turns out to be malformed
+    monkeypatch.setattr(imports, "IMPORT_BATCH_SIZE", 1)
+    data = json.dumps(DECK).encode()
+    data = data[: data.index(b'"2"')] + b'"2": {"schema": }}}'
+    progress = ImportProgress()
+    with pytest.raises(InvalidImport):
+        import_deck_file(storage, io.BytesIO(data), progress)
+    assert progress.done
+    assert progress.deck_id is not None
+    assert storage.get_deck(progress.deck_id) is None
+    assert storage.list_decks() == {}
+    assert storage.usage_by_schema() == {}
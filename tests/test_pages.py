@@ -0,0 +1,27 @@
+"""
+Paginated lists: cursors from the query string are checked before they reach the storage.
+"""
+import pytest
+
+
+URLS = ["/htmx/components/decks", "/htmx/components/decks/deck/cards"]
+
+
+@pytest.fixture
+def deck(client):
+    client.app.state.storage.save_deck("deck", {
+        "name": "Deck", "description": "", "tags": [], "algorithm": "Random"
+    })
+    return "deck"
+
+
+@pytest.mark.parametrize("cursor", [None, "", "0", "12"])
+@pytest.mark.parametrize("url", URLS)
+def test_valid_cursor(client, deck, url, cursor):
+    assert client.get(url, params={"cursor": cursor} if cursor is not None else {}).is_success
+
+
+@pytest.mark.parametrize("cursor", ["abc", "-1", "1.5", "²"])
+@pytest.mark.parametrize("url", URLS)
+def test_invalid_cursor(client, deck, url, cursor):
+    assert client.get(url, params={"cursor": cursor}).status_code == 400
@@ -0,0 +1,63 @@
+"""
+Reviews saved by `GroupCommit`: the reviews of a batch share a transaction, and each one
+must still see the ones saved before it.
+"""
+import pytest
+
+from flashcards_htmx.api.algorithms import ALGORITHMS
+from flashcards_htmx.api.reviews import GroupCommit, _PendingReview
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS
+
+
+@pytest.fixture
+def deck(storage):
+    storage.import_deck("deck", {
+        "name": "Deck",
+        "description": "",
+        "tags": [],
+        "algorithm": "HardestFirst",
+        "cards": {
+            card_id: {
+                "schema": list(DEFAULT_SCHEMAS)[0],
+                "tags": [],
+                "question": card_id,
+                "answer": card_id,
+                "reviews": {"direct": 5},
+            }
+            for card_id in ("1", "2", "3")
+        },
+    })
+    return "deck"
+
+
+def review(storage, deck_id, card_id, result):
+    return _PendingReview(lambda: ALGORITHMS["HardestFirst"].process_result(
+        storage, deck_id, card_id, "direct", result
+    ))
+
+
+def scores(storage, deck_id):
+    return {card_id: score for card_id, _, score in storage.list_reviews(deck_id)}
+
+
+def test_wrong_answers_in_the_same_batch(storage, deck):
+    batch = [review(storage, deck, "1", "wrong"), review(storage, deck, "2", "wrong")]
+    GroupCommit()._commit(storage, batch)
+    assert [pending.error for pending in batch] == [None, None]
+    # The second wrong answer goes below the first one
+    assert scores(storage, deck) == {"1": 4, "2": 3, "3": 5}
+    assert storage.review_index.minimum(deck) == 3
+
+
+def test_failed_review_in_a_batch(storage, deck):
+    def fail():
+        storage.record_review(deck, "2", "direct", 0)
+        raise ValueError()
+
+    batch = [review(storage, deck, "1", "wrong"), _PendingReview(fail)]
+    batch.append(review(storage, deck, "3", "wrong"))
+    GroupCommit()._commit(storage, batch)
+    assert isinstance(batch[1].error, ValueError)
+    # The failed review is undone, and not seen by the ones after it
+    assert scores(storage, deck) == {"1": 4, "2": 5, "3": 3}
+    assert storage.review_index.minimum(deck) == 3
@@ -0,0 +1,97 @@
+"""
+The sandbox of the card types generated by code: what it rejects when the schema is saved,
+and the budgets enforced when the code runs.
+"""
+import pytest
+
+from flashcards_htmx.api import schema_code
+from flashcards_htmx.api.schema_code import (
+    InvalidSchema,
+    SchemaCodeError,
+    compile_card_code,
+    run_card_code,
+)
+
+
+VALID = "word = random.choice([a, b]).upper(); card = {'question': word, 'answer': word.lower()}"
+
+
+def test_run_card_code():
+    assert run_card_code(VALID, {"a": "x", "b": "x"}) == ("X", "x")
+
+
+@pytest.mark.parametrize("source", [
+    pytest.param("import os", id="import"),
+    pytest.param("from os import path", id="import_from"),
+    pytest.param("try:\n    pass\nexcept Exception:\n    pass", id="try"),
+    pytest.param("x = ().__class__", id="dunder_attribute"),
+    pytest.param("x = __import__('os')", id="dunder_name"),
+    pytest.param("x = '{0.__class__}'.format(1)", id="format"),
+    pytest.param("x = '{a}'.format_map({})", id="format_map"),
+    pytest.param("x = str.format", id="format_unbound"),
+    pytest.param(
+        "def f():\n    yield g.gi_frame.f_back.f_back\n"
+        "g = f()\nfor fr in g:\n    break\n"
+        "os = fr.f_globals['__builtins__']['__import__']('os')",
+        id="generator_frame",
+    ),
+    pytest.param("def f():\n    yield from []", id="yield_from"),
+    pytest.param("async def f():\n    pass", id="coroutine"),
+    pytest.param("x = (i for i in []).gi_frame", id="generator_expression_frame"),
+    pytest.param("x = (i for i in []).gi_code", id="generator_code"),
+    pytest.param("x = random.choice.f_globals", id="frame_globals"),
+    pytest.param("x = random.choice.__self__", id="bound_method_self"),
+    pytest.param("x = {}['__builtins__']", id="dunder_subscript"),
+    pytest.param("x = card.tb_frame", id="traceback_frame"),
+    pytest.param("x = f.co_consts", id="code_constants"),
+])
+def test_escapes_are_rejected(source):
+    with pytest.raises(InvalidSchema):
+        compile_card_code(source)
+
+
+def test_generator_expressions_are_allowed():
+    source = "card = {'question': ''.join(w for w in [a, b]), 'answer': a}"
+    assert run_card_code(source, {"a": "x", "b": "y"}) == ("xy", "x")
+
+
+def test_time_budget():
+    with pytest.raises(SchemaCodeError, match="ran for more than"):
+        run_card_code("while True:\n    pass", {})
+
+
+def test_single_long_call_is_killed():
+    with pytest.raises(SchemaCodeError, match="killed"):
+        run_card_code("x = sum(range(10**9))", {})
+    # The next call gets a new worker
+    assert run_card_code(VALID, {"a": "x", "b": "x"}) == ("X", "x")
+
+
+def test_memory_budget():
+    with pytest.raises(SchemaCodeError, match="MemoryError"):
+        run_card_code("x = 'a' * 10**10", {})
+
+
+def test_templates_size():
+    with pytest.raises(SchemaCodeError, match="longer than"):
+        run_card_code("card = {'question': 'a' * 10**6, 'answer': ''}", {})
+
+
+def test_dead_worker_is_replaced():
+    run_card_code(VALID, {"a": "x", "b": "x"})
+    for worker in schema_code._workers:
+        worker.process.kill()
+        worker.process.join()
+    assert run_card_code(VALID, {"a": "x", "b": "x"}) == ("X", "x")
+
+
+def test_worker_dying_while_running(monkeypatch):
+    run_card_code(VALID, {"a": "x", "b": "x"})
+    worker = schema_code._workers[-1]
+    worker.process.kill()
+    worker.process.join()
+    # Died after being taken for the run
+    monkeypatch.setattr(worker.process, "is_alive", lambda: True)
+    with pytest.raises(SchemaCodeError, match="stopped its worker"):
+        run_card_code(VALID, {"a": "x", "b": "x"})
+    assert worker not in schema_code._workers
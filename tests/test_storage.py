@@ -0,0 +1,554 @@
+"""
+Behavior every storage backend must share: the routes and algorithms only rely on the
+`Storage` interface, so each test runs on all the backends of `STORAGE_BACKENDS`.
+"""
+import shelve
+import sqlite3
+
+import pytest
+
+from flashcards_htmx.storage import SQLiteStorage, ShelveStorage
+from flashcards_htmx.storage.defaults import DEFAULT_SCHEMAS
+
+
+SCHEMA_ID, OTHER_SCHEMA_ID = list(DEFAULT_SCHEMAS)
+
+
+def make_card(question="Question", tags=(), schema_id=SCHEMA_ID, reviews=None):
+    return {
+        "schema": schema_id,
+        "tags": list(tags),
+        "question": question,
+        "answer": "Answer",
+        "reviews": reviews if reviews is not None else {"direct": None, "reverse": None},
+    }
+
+
+def make_deck(name="Deck", tags=(), cards=None):
+    return {
+        "name": name,
+        "description": "A deck",
+        "tags": list(tags),
+        "algorithm": "HardestFirst",
+        "cards": cards or {},
+    }
+
+
+#
+# Decks and cards
+#
+
+
+def test_save_and_get_deck(storage):
+    storage.save_deck("deck", make_deck(cards={"card": make_card()}))
+    assert storage.get_deck("deck") == {
+        key: value for key, value in make_deck().items() if key != "cards"
+    }
+    assert storage.count_cards("deck") == 0  # save_deck ignores the cards
+    assert list(storage.list_decks()) == ["deck"]
+    assert storage.get_deck("missing") is None
+
+
+def test_save_deck_keeps_its_cards(storage):
+    storage.import_deck("deck", make_deck(cards={"card": make_card()}))
+    storage.save_deck("deck", make_deck(name="Renamed"))
+    assert storage.get_deck("deck")["name"] == "Renamed"
+    assert list(storage.list_cards("deck")) == ["card"]
+
+
+def test_returned_records_are_copies(storage):
+    storage.import_deck("deck", make_deck(cards={"card": make_card()}))
+    storage.get_deck("deck")["name"] = "Changed"
+    storage.get_card("deck", "card")["reviews"]["direct"] = 5
+    assert storage.get_deck("deck")["name"] == "Deck"
+    assert storage.get_card("deck", "card")["reviews"]["direct"] is None
+
+
+def test_upsert_get_and_delete_card(storage):
+    storage.import_deck("deck", make_deck())
+    storage.upsert_card("deck", "card", make_card())
+    assert storage.get_card("deck", "card") == make_card()
+
+    storage.upsert_card("deck", "card", make_card(question="Changed"))
+    assert storage.get_card("deck", "card")["question"] == "Changed"
+    assert storage.count_cards("deck") == 1
+
+    storage.delete_card("deck", "card")
+    assert storage.get_card("deck", "card") is None
+    assert storage.list_cards("deck") == {}
+
+
+def test_upsert_card_keeps_only_its_card_types(storage):
+    storage.import_deck("deck", make_deck(cards={"card": make_card()}))
+    storage.record_review("deck", "card", "direct", 2)
+    storage.save_model("deck", "card", "reverse", (3.0, 3.0, 3.0, 100.0))
+    storage.upsert_card("deck", "card", make_card(reviews={"direct": 2}))
+    assert storage.list_reviews("deck") == [("card", "direct", 2)]
+    assert storage.get_model("deck", "card", "reverse") is None
+
+
+def test_delete_deck(storage):
+    storage.import_deck("deck", make_deck(cards={"card": make_card()}))
+    storage.import_deck("other", make_deck(cards={"card": make_card()}))
+    storage.log_review("deck", "card", "direct", "correct", 100.0)
+    storage.delete_deck("deck")
+    assert storage.get_deck("deck") is None
+    assert storage.list_cards("deck") == {}
+    assert storage.list_review_log("deck") == []
+    assert list(storage.list_decks()) == ["other"]
+
+
+def test_transaction_groups_writes(storage):
+    with storage.transaction():
+        storage.save_deck("deck", make_deck())
+        with storage.transaction():
+            storage.upsert_card("deck", "card", make_card())
+    assert storage.count_cards("deck") == 1
+
+
+#
+# Schemas and their usage counters
+#
+
+
+def test_save_and_delete_schema(storage):
+    assert set(storage.list_schemas()) == set(DEFAULT_SCHEMAS)
+    storage.save_schema("schema", {"name": "Schema"})
+    assert storage.get_schema("schema") == {"name": "Schema"}
+    storage.delete_schema("schema")
+    assert storage.get_schema("schema") is None
+    assert set(storage.list_schemas()) == set(DEFAULT_SCHEMAS)
+
+
+def test_usage_counts_cards_by_schema(storage):
+    storage.import_deck("deck", make_deck(cards={
+        "1": make_card(),
+        "2": make_card(),
+        "3": make_card(schema_id=OTHER_SCHEMA_ID),
+    }))
+    assert storage.usage_by_schema() == {SCHEMA_ID: 2, OTHER_SCHEMA_ID: 1}
+
+    storage.delete_card("deck", "1")
+    assert storage.usage_by_schema() == {SCHEMA_ID: 1, OTHER_SCHEMA_ID: 1}
+
+
+def test_usage_follows_schema_changes(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(), "2": make_card()}))
+    storage.upsert_card("deck", "1", make_card(schema_id=OTHER_SCHEMA_ID))
+    assert storage.usage_by_schema() == {SCHEMA_ID: 1, OTHER_SCHEMA_ID: 1}
+    storage.upsert_card("deck", "2", make_card(schema_id=OTHER_SCHEMA_ID))
+    assert storage.usage_by_schema() == {OTHER_SCHEMA_ID: 2}
+
+
+def test_usage_after_deck_delete(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(), "2": make_card()}))
+    storage.import_deck("other", make_deck(cards={"1": make_card()}))
+    storage.delete_deck("deck")
+    assert storage.usage_by_schema() == {SCHEMA_ID: 1}
+    storage.delete_deck("other")
+    assert storage.usage_by_schema() == {}
+
+
+def test_recount_usage(storage):
+    storage.import_deck("deck", make_deck(cards={
+        "1": make_card(),
+        "2": make_card(schema_id=OTHER_SCHEMA_ID),
+    }))
+    usage = storage.usage_by_schema()
+    storage.recount_usage()
+    assert storage.usage_by_schema() == usage
+
+
+#
+# Pagination
+#
+
+
+def test_page_cards_in_creation_order(storage):
+    storage.import_deck("deck", make_deck())
+    for card in ["c", "a", "e", "b", "d"]:
+        storage.upsert_card("deck", card, make_card())
+
+    page, cursor = storage.page_cards("deck", limit=2)
+    assert list(page) == ["c", "a"]
+    page, cursor = storage.page_cards("deck", cursor, limit=2)
+    assert list(page) == ["e", "b"]
+    page, cursor = storage.page_cards("deck", cursor, limit=2)
+    assert list(page) == ["d"]
+    assert cursor is None
+
+
+def test_page_cursor_survives_writes(storage):
+    storage.import_deck("deck", make_deck())
+    for card in ["1", "2", "3", "4"]:
+        storage.upsert_card("deck", card, make_card())
+
+    page, cursor = storage.page_cards("deck", limit=2)
+    assert list(page) == ["1", "2"]
+    # Removing the last card of the page or adding cards doesn't shift the next page
+    storage.delete_card("deck", "2")
+    storage.upsert_card("deck", "5", make_card())
+    page, cursor = storage.page_cards("deck", cursor, limit=2)
+    assert list(page) == ["3", "4"]
+    page, cursor = storage.page_cards("deck", cursor, limit=2)
+    assert list(page) == ["5"]
+    assert cursor is None
+
+
+def test_page_decks(storage):
+    for deck in ["b", "a", "c"]:
+        storage.save_deck(deck, make_deck())
+    page, cursor = storage.page_decks(limit=2)
+    assert list(page) == ["b", "a"]
+    assert page["a"]["name"] == "Deck"
+    page, cursor = storage.page_decks(cursor, limit=2)
+    assert list(page) == ["c"]
+    assert cursor is None
+
+
+#
+# Search and filters
+#
+
+
+def test_search_decks_and_cards(storage):
+    storage.import_deck("deck", make_deck(name="Portuguese verbs", cards={
+        "1": make_card(question="falar"),
+        "2": make_card(question="comer", tags=["verbs"]),
+    }))
+    storage.import_deck("other", make_deck(name="Capitals", cards={
+        "1": make_card(question="Lisbon"),
+    }))
+    assert storage.search("verbs") == [("deck", None), ("deck", "2")]
+    assert storage.search("lisb") == [("other", "1")]  # The last word is a prefix
+    assert storage.search("nothing") == []
+
+
+def test_search_in_deck_and_limit(storage):
+    cards = {str(card): make_card(question="word") for card in range(10)}
+    storage.import_deck("deck", make_deck(name="word", cards=cards))
+    storage.import_deck("other", make_deck(cards=cards))
+    assert len(storage.search("word", deck_id="deck")) == 10
+    assert all(card_id for _, card_id in storage.search("word", deck_id="deck"))
+    assert len(storage.search("word", limit=5)) == 5
+    assert len(storage.search("word", limit=None)) == 21
+
+
+def test_search_follows_writes(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(question="before")}))
+    assert storage.search("before") == [("deck", "1")]
+    storage.upsert_card("deck", "1", make_card(question="after"))
+    assert storage.search("before") == []
+    assert storage.search("after") == [("deck", "1")]
+    storage.delete_card("deck", "1")
+    assert storage.search("after") == []
+
+
+def test_search_with_filters(storage):
+    cards = {
+        str(card): make_card(question="word", tags=["easy"] if card % 2 else [])
+        for card in range(10)
+    }
+    cards["10"] = make_card(question="word", tags=["easy"], schema_id=OTHER_SCHEMA_ID)
+    storage.import_deck("deck", make_deck(name="word", tags=["easy"], cards=cards))
+    storage.import_deck("other", make_deck(name="word", cards=cards))
+    # The limit is applied after the filters
+    found = storage.search("word", tags=["easy"], limit=3)
+    assert len(found) == 3
+    assert {card_id for _, card_id in found} <= {None, "1", "3", "5", "7", "9", "10"}
+    assert len(storage.search("word", tags=["easy"], limit=None)) == 13
+    assert storage.search("word", "other", tags=["easy"], schema_id=OTHER_SCHEMA_ID) == [
+        ("other", "10")
+    ]
+    assert storage.search("word", schema_id=OTHER_SCHEMA_ID) == [("deck", "10"), ("other", "10")]
+    assert storage.search("word", tags=["hard"]) == []
+
+
+def test_filter_decks(storage):
+    storage.save_deck("a", make_deck(tags=["pt", "verbs"]))
+    storage.save_deck("b", make_deck(tags=["pt"]))
+    storage.save_deck("c", make_deck())
+    assert storage.filter_decks(["pt"]) == ["a", "b"]
+    assert storage.filter_decks(["pt", "verbs"]) == ["a"]
+    assert storage.filter_decks([]) == ["a", "b", "c"]
+
+
+def test_filter_cards(storage):
+    storage.import_deck("deck", make_deck(cards={
+        "1": make_card(tags=["easy"]),
+        "2": make_card(tags=["easy"], schema_id=OTHER_SCHEMA_ID),
+        "3": make_card(),
+    }))
+    storage.import_deck("other", make_deck(cards={"1": make_card(tags=["easy"])}))
+    assert storage.filter_cards(tags=["easy"]) == [("deck", "1"), ("deck", "2"), ("other", "1")]
+    assert storage.filter_cards("deck", tags=["easy"]) == [("deck", "1"), ("deck", "2")]
+    assert storage.filter_cards(schema_id=OTHER_SCHEMA_ID) == [("deck", "2")]
+    assert storage.filter_cards("deck", tags=["easy"], schema_id=SCHEMA_ID) == [("deck", "1")]
+    assert storage.filter_cards("deck") == [("deck", "1"), ("deck", "2"), ("deck", "3")]
+    assert storage.filter_cards(limit=2) == [("deck", "1"), ("deck", "2")]
+
+    storage.upsert_card("deck", "1", make_card())
+    assert storage.filter_cards(tags=["easy"]) == [("deck", "2"), ("other", "1")]
+
+
+#
+# Version counters
+#
+
+
+def test_versions_start_at_zero(storage):
+    assert storage.get_versions(["decks", "deck/missing"]) == [0, 0]
+
+
+@pytest.mark.parametrize("write, bumped, unchanged", [
+    pytest.param(
+        lambda storage: storage.save_deck("deck", make_deck(name="New")),
+        ["decks", "deck/deck"], ["schemas", "deck/other"],
+        id="save_deck",
+    ),
+    pytest.param(
+        lambda storage: storage.upsert_card("deck", "2", make_card()),
+        ["deck/deck", "schemas"], ["decks", "deck/other"],
+        id="upsert_card",
+    ),
+    pytest.param(
+        lambda storage: storage.delete_card("deck", "1"),
+        ["deck/deck", "schemas"], ["decks", "deck/other"],
+        id="delete_card",
+    ),
+    pytest.param(
+        lambda storage: storage.delete_deck("deck"),
+        ["decks", "deck/deck", "schemas"], ["deck/other"],
+        id="delete_deck",
+    ),
+    pytest.param(
+        lambda storage: storage.save_schema(SCHEMA_ID, {"name": "Changed"}),
+        ["schemas", f"schema/{SCHEMA_ID}"], ["decks", "deck/deck", f"schema/{OTHER_SCHEMA_ID}"],
+        id="save_schema",
+    ),
+    pytest.param(
+        lambda storage: storage.record_review("deck", "1", "direct", 3),
+        [], ["decks", "deck/deck", "schemas"],
+        id="record_review",
+    ),
+])
+def test_writes_bump_versions(storage, write, bumped, unchanged):
+    storage.import_deck("deck", make_deck(cards={"1": make_card()}))
+    storage.import_deck("other", make_deck())
+    names = bumped + unchanged
+    before = dict(zip(names, storage.get_versions(names)))
+    write(storage)
+    after = dict(zip(names, storage.get_versions(names)))
+    assert [name for name in names if after[name] != before[name]] == bumped
+
+
+def test_transaction_bumps_versions_once(storage):
+    storage.save_deck("deck", make_deck())
+    (before,) = storage.get_versions(["deck/deck"])
+    with storage.transaction():
+        for card in range(3):
+            storage.upsert_card("deck", str(card), make_card())
+    (after,) = storage.get_versions(["deck/deck"])
+    assert after != before
+    if isinstance(storage, SQLiteStorage):
+        # The memory storages bump at every write: only SQLite has an end of transaction
+        assert after == before + 1
+
+
+#
+# Reviews
+#
+
+
+def test_reviews_and_models(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(), "2": make_card()}))
+    storage.record_review("deck", "1", "direct", 4)
+    assert sorted(storage.list_reviews("deck")) == [
+        ("1", "direct", 4), ("1", "reverse", None), ("2", "direct", None), ("2", "reverse", None)
+    ]
+    storage.save_model("deck", "1", "direct", (3.0, 3.0, 3.0, 100.0))
+    assert storage.get_model("deck", "1", "direct") == (3.0, 3.0, 3.0, 100.0)
+    assert storage.list_models("deck") == {("1", "direct"): (3.0, 3.0, 3.0, 100.0)}
+    assert storage.get_model("deck", "1", "reverse") is None
+
+
+def test_review_log(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(), "2": make_card()}))
+    storage.log_review("deck", "1", "direct", "correct", 100.0, 1.5)
+    storage.log_review("deck", "2", "reverse", "wrong", 200.0)
+    storage.log_review("deck", "1", "reverse", "correct", 300.0, 2.0)
+    assert [tuple(review) for review in storage.list_review_log("deck")] == [
+        ("1", "direct", "correct", 100.0, 1.5),
+        ("2", "reverse", "wrong", 200.0, None),
+        ("1", "reverse", "correct", 300.0, 2.0),
+    ]
+    # Deleting a card deletes its reviews from the log
+    storage.delete_card("deck", "1")
+    assert [tuple(review) for review in storage.list_review_log("deck")] == [
+        ("2", "reverse", "wrong", 200.0, None),
+    ]
+
+
+def test_clear_reviews_keeps_the_log(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card()}))
+    storage.record_review("deck", "1", "direct", 4)
+    storage.save_model("deck", "1", "direct", (3.0, 3.0, 3.0, 100.0))
+    storage.log_review("deck", "1", "direct", "correct", 100.0)
+    storage.clear_reviews("deck")
+    assert storage.list_reviews("deck") == [("1", "direct", None), ("1", "reverse", None)]
+    assert storage.list_models("deck") == {}
+    assert len(storage.list_review_log("deck")) == 1
+
+
+def test_review_index_follows_writes(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(reviews={"direct": 2})}))
+    assert storage.review_index.minimum("deck") == 2
+    storage.upsert_card("deck", "2", make_card(reviews={"direct": 1}))
+    assert storage.review_index.minimum("deck") == 1
+    storage.record_review("deck", "2", "direct", 5)
+    assert storage.review_index.minimum("deck") == 2
+    storage.delete_card("deck", "1")
+    assert storage.review_index.minimum("deck") == 5
+
+
+#
+# Rollbacks
+#
+
+
+def test_failed_transaction_is_undone(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(), "2": make_card()}))
+    storage.log_review("deck", "1", "direct", "correct", 100.0)
+    before = (storage.list_cards("deck"), storage.usage_by_schema())
+    versions = storage.get_versions(["decks", "deck/deck", "schemas"])
+    with pytest.raises(ValueError):
+        with storage.transaction():
+            storage.save_deck("deck", make_deck(name="Renamed"))
+            storage.upsert_card("deck", "1", make_card(schema_id=OTHER_SCHEMA_ID))
+            storage.upsert_card("deck", "3", make_card(question="added"))
+            storage.delete_card("deck", "2")
+            storage.record_review("deck", "1", "direct", 3)
+            storage.save_model("deck", "1", "direct", (3.0, 3.0, 3.0, 100.0))
+            storage.log_review("deck", "1", "direct", "wrong", 200.0)
+            storage.save_schema("schema", {"name": "Schema"})
+            storage.import_deck("other", make_deck(cards={"1": make_card()}))
+            raise ValueError()
+    assert storage.get_deck("deck")["name"] == "Deck"
+    assert (storage.list_cards("deck"), storage.usage_by_schema()) == before
+    assert storage.get_versions(["decks", "deck/deck", "schemas"]) == versions
+    assert storage.list_models("deck") == {}
+    assert len(storage.list_review_log("deck")) == 1
+    assert storage.get_schema("schema") is None
+    assert list(storage.list_decks()) == ["deck"]
+    assert storage.search("added") == []
+    assert [card for _, card in storage.filter_cards(schema_id=OTHER_SCHEMA_ID)] == []
+    assert storage.review_index.minimum("deck") == 0
+
+
+def test_failed_delete_is_undone(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(tags=["a"])}))
+    storage.save_model("deck", "1", "direct", (3.0, 3.0, 3.0, 100.0))
+    storage.log_review("deck", "1", "direct", "correct", 100.0)
+    with pytest.raises(ValueError):
+        with storage.transaction():
+            storage.clear_reviews("deck")
+            storage.delete_deck("deck")
+            raise ValueError()
+    assert storage.get_card("deck", "1") == make_card(tags=["a"])
+    assert storage.list_models("deck") == {("1", "direct"): (3.0, 3.0, 3.0, 100.0)}
+    assert len(storage.list_review_log("deck")) == 1
+    assert storage.usage_by_schema() == {SCHEMA_ID: 1}
+    assert storage.filter_cards(tags=["a"]) == [("deck", "1")]
+    page, _ = storage.page_cards("deck")
+    assert list(page) == ["1"]
+
+
+def test_shelve_never_saves_undone_writes(tmp_path):
+    storage = ShelveStorage(str(tmp_path / "flashcards"))
+    storage.open()
+    storage.import_deck("deck", make_deck(cards={"1": make_card()}))
+    with pytest.raises(ValueError):
+        with storage.transaction():
+            storage.delete_card("deck", "1")
+            raise ValueError()
+    storage.save_deck("other", make_deck())
+    storage.close()
+    storage.open()
+    assert list(storage.list_cards("deck")) == ["1"]
+    assert list(storage.list_decks()) == ["deck", "other"]
+    storage.close()
+
+
+def test_shelve_saves_only_the_changed_sections(tmp_path, monkeypatch):
+    storage = ShelveStorage(str(tmp_path / "flashcards"))
+    storage.open()
+    storage.import_deck("deck", make_deck(cards={"1": make_card()}))
+    written = []
+    setitem = shelve.Shelf.__setitem__
+    monkeypatch.setattr(
+        shelve.Shelf, "__setitem__",
+        lambda shelf, key, value: written.append(key) or setitem(shelf, key, value),
+    )
+    storage.save_model("deck", "1", "direct", (3.0, 3.0, 3.0, 100.0))
+    storage.log_review("deck", "1", "direct", "correct", 100.0)
+    assert written == ["models", "log"]
+    with pytest.raises(ValueError):
+        with storage.transaction():
+            storage.delete_deck("deck")
+            raise ValueError()
+    assert written == ["models", "log"]
+    storage.close()
+    storage.open()
+    assert storage.list_models("deck") == {("1", "direct"): (3.0, 3.0, 3.0, 100.0)}
+    assert len(storage.list_review_log("deck")) == 1
+    storage.close()
+
+
+def test_savepoint_undoes_a_failed_block(storage):
+    storage.import_deck("deck", make_deck(cards={"1": make_card(), "2": make_card()}))
+    with storage.transaction():
+        storage.record_review("deck", "1", "direct", 3)
+        with pytest.raises(ValueError):
+            with storage.savepoint():
+                storage.record_review("deck", "2", "direct", 4)
+                raise ValueError()
+    assert storage.get_card("deck", "1")["reviews"]["direct"] == 3
+    assert storage.get_card("deck", "2")["reviews"]["direct"] is None
+    assert storage.review_index.minimum("deck") == 0
+
+
+def test_sqlite_numbers_the_decks_and_cards_of_older_databases(tmp_path):
+    path = str(tmp_path / "flashcards.sqlite3")
+    connection = sqlite3.connect(path)
+    # Without `seq`: the rows are numbered by their implicit rowid
+    connection.executescript(f"""
+        CREATE TABLE decks (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE cards (
+            deck_id TEXT NOT NULL REFERENCES decks(id) ON DELETE CASCADE,
+            id TEXT NOT NULL,
+            schema TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (deck_id, id)
+        );
+        INSERT INTO decks (rowid, id, data) VALUES (7, 'b', '{{"name": "Second"}}');
+        INSERT INTO decks (rowid, id, data) VALUES (3, 'a', '{{"name": "First"}}');
+        INSERT INTO cards (rowid, deck_id, id, schema, data)
+            VALUES (9, 'a', '2', '{SCHEMA_ID}', '{{"question": "second"}}');
+        INSERT INTO cards (rowid, deck_id, id, schema, data)
+            VALUES (4, 'a', '1', '{SCHEMA_ID}', '{{"question": "first"}}');
+    """)
+    connection.close()
+
+    storage = SQLiteStorage(path)
+    storage.open()
+    assert list(storage.list_decks()) == ["a", "b"]
+    # Numbered by their rowids: the cursors and search indexes stay valid
+    assert storage._query("SELECT seq, id FROM cards ORDER BY seq") == [(4, "1"), (9, "2")]
+    assert list(storage.page_cards("a", "4")[0]) == ["2"]
+    assert storage.search("second") == [("b", None), ("a", "2")]
+    storage.save_deck("c", make_deck())
+    assert list(storage.page_decks("7")[0]) == ["c"]
+    storage.delete_deck("a")
+    assert storage.search("first") == []
+    assert storage.usage_by_schema() == {}
+    storage.close()